@@ -2,14 +2,25 @@ import serial
 import serial.tools.list_ports
 import time
 import threading
+import collections
 import RepeatTimer
 import sys
 import math
 import inspect
+import struct
 
 
 import channels
 import logger
+import framing
+import streamdecode
+import dispatch
+import metrics
+import capture
+import outbound
+import devicestate
+import flightrec
+import clockmodel
 
 
 DEFAULTOUTFILE = "test.txt"
@@ -22,6 +33,11 @@ ESC = "`"
 
 #keyTable = {0:"talk",1:"over",2:"bad",3:"version",4:"start",5:"stop",6:"set",7:"dir",8:"query",9:"info",10:"dig",11:"wav"} 
 keyTable = ["talk","over","bad","version","start","stop","set","dir","query","info","dig","wav","point","sync","avg", "timer", "event", "resetevents", "trigger"]
+SYNC = chr(keyTable.index("sync"))	# first byte of a sync packet
+encoder = framing.Encoder(keyTable)
+# message types whose first word holds a channel index -> the shift that leaves the index. Callbacks can be registered for one channel of these, see PropCom.register.
+channelKeys = {"info": 0, "set": 0, "point": 12}
+channelShifts = [channelKeys.get(name) for name in keyTable]	# message type ID -> shift of the channel index in the first word, or None
 
 
 # -- Class that holds one integer point.
@@ -57,7 +73,11 @@ class Device():
 	# nDigitals = number of digital channels. includes digital inputs and digital outputs.
 
 	def __init__(self, nAnalogI, nAnalogO, nDigitals):
-		self.propCom = PropCom()
+		if logger.options.get("acquisition_process", False):
+			import acquisition # imported here, acquisition imports this module
+			self.propCom = acquisition.RemotePropCom()
+		else:
+			self.propCom = PropCom()
 		self.analogIn = dict()
 		self.analogOut = dict()
 		self.digitals = None
@@ -99,33 +119,46 @@ class Device():
 
 		self.propCom.send("avg", self.propCom.nAvg)
 		
-	# function Device.queryChannel( Int chan ) Query the specified channel number for its state information like sample rate, start/stop state, etc.
+	# function Device.queryChannel( Int chan ) return outbound.Request|outbound.RequestGroup|None Query the specified channel number for its state information like sample rate, start/stop state, etc.
 	# chan = The channel number of the channel to querry. Leave blank to querry all channels
+	# All channels are queried with a single write, and answered in one round trip. The info hooks of the channels run as each answer arrives.
+	# Wait on the result for the info words, e.g. device.queryChannel().wait(1.0)
 	def queryChannel(self, chan=None):
 		if chan is None:
+			queries = []
 			for x in self.analogIn:
-				idx = self.channels[x].idx
-				self.propCom.send("query", idx)
+				queries.append(outbound.Request("query", self.channels[x].idx, "info", self.channels[x].idx))
 			for x in self.analogOut:
-				idx = self.channels[x].idx
-				self.propCom.send("query", idx)
-			idx = self.digitals.idx
-			self.propCom.send("query", idx)
+				queries.append(outbound.Request("query", self.channels[x].idx, "info", self.channels[x].idx))
+			queries.append(outbound.Request("query", self.digitals.idx, "info", self.digitals.idx))
+			return self.propCom.requestMany(queries)
 		else:
 			if chan in self.channels:
 				idx = self.channels[chan].idx
-				self.propCom.send("query", idx)
+				return self.propCom.query(idx)
 			else:
 				logger.log("Bad Channel Querry", chan, logger.WARNING)
+				return None
 	# function Device.addEvent( String condition, Int condParam, String action, Int actionParam ) Add a new event, that executes *action* with specified parameters in *actionParam* when *condition* is met with the given parameters in *condParam*. *condition* and *action* should match entries in the device condition and action tables.
 	def addEvent(self, condition, condParam, *actionArg):
-
+		self.propCom.send( *self.eventMessage(condition, condParam, *actionArg) )
+
+	# function Device.addEvents( [(String condition, Int condParam, String action, Int actionParam, ...)] events, Bool reset ) Add several events with a single write.
+	# Each event is a tuple of the arguments Device.addEvent takes. If *reset* is True, existing events are removed first.
+	def addEvents(self, events, reset=False):
+		messages = [self.eventMessage(*e) for e in events]
+		if reset:
+			messages.insert(0, ("resetevents",))
+		self.propCom.sendMany(messages)
+
+	# function Device.eventMessage( String condition, Int condParam, String action, Int actionParam, ... ) return (String, [Int]) the "event" message for PropCom.send
+	def eventMessage(self, condition, condParam, *actionArg):
 		actions = [0] * len(actionArg)
 		for n in range(0,len(actionArg),2):
 				actions[n] = self.actions.index(actionArg[n])
 				actions[n+1] = actionArg[n+1]
 
-		self.propCom.send( "event", [self.conditions.index(condition), condParam] + actions )
+		return ("event", [self.conditions.index(condition), condParam] + actions)
 
 	#function Device.setEventTimer(Int timerID, Int time) Sets the timer specified by *timerID* to match the time, in device clock cycles, given by *time*
 	def setEventTimer(self, timerID, time):
@@ -136,6 +169,11 @@ class Device():
 	#function Device.resetEvents() Reset and remove all events from the event loop.
 	def resetEvents(self):
 		self.propCom.send("resetevents")
+	# function Device.restart() Close the port and search for the device again. Every channel moves to the new PropCom, with its callbacks and stream listeners.
+	def restart(self):
+		self.propCom = self.propCom.restart()
+		for c in self.channels.values():
+			c.propCom = self.propCom
 
 
 
@@ -152,6 +190,8 @@ class PropCom(threading.Thread):
 	MIN_ADC_PERIOD = 1500
 	MAX_AVG = 100
 	MAX_CLOCK = (1<<32) - 1
+	HALF_CLOCK = 1<<31	# timestamps further apart than this are taken to be on the other side of a rollover
+	STREAM_IDLE = 1<<30	# ticks of sync after which a stream's counter is placed again from the last sync
 	MAX_RATE = 1500 # max sampling rate in samples per second
 	nAvg = 1
 	name = "?"
@@ -165,7 +205,7 @@ class PropCom(threading.Thread):
 	eIDs = dict()
 
 	# dictionary of callback functions for each 
-	callbacks = dict()
+	callbacks = None
 	echoCallbacks = dict()
 
 
@@ -173,75 +213,335 @@ class PropCom(threading.Thread):
 	# callbacks = If specified, the new PrpCom object will start with its callback table initialized to this dictionary.
 	def __init__ (self, callbacks=None):
 		if callbacks is not None: self.callbacks = callbacks
+		else: self.callbacks = dict()
+		self.buildRoutes()
 		self.com = serial.Serial(timeout=None)
 		threading.Thread.__init__(self)
 		self.daemon = True
 		self.setDaemon(True)
 		self.lastPkt = 0
-		self.lastTStamp = dict()
-		self.lastRTime = dict()
+		self.streams = dict()	# stream ID -> (last timestamp, its unwrapped ticks, cnt at which it goes stale), see PropCom.streamTicks
 		self.lastTime = None
-		#self.lastRTime = 0
-		self.cnt = 0
+		self.cnt = 0	# device ticks from the first sync to the last, unwrapped
+		self.clock = clockmodel.ClockModel(self.CLOCKPERSEC, logger.options.get("clock_window", 300), logger.options.get("clock_outlier", 0.05), logger.options.get("clock_reset", 1.0))
+		self.syncArrivals = collections.deque(maxlen=64)	# (timestamp, host time it was read) of sync packets not yet handled, see PropCom.syncArrival
 		self.MAXTICK = (1 << 32) -1
 		self.port=None # initial port to attempt to open. overrides default search
-		self.listeners = [set(),set(),set(),set(),set(),set(),set(),set()] # length 8 list of sets
+		self.listeners = [(),(),(),(),(),(),(),()] # length 8 list of tuples. Each tuple is replaced, never changed, so callStream can loop over it without copying.
+		self.registryLock = threading.Lock() # serializes changes to listeners and callbacks
+		self.framer = framing.Framer()
+		self.ring = framing.RxRing(int(logger.options.get("rx_buffer_size", 65536)))
+		self.queue = None	# PacketQueue between the reader and the dispatcher threads. None to dispatch on the reader thread.
+		self.dispatchers = []
+		self.metrics = metrics.Metrics(self)
+		self.capture = None	# capture.CaptureWriter teeing every byte read, while the capture_file option is set
+		self.outbox = None	# outbound.Outbox feeding the writer thread. None to write on the calling thread.
+		self.writer = None
+		self.settings = dict()	# outbound.coalesceKey -> the last avg, dir or set sent, for restoreState
+		self.startMask = 0	# channels started and not stopped since, for restoreState
+		self.firmwareVersion = None	# from the last version packet answering the handshake
+		self.lost = False	# True when the port failed under the read loop, rather than being closed
+		self.closing = False	# True once PropCom.close is called. Stops any reconnect.
+		self.requests = dict()	# message ID -> outbound.Request waiting for its answer
+		self.requestLock = threading.Lock()
+		self.msgIDLock = threading.Lock()
+		self.recorder = None	# flightrec.FlightRecorder keeping the last packets read, unless the flight_records option is 0
+		if int(logger.options.get("flight_records", 8192)) > 0:
+			self.recorder = flightrec.FlightRecorder(int(logger.options.get("flight_records", 8192)), int(logger.options.get("flight_slot_bytes", 128)))
+		self.badBurst = int(logger.options.get("flight_bad_checksum_burst", 5))	# bad checksums within a second that dump the flight recorder. 0 for never
+		self.badSeen = 0	# framer.badChecksums at the last check
+		self.badSince = 0	# start of the current second of bad checksums
+		self.badCount = 0
 
 	# function PropCom.run() Starts a new thread to read information from the com buffers.
 	# The PropCom must first be in the open state before this method is called. 
 	# A new thread is created that will terminate when the connection is closed.
 	# This method should not be called directly.
+	# If the port fails while reading, the device is searched for again and its settings restored, see PropCom.reconnect.
 	def run(self):
 		self.open(self.port)
-		buf = EOP + " "
-		waiting = 0
-	
+		self.receive()
+		while self.lost and self.reconnect():
+			self.receive()
+
+	# function PropCom.receive() Read from the open serial port until it is closed, passing everything read to PropCom.parse.
+	# The read strategy is picked by the [com] read_mode option:
+	# "byte" reads one byte per call and parses after every EOP.
+	# "bulk" blocks for at most read_timeout seconds, then drains everything waiting (up to read_size bytes) in one call and parses the whole chunk.
+	# If the capture_file option is set, every byte read is also recorded there, see capture.py.
+	def receive(self):
+		self.framer = framing.Framer()
+		self.badSeen = 0
+		self.startDispatchers()
+		self.startWriter()
+		self.capture = None
+		if logger.options.get("capture_file", ""):
+			try:
+				self.capture = capture.CaptureWriter(logger.options["capture_file"])
+				logger.log("Capturing to", self.capture.fname, logger.INFO)
+			except IOError as e:
+				logger.log("Could not open capture file", e, logger.ERROR)
+		try:
+			if logger.options["read_mode"] == "byte":
+				self.receiveBytes()
+			else:
+				self.receiveChunks()
+		finally:
+			if self.capture is not None:
+				self.capture.close()
+
+	# function PropCom.receiveBytes() Read loop used by the "byte" read_mode. One read call per byte.
+	def receiveBytes(self):
+		buf = ""
 		while self.isOpen():
 			# try to read in new info
 			try:
 				c = self.com.read(1)
 				buf += c
+				self.metrics.bytesRead += len(c)
+				if self.capture is not None:
+					self.capture.write(c)
 				if c == EOP:
 					c = self.com.read(1)
 					buf += c
-					prebuf = buf
-					buf = self.parse(buf)
-					if logger.options["log_buffer"] and buf != prebuf:
-						logger.write(prebuf + " Parsed to " + buf)
+					if logger.logBuffer:
+						logger.write("buffer: " + buf)
+					t = time.time()
+					self.deliver(self.framer.feed(buf), t)
+					self.metrics.parseTime(time.time() - t)
+					buf = ""
+			except serial.SerialException as err:
+				if not self.closing: # the port was closed under the read, nothing went wrong
+					logger.log("SerialException on read", err,logger.WARNING)
+					self.flightEvent("SerialException on read: " + str(err), not isinstance(self.com, capture.ReplaySerial)) # a replay ends this way
+				self.dropPort() # clean-up
+				break
+			except TypeError:
+				if not self.closing:
+					raise
+				break # pyserial reading a port closed under it, its fd is None
+
+	# function PropCom.receiveChunks() Read loop used by the "bulk" read_mode. One read call per chunk of waiting bytes.
+	# Bytes are read straight into the preallocated receive ring, and packets are dispatched as views into it.
+	def receiveChunks(self):
+		readSize = int(logger.options["read_size"])
+		self.com.timeout = logger.options["read_timeout"] # lets the loop notice a closed port while the line is idle
+		ring = self.ring
+		ring.clear()
+		while self.isOpen():
+			try:
+				waiting = self.com.inWaiting()
+				room = ring.reserve(readSize)
+				if len(room) == 0:
+					logger.log("Receive buffer overflow", "no packet end in " + str(ring.size) + " bytes", logger.WARNING)
+					self.framer.reset(False)
+					continue
+				n = self.com.readinto(room[:min(max(waiting, 1), len(room))])
+				if not n:
+					continue # timed out with nothing waiting
+				ring.commit(n)
+				self.metrics.bytesRead += n
+				if self.capture is not None:
+					self.capture.write(room[:n])
+				if logger.logBuffer:
+					logger.write("buffer: " + room[:n].tobytes())
+				t = time.time()
+				self.deliver(self.framer.feedRing(ring), t)
+				self.metrics.parseTime(time.time() - t)
 			except serial.SerialException as err:
-				logger.log("SerialException on read", err,logger.WARNING)
-				self.close() # clean-up
+				if not self.closing: # the port was closed under the read, nothing went wrong
+					logger.log("SerialException on read", err,logger.WARNING)
+					self.flightEvent("SerialException on read: " + str(err), not isinstance(self.com, capture.ReplaySerial)) # a replay ends this way
+				self.dropPort() # clean-up
 				break
-	# function PropCom.restart() Restarts the objects thread by making a new PropCom object with the same callbacks table.
+			except TypeError:
+				if not self.closing:
+					raise
+				break # pyserial reading a port closed under it, its fd is None
+	# function PropCom.startDispatchers() Create the packet queue and start the dispatcher threads, if the [com] dispatch_threads option asks for any.
+	# queue_size and queue_policy set the queue capacity and what happens when it is full (block, drop_oldest or drop_newest).
+	# With more than one dispatcher thread, packets are no longer handled strictly in order.
+	def startDispatchers(self):
+		nThreads = int(logger.options.get("dispatch_threads", 0))
+		if nThreads <= 0:
+			self.queue = None
+			return
+		if self.queue is None:
+			self.queue = dispatch.PacketQueue(logger.options.get("queue_size", 1000), logger.options.get("queue_policy", dispatch.DROP_OLDEST), self.ring.release)
+			self.ring.limitSpares(self.queue.maxsize)
+		self.dispatchers = [d for d in self.dispatchers if d.isAlive()]
+		while len(self.dispatchers) < nThreads:
+			d = dispatch.Dispatcher(self, self.queue, len(self.dispatchers))
+			d.start()
+			self.dispatchers.append(d)
+
+	# function PropCom.stopDispatchers( Float timeout ) Close the packet queue and wait for the dispatcher threads to end. Packets still queued are not dispatched.
+	def stopDispatchers(self, timeout=1.0):
+		queue = self.queue
+		self.queue = None
+		if queue is None:
+			return
+		queue.close()
+		for d in self.dispatchers:
+			if d is not threading.currentThread():
+				d.join(timeout)
+		self.dispatchers = []
+
+	# function PropCom.startWriter() Start the writer thread that sends queued control packets, unless the [com] writer_thread option is off.
+	# send_dedupe_window is how long a set or avg sent with dedupe=True and identical to the last one written is skipped, in seconds. 0 turns it off.
+	def startWriter(self):
+		if not logger.options.get("writer_thread", True):
+			return
+		if self.writer is not None and self.writer.isAlive():
+			return
+		self.outbox = outbound.Outbox()
+		self.writer = outbound.Writer(self, self.outbox, logger.options.get("send_dedupe_window", 0))
+		self.writer.start()
+
+	# function PropCom.stopWriter( Float timeout ) Stop the writer thread. Later sends are written on the calling thread.
+	def stopWriter(self, timeout=1.0):
+		outbox = self.outbox
+		self.outbox = None
+		if outbox is not None:
+			outbox.close()
+			self.writer.join(timeout)
+
+	# function PropCom.deliver( [String] packets, Float arrived ) Pass freshly framed packets on. Called on the reader thread.
+	# arrived = the host time the packets were read. Kept for each sync packet, so the clock model does not see how long it waited for a dispatcher. See PropCom.syncArrival.
+	# Without a queue they are dispatched right away. Otherwise they are queued for the dispatcher threads.
+	# Views into the receive ring are not copied. They are held in the ring until the dispatcher releases them, see RxRing.hold.
+	# Every packet is also added to the flight recorder, and a burst of bad checksums dumps it.
+	def deliver(self, packets, arrived):
+		for packet in packets:
+			if packet[0] == SYNC and len(packet) >= 6:
+				self.syncArrivals.append((struct.unpack_from(">I", packet, 2)[0], arrived))
+		if self.recorder is not None:
+			self.recordPackets(packets)
+			if self.framer.badChecksums != self.badSeen:
+				self.checkBadChecksums(self.framer.badChecksums)
+		queue = self.queue
+		if queue is None:
+			self.dispatch(packets)
+			return
+		holder = None
+		if packets and isinstance(packets[0], memoryview):
+			holder = self.ring.hold(len(packets))
+		queue.put(packets, holder)
+
+	# function PropCom.recordPackets( [String] packets ) Add packets to the flight recorder, with the sync state they arrived in.
+	# Stream packets are recorded under their stream ID. Control packets about a channel, see channelKeys, also record the channel index.
+	def recordPackets(self, packets):
+		record = self.recorder.record
+		if self.lastTime is None:
+			lastSync, ticks, flags = 0, 0, 0
+		else:
+			lastSync, ticks, flags = self.lastTime, int(self.cnt), flightrec.SYNCED
+		for packet in packets:
+			first = ord(packet[0])
+			if first & 128:
+				record(flightrec.STREAM, (first >> 4) & 7, flightrec.NO_CHANNEL, packet, lastSync, ticks, flags)
+				continue
+			channel = flightrec.NO_CHANNEL
+			if first < len(channelShifts) and channelShifts[first] is not None and len(packet) >= 6:
+				channel = min(struct.unpack_from(">I", packet, 2)[0] >> channelShifts[first], flightrec.NO_CHANNEL - 1)
+			record(flightrec.CONTROL, first, channel, packet, lastSync, ticks, flags)
+
+	# function PropCom.checkBadChecksums( Int bad ) Dump the flight recorder if at least flight_bad_checksum_burst checksums failed within a second. *bad* is the framer's count so far.
+	def checkBadChecksums(self, bad):
+		now = time.time()
+		if now - self.badSince > 1.0:
+			self.badSince = now
+			self.badCount = 0
+		self.badCount += bad - self.badSeen
+		self.badSeen = bad
+		if self.badBurst > 0 and self.badCount >= self.badBurst:
+			self.badCount = 0
+			self.flightEvent("Bad checksum burst: " + str(bad) + " bad checksums since the port opened")
+
+	# function PropCom.flightEvent( String text, Bool dump ) Add *text* to the flight recorder, and dump the recorder unless *dump* is False.
+	# Automatic dumps are at least flight_dump_interval seconds apart, so a storm of errors writes one file.
+	def flightEvent(self, text, dump=True):
+		recorder = self.recorder
+		if recorder is None:
+			return
+		if self.lastTime is None:
+			recorder.record(flightrec.EVENT, 0, flightrec.NO_CHANNEL, text)
+		else:
+			recorder.record(flightrec.EVENT, 0, flightrec.NO_CHANNEL, text, self.lastTime, int(self.cnt), flightrec.SYNCED)
+		now = time.time()
+		if dump and now - recorder.lastDump >= float(logger.options.get("flight_dump_interval", 10)):
+			recorder.lastDump = now
+			self.dumpFlightRecorder(text)
+
+	# function PropCom.dumpFlightRecorder( String reason, String fname ) return String|None Write the flight recorder to *fname*, by default the flight_file option formatted by time.strftime.
+	# Returns the file name, or None if there is no flight recorder. Decode the file with "python flightrec.py file".
+	def dumpFlightRecorder(self, reason="", fname=None):
+		if self.recorder is None:
+			return None
+		if fname is None:
+			fname = time.strftime(logger.options.get("flight_file", "flight-%Y%m%d-%H%M%S.bin"))
+		self.recorder.dump(fname)
+		logger.log("Flight recorder dumped to " + fname, reason, logger.INFO)
+		return fname
+
+	# function PropCom.queueStats() return Dict|None depth and drop counters of the packet queue, or None when dispatching on the reader thread.
+	def queueStats(self):
+		if self.queue is None:
+			return None
+		return self.queue.stats()
+
+	# function PropCom.copyRate() return Float bytes per second the receive path copied since the last call. Close to zero when nothing is being copied per byte.
+	def copyRate(self):
+		return self.ring.copyRate(self.framer)
+
+	# function PropCom.restart() return PropCom Restarts the objects thread by making a new PropCom object with the same callbacks table.
+	# The new object also keeps the stream listeners and the settings to restore after a reconnect. It searches for the device again, known port first.
 	def restart(self):
 		self.close()
-		thread.sleep(1000)
-		newSelf = PropCom(callbacks=self.callbacks)
+		if self.isAlive():
+			self.join(2.0)
+		newSelf = self.__class__(callbacks=self.callbacks)
+		newSelf.ID = self.ID	# IDs of registered callbacks stay unique
+		newSelf.listeners = self.listeners
+		newSelf.settings = self.settings
+		newSelf.startMask = self.startMask
+		newSelf.nAvg = self.nAvg
 		newSelf.start()
 		return newSelf
 	
+	# function PropCom.syncArrival( Int tStamp ) return Float the host time the sync packet with timestamp *tStamp* was read, or now if it was not seen by PropCom.deliver.
+	# Arrivals of syncs that were skipped over are dropped.
+	def syncArrival(self, tStamp):
+		arrivals = self.syncArrivals
+		while arrivals:
+			t, arrived = arrivals.popleft()
+			if t == tStamp:
+				return arrived
+		return time.time()
+
 	# function PropCom.onSync( Int tStamp ) Sync the PropCom objects internal clock state to reflect the device's CPU clock.
 	# The PropCom object keeps track of timestamps and can change from timestamps to system time.
-	# Should be called on every *sync* packet. 
+	# Should be called on every *sync* packet. Each sync is added to PropCom.clock, the model that turns ticks into seconds, see clockmodel.py,
+	# with the time it was read rather than the time it is handled, see PropCom.syncArrival.
 	def onSync(self, tStamp):
+		arrived = self.syncArrival(tStamp)
 		if self.lastTime is None:
 			self.firstTime = tStamp
 			self.lastTime = tStamp
-			if logger.options["log_sync"]:
+			self.clock.add(self.cnt, arrived)
+			if logger.logSync:
 				logger.write( "first: "  + str(self.lastTime) )
 			return 
 			
 		#updates the clock counter with a new value. tests for overflow.
-		if tStamp >= self.lastTime:
-			elapsedTicks = tStamp - self.lastTime
-			if logger.options["log_sync"]:
+		elapsedTicks = (tStamp - self.lastTime) & self.MAX_CLOCK
+		if logger.logSync:
+			if tStamp >= self.lastTime:
 				logger.log( "sync", str(self.lastTime) + " -> " + str(tStamp), logger.INFO)
-		else:
-			elapsedTicks = tStamp + (self.MAXTICK - self.lastTime)
-			if logger.options["log_sync"]:
+			else:
 				logger.log( "sync (rollover)", str(self.lastTime) + " -> " + str(tStamp), logger.INFO)
 
-		if logger.options["log_sync"]:
+		if logger.logSync:
 			if elapsedTicks < self.SYNCPERIOD - self.CLOCKERROR:
 				logger.log( "sync too soon! not enough ticks!", elapsedTicks, logger.WARNING)
 			if elapsedTicks > self.SYNCPERIOD + self.CLOCKERROR:
@@ -249,57 +549,54 @@ class PropCom(threading.Thread):
 
 		self.cnt += elapsedTicks
 		self.lastTime = tStamp
-		if logger.options["log_sync"]:
-			logger.write( str(self.cnt) + "ticks. " + str(self.curTime()) + "seconds from first sync. estimated " + str(self.estTime()))
-		if abs(self.curTime() - self.estTime()) > 1.0: #Adjust if time has strayed
-			logger.log("Significant Timing difference between curTime() and estTime()" , str(self.curTime() - self.estTime()),logger.ERROR)
-			self.cnt -= (self.curTime() - self.estTime())*self.CLOCKPERSEC
+		error = self.clock.add(self.cnt, arrived)
+		if logger.logSync:
+			logger.write( str(self.cnt) + "ticks. " + str(self.curTime()) + "seconds from first sync. off by " + str(error) + ", drift " + str(self.clock.drift()) + "ppm")
+		if abs(error) > self.clock.reset: # the model started over from this sync
+			logger.log("Significant Timing difference between the device clock and the host clock" , str(error),logger.ERROR)
+			self.flightEvent("Significant Timing difference between the device clock and the host clock: " + str(error))
 
 	# function PropCom.curTime() return Float the current time in seconds since the first sync.
 	def curTime(self):
-		return (self.cnt) / float(self.CLOCKPERSEC)
+		return self.clock.seconds(self.cnt)
 	# function PropCom.estTime() return Float an estimated time in seconds since the first sync. Uses system clock and is imprecise.
 	def estTime(self):
 		return time.time()-self.firstSyncTime
 
-	# function PropCom.realTime(Int tStamp) return Float The time in seconds since the first sync this timestamp corresponds to.
+	# function PropCom.ticks( Int tStamp ) return Int the device ticks since the first sync this timestamp corresponds to, for PropCom.clock.
+	# tStamp = the timestamp to be converted. Must be within +- 1/2 clock cycle since the last sync to avoid errors. Before the first sync it is taken as the first sync.
+	def ticks(self, tStamp):
+		if self.lastTime is None:
+			return 0
+		return self.cnt + ((tStamp - self.lastTime + self.HALF_CLOCK) & self.MAX_CLOCK) - self.HALF_CLOCK
+
+	# function PropCom.streamTicks( Int tStamp, Int streamID ) return Int the device ticks since the first sync this timestamp of stream *streamID* corresponds to.
+	# Each stream keeps its own unwrapped counter, moved on by the difference from the stream's previous timestamp, so it stays exact for the whole session.
+	# The first timestamp of a stream, or the first after it was idle for STREAM_IDLE ticks or more, is placed from the last sync by PropCom.ticks.
+	def streamTicks(self, tStamp, streamID=-1):
+		state = self.streams.get(streamID)
+		if state is None or self.cnt >= state[2]:
+			ticks = self.ticks(tStamp)
+		else:
+			elapsedTicks = ((tStamp - state[0] + self.HALF_CLOCK) & self.MAX_CLOCK) - self.HALF_CLOCK
+			ticks = state[1] + elapsedTicks
+			if elapsedTicks < -(self.CLOCKPERSEC >> 1):
+				logger.log("Went back in time??? [" + str(streamID) + "]  ("+str(state[0])+"->"+str(tStamp)+") Dif="+str(-elapsedTicks)+"ticks", ticks, logger.WARNING)
+				self.flightEvent("Went back in time [" + str(streamID) + "] " + str(state[0]) + "->" + str(tStamp) + ", " + str(-elapsedTicks) + " ticks")
+		self.streams[streamID] = (tStamp, ticks, -1 if self.lastTime is None else self.cnt + self.STREAM_IDLE)
+		return ticks
+
+	# function PropCom.realTime(Int tStamp) return Float The time in seconds since the first sync this timestamp corresponds to, from PropCom.streamTicks and PropCom.clock.
 	# tStamp = the timestamp to be converted. Must be within +- 1/2 clock cycle since the last sync to avoid errors
 	def realTime(self, tStamp, streamID=-1):
-		if tStamp >= self.lastTime and tStamp - self.lastTime < self.MAXTICK/2: 			# this timestamp is after last sync, and no rollovers
-			elapsedTicks = tStamp - self.lastTime
-		elif self.lastTime - tStamp > self.MAXTICK/2: 	# this timestamp is new, but rolled over since last sync
-			#logger.write( "!!" + str(self.lastTime) + "->" + str(tStamp))
-			elapsedTicks = tStamp + (self.MAXTICK - self.lastTime)
-		elif tStamp < self.lastTime:  						# this timestamp is slightly old, assuming it is not garbage data.
-			elapsedTicks = tStamp - self.lastTime #returns a negative elapsed time.
-		elif tStamp > self.lastTime and tStamp - self.lastTime > self.MAXTICK/2: #this timestamp is in the past, but clock recently rolled over.
-			logger.write("!!@" + str(self.lastTime) + "->" + str(tStamp))
-			elapsedTicks = tStamp - self.MAXTICK - self.lastTime
-		else:
-			logger.log("No condition matched for 'realTime()'","Propellor.py", logger.ERROR)
-			elapsedTicks = 0
-
-		try:
-			lastRTime = self.lastRTime[streamID]
-			lastTStamp = self.lastTStamp[streamID]
-		except KeyError as e:
-			lastRTime = 0
-			lastTStamp = 0
-
-		rTime = (self.cnt + elapsedTicks) / float(self.CLOCKPERSEC)
-		if lastRTime > rTime + 0.5:
-			logger.log("Went back in time??? [" + str(streamID) + "]  ("+str(lastTStamp)+"->"+str(tStamp)+") Dif="+str(lastTStamp-tStamp)+"ticks, " + str(lastRTime-rTime)+"seconds",rTime,logger.WARNING)
-		self.lastTStamp[streamID] = tStamp
-		self.lastRTime[streamID] = rTime
-
-
-		return rTime
+		return self.clock.seconds(self.streamTicks(tStamp, streamID))
 	# functino PropCom.nextMsgID() return Int a sequential message ID for the next message to be sent.
 	def nextMsgID(self):
-		self.msgID = (self.msgID + 1) & 255
-		if self.msgID == 0:
+		with self.msgIDLock:
 			self.msgID = (self.msgID + 1) & 255
-		return self.msgID
+			if self.msgID == 0:
+				self.msgID = (self.msgID + 1) & 255
+			return self.msgID
 	# function PropCom.newID() return Int a new unique ID.
 	def newID(self):
 		self.ID = (self.ID + 1)
@@ -310,85 +607,283 @@ class PropCom(threading.Thread):
 	# streamID = The ID of the stream of interest
 	# obj = StreamListener object that has methods to react to any events of interest. 
 	def addListener(self, streamID, obj):
-		self.listeners[streamID].add(obj)
+		with self.registryLock:
+			if obj not in self.listeners[streamID]:
+				self.listeners[streamID] = self.listeners[streamID] + (obj,)
 	
 	# function PropCom.removeListener( Int streamID, StreamListener obj ) Removes the StreamListener from the list of objects listening to this stream.
 	# If no such object is registered, a KeyError is raised.
 	# steamID = the ID of the stream of interest
 	# obj = StreamListener object ot be removed from the list.
 	def removeListener(self, streamID, obj):
-		try:
-			self.listeners[streamID].remove(obj)
-		except KeyError as E:
-			logger.log("No function registered in channel " + str(self.idx),  str(obj), logger.WARNING)
-			raise
+		with self.registryLock:
+			listeners = self.listeners[streamID]
+			if obj not in listeners:
+				logger.log("No function registered in stream " + str(streamID),  str(obj), logger.WARNING)
+				raise KeyError(obj)
+			self.listeners[streamID] = tuple([f for f in listeners if f is not obj])
 
 
-	# function register( String name, Function func, Function test)
+	# function register( String name, Function func, Function test, Int index)
 	# Registers the given function to the given message name. func will be called for any packet with of the given message type.
 	# func = Called any time a matching control packet is recieved.
 	# test = A predicate can be used to only execute func if test returns true.
-	def register(self, name, func, test=None):
-		ID = self.newID()
-		if name not in self.callbacks:
-			self.callbacks[name] = dict()
-		self.callbacks[name][ID]=(test, func)
+	# index = Only call func for packets about this channel index. Packets are routed straight to it, without running a test for every callback.
+	#	Only for the message types in channelKeys. Raises ValueError for others.
+	def register(self, name, func, test=None, index=None):
+		if index is not None and name not in channelKeys:
+			raise ValueError("No channel index in " + str(name) + " packets")
+		with self.registryLock:
+			ID = self.newID()
+			if name not in self.callbacks:
+				self.callbacks[name] = dict()
+			self.callbacks[name][ID]=(test, func, index)
+			self.buildRoutes()
 		return ID
 	# function deregister( String name, Int funcID ) return Bool|None true if successful. If no such function is registered, None is returned and a KeyError is raised.
 	# name = Name of the message type the functino is registered to
 	# funcID = the function ID returned by the register function of the function to deregister.
 	def deregister(self, name, funcID):
-		try:
-			rval = self.callbacks[name][funcID]
-			del (self.callbacks[name])[funcID]
-		except KeyError as E:
-			rval = None
-			logger.log("No function registered", name + ":" + str(funcID), logger.WARNING)
-			raise
-
+		with self.registryLock:
+			try:
+				rval = self.callbacks[name][funcID]
+				del (self.callbacks[name])[funcID]
+			except KeyError as E:
+				rval = None
+				logger.log("No function registered", name + ":" + str(funcID), logger.WARNING)
+				raise
+			self.buildRoutes()
 		return rval
+
+	# function PropCom.buildRoutes() Rebuild the dispatch table PropCom.call uses from the callbacks table. Called on every register and deregister.
+	# routes[nameNum] = (callbacks for every packet, {channel index: callbacks for that channel}, index shift), or None if nothing is registered.
+	# Callbacks are (test, func) pairs in the order they were registered. The table is replaced whole, never changed in place.
+	def buildRoutes(self):
+		routes = [None] * len(keyTable)
+		for nameNum in range(len(keyTable)):
+			name = keyTable[nameNum]
+			entries = self.callbacks.get(name)
+			if not entries:
+				continue
+			every = []
+			byIndex = dict()
+			for ID in sorted(entries):
+				test, func, index = entries[ID]
+				if index is None:
+					every.append((test, func))
+				else:
+					byIndex.setdefault(index, []).append((test, func))
+			routes[nameNum] = (tuple(every), dict([(i, tuple(f)) for i, f in byIndex.items()]), channelKeys.get(name, 0))
+		self.routes = routes
 	# open COM port for this prop. used to find prop waiting on ports
 	# function PropCom.open( String port ) Opens tyhe specified serial port for reading and writing. If no port is specified, the first available port that responds is opened.
 	# port = A string representation of the port to open. on windows it might look like "COM3"
+	# If the replay_file option is set, that capture file is played back instead, at replay_speed times the recorded pace (0 for as fast as possible).
 
 	def open(self, port=None):
+		self.openTime = time.time()
+		self.logStartup()
+		if logger.options.get("replay_file", ""):
+			self.openReplay(logger.options["replay_file"], logger.options.get("replay_speed", 1))
+			return
 		self.com.baudrate = logger.options["baud"]
-		def openPort(self, port):
+		if port is None:
+			self.openFirstProp(PropCom.openPort) # opens the first com port
+		else:
+			self.openPort(port)
+
+	# function PropCom.openPort( String port, Bool restore ) return Bool True if *port* was opened
+	# restore = wait for the device to answer a version request, then send it the settings it had before the port was lost, all before the read loop starts.
+	# Otherwise the version handshake runs on its own thread.
+	def openPort(self, port, restore=False):
+		try:
+			self.com.port = port
+			self.com.open()
+			logger.log("Opened port",self.com.port,logger.INFO)
+			self.comOpen = True
+			self.firstSyncTime = time.time() #sync packets should start accumulating as soon as we open the port
+		except Exception as e:
+			self.comOpen = False
+			logger.log("openPort Failed",e,logger.ERROR)
+			return False
+		deadline = time.time() + logger.options.get("handshake_timeout", 5.0)
+		if restore:
 			try:
-				self.com.port = port
-				self.com.open()
-				logger.log("Opened port",self.com.port,logger.INFO)
-				self.comOpen = True
-				self.firstSyncTime = time.time() #sync packets should start accumulating as soon as we open the port
-			except Exception as e:
+				version = self.pollVersion(self.com, deadline)
+			except (serial.serialutil.SerialException, ValueError, OSError) as err:
+				version = None
+			if version is None:
+				logger.log("No answer to version", port, logger.WARNING)
 				self.comOpen = False
-				logger.log("openPort Failed",e,logger.ERROR)
-			time.sleep(3)
-			self.send("version") # start the dialog
+				self.com.close()
+				return False
+			self.reopened()
+		self.handshake(deadline) # start the dialog
+		return True
+
+	# function PropCom.reconnect() return Bool True once the device is open again after the port failed under the read loop.
+	# Searches for [com] reconnect_timeout seconds, the known port first. Nothing is asked of the user. Not done when replaying a capture or when auto_reconnect is off.
+	def reconnect(self):
+		self.lost = False
+		if logger.options.get("replay_file", "") or not logger.options.get("auto_reconnect", True):
+			return False
+		logger.log("Reconnecting", self.com.port, logger.WARNING)
+		started = time.time()
+		deadline = started + logger.options.get("reconnect_timeout", 30)
+		while time.time() < deadline and not self.closing:
+			port = self.findKnownProp()
+			if port is None:
+				port = self.findProp([p[0] for p in serial.tools.list_ports.comports()], logger.options["timeout"])
+			if port is not None and self.openPort(port, True):
+				logger.log("Reconnected", "%s after %.2f seconds" % (port, time.time() - started), logger.INFO)
+				return True
+			time.sleep(logger.options.get("probe_interval", 0.25))
+		logger.log("Could not reconnect", self.com.port, logger.ERROR)
+		return False
+
+	# function PropCom.dropPort() Close a port that failed under the read loop, so that PropCom.run reconnects. Does nothing if the port was already closed.
+	def dropPort(self):
+		if not self.comOpen or self.closing:
 			return
-
-		if port is None:
-			self.openFirstProp(openPort) # opens the first com port
-		else:
-			openPort(self,port)
+		self.comOpen = False
+		self.lost = True
+		self.stopWriter()
+		try:
+			self.com.close()
+		except Exception:
+			pass
+
+	# function PropCom.reopened() Called by openPort once a reconnected device has answered, before the read loop starts again.
+	def reopened(self):
+		self.restoreState()
+
+	# function PropCom.remember( String|Int key, Int|[Int] value ) Keep track of the settings sent to the device: the avg, the digital directions, each channel's set value and the started channels.
+	def remember(self, key, value):
+		if key == "avg" or key == "dir":
+			self.settings[(key,)] = value
+		elif key == "set":
+			ckey = outbound.coalesceKey(key, value)
+			if ckey is not None:
+				self.settings[ckey] = list(value)
+		elif key == "start":
+			self.startMask |= value or 0
+		elif key == "stop":
+			if value:
+				self.startMask &= ~value
+			else:
+				self.startMask = 0
+
+	# function PropCom.restoreState() return outbound.SendFuture|outbound.FutureGroup Send the device every setting remembered, in one write: avg, digital directions, set values, then start.
+	def restoreState(self):
+		messages = []
+		for ckey in [("avg",), ("dir",)]:
+			if ckey in self.settings:
+				messages.append((ckey[0], self.settings[ckey]))
+		for ckey, value in sorted(self.settings.items()):
+			if ckey[0] == "set":
+				messages.append(("set", value))
+		if self.startMask:
+			messages.append(("start", self.startMask))
+		if self.writer is not None:
+			self.writer.forget()
+		if not messages:
+			return outbound.SendFuture(1)
+		logger.log("Restoring device settings", len(messages), logger.INFO)
+		return self.sendMany(messages)
+	# function PropCom.handshake( Float deadline ) Send version every probe_interval seconds, on a new thread, until the device answers or the time *deadline* passes.
+	# Replaces a fixed wait for the device to boot after the port opens.
+	def handshake(self, deadline):
+		answered = threading.Event()
+		def onVersion(propCom, *ver):
+			if ver:
+				self.firmwareVersion = ver[0]
+			answered.set()
+			return 0
+		ID = self.register("version", onVersion)
+		def run():
+			interval = logger.options.get("probe_interval", 0.25)
+			while not answered.isSet() and time.time() < deadline and self.isOpen():
+				self.send("version")
+				answered.wait(interval)
+			try:
+				self.deregister("version", ID)
+			except KeyError:
+				pass
+			if not answered.isSet():
+				logger.log("No answer to version", self.com.port, logger.WARNING)
+			else:
+				self.saveDevice()
+		t = threading.Thread(target=run, name="Handshake")
+		t.daemon = True
+		t.start()
+
+	# function PropCom.saveDevice() Remember the open port, its USB identity and the firmware version in the [com] state_file, so the next search tries it first.
+	def saveDevice(self):
+		fname = logger.options.get("state_file", "")
+		if not fname:
+			return
+		device = devicestate.portInfo(self.com.port)
+		device["version"] = self.firmwareVersion
+		devicestate.save(fname, device)
+
+	# function PropCom.logStartup() Log the time from PropCom.open to the first info packet, once.
+	def logStartup(self):
+		logged = []
+		def onInfo(propCom, *val):
+			if logged:
+				return 0
+			logged.append(True)
+			try:
+				self.deregister("info", ID)
+			except KeyError:
+				pass
+			self.startupTime = time.time() - self.openTime
+			logger.log("First info packet", "%.2f seconds after open" % self.startupTime, logger.INFO)
+			return 0
+		ID = self.register("info", onInfo)
+
+	# function PropCom.openReplay( String fname, Float speed ) Use a capture.ReplaySerial playing *fname* in place of the serial port.
+	def openReplay(self, fname, speed=1):
+		try:
+			self.com = capture.ReplaySerial(fname, speed)
+			self.com.open()
+			logger.log("Replaying",fname,logger.INFO)
+			self.comOpen = True
+			self.firstSyncTime = time.time()
+		except IOError as e:
+			self.comOpen = False
+			logger.log("openReplay Failed",e,logger.ERROR)
 	# function PropCom.isOpen() return Bool True if a serial port is open, False otherwise.
 	def isOpen(self):
 		return self.comOpen
 	# function PropCom.close() Close the currently active serial port and stop any channels
 	def close(self):
-		comOpen = False
-		self.send("stop",0) # stops all channels.
+		self.closing = True
+		self.send("stop",0).wait(1.0) # stops all channels. Wait for the writer to get it out before the port closes.
+		self.stopWriter()
+		self.comOpen = False
+		with self.requestLock:
+			waiting = set(self.requests.values())
+			self.requests.clear()
+		for req in waiting:
+			req.set(None)
+		if self.isAlive() and threading.currentThread() is not self:
+			self.join(logger.options.get("read_timeout", 0.1) * 2) # let a bulk read notice, rather than closing the port under it
+		self.stopDispatchers()
 		self.com.close()
 		# kill locks. 
-		for idx,t in self.locks.iteritems():
+		for idx,t in self.locks.items():
 			t.cancel()
-			del self.locks[idx]
+		self.locks.clear()
 
 
-	# function PropCom.send( String|Int key, String value) return Int 1 if successful. -1 on most errors.
+	# function PropCom.send( String|Int key, String value) return outbound.SendFuture completed with 1 once written, -1 on most errors.
 	# Send a control packet to the device using the currently active serial port.
+	# While the writer thread runs, the packet is queued and the call returns right away. A queued set or avg can be replaced by a newer one, see outbound.py.
 	# key = A byte representing the message type. if a String is passed, a dictionary is used to convert into an int. All message types are listed in the firmware wiki section.
-	def send(self, key, value=None ):
+	# msgID = the message ID to send it with. By default the next one is taken when the packet is encoded.
+	# dedupe = True if the writer may skip it when it is the same as the last set or avg written, within send_dedupe_window seconds. Off by default, so a resend always goes out.
+	def send(self, key, value=None, msgID=None, dedupe=False):
 		""" sends a control packet with a message ID that corresponds to the string value 'key', with parameters specified in value.
 			key is a string that represents the message ID, or and int specifing the message ID.
 			value is either an integer, or a list of integers."""
@@ -396,224 +891,199 @@ class PropCom(threading.Thread):
 
 		if self.com is None or self.isOpen() == False:
 			logger.log("send on bad port", key, logger.WARNING)
-			return -1
-	
+			return outbound.SendFuture(-1)
+		self.remember(key, value)
+		outbox = self.outbox
+		if outbox is not None:
+			return outbox.put(key, value, msgID, dedupe)
+		msg = self.encode(key, value, msgID)
+		if msg is None:
+			return outbound.SendFuture(-1)
+		return outbound.SendFuture(self.sendRaw(msg))
+
+	# function PropCom.sendMany( [(String|Int key, Int|[Int] value)] messages ) return outbound.FutureGroup|SendFuture completed with 1 once all are written, -1 on most errors.
+	# Send several control packets with a single write, in order. Each message is a tuple like the arguments of PropCom.send. The value and message ID can be left out.
+	# Without the writer thread, nothing is sent if any message cannot be encoded.
+	def sendMany(self, messages):
+		if self.com is None or self.isOpen() == False:
+			logger.log("send on bad port", [m[0] for m in messages], logger.WARNING)
+			return outbound.SendFuture(-1)
+		for m in messages:
+			self.remember(m[0], m[1] if len(m) > 1 else None)
+		outbox = self.outbox
+		if outbox is not None:
+			return outbound.FutureGroup([outbox.put(m[0], m[1] if len(m) > 1 else None, m[2] if len(m) > 2 else None) for m in messages])
+		msgs = []
+		for m in messages:
+			msg = self.encode(m[0], m[1] if len(m) > 1 else None, m[2] if len(m) > 2 else None)
+			if msg is None:
+				return outbound.SendFuture(-1)
+			msgs.append(msg)
+		return outbound.SendFuture(self.sendRaw("".join(msgs)))
+
+	# function PropCom.encode( String|Int key, Int|[Int] value, Int msgID ) return String the control packet as it goes on the wire, or None if *key* is not valid.
+	# Takes the next message ID, unless *msgID* is given.
+	def encode(self, key, value=None, msgID=None):
 		if key is None:
 			logger.log("send NoneType key", key, logger.WARNING)
-			return -1
-
+			return None
+		if msgID is None:
+			msgID = self.nextMsgID()
 		try:
-			msg = chr(key) + chr(self.nextMsgID())
-		except TypeError: # key is not an int. treat as string.			
-			if key not in keyTable and key :
-				logger.log("Attempting invalid control msg ID", key, logger.WARNING)
-				return -1
-			msg = chr(keyTable.index(key)) + chr(self.nextMsgID())
-
-		if value is not None:
-			try:
-				for v in value:
-					for n in range(4):
-						msg += chr( (v>>24-n*8)&255 )
-			except TypeError: # value is not a list. treat as int.
-				for n in range(4):
-					msg += chr( (int(value)>>24-n*8)&255 )
-		msg = msg.replace(ESC, ESC+ESC)
-		msg = msg.replace(EOP, ESC+EOP)
-		chksum = 0
-		for c in msg:
-			chksum = ((chksum<<1) | (chksum>>7)) & 255 # left-rotate
-			chksum = (chksum + ord(c)) % 256           # 8-bit addition
-		msg = msg + EOP + chr(chksum)
-		if logger.options["log_sent"]:
+			msg = encoder.encode(key, msgID, value)
+		except KeyError:
+			logger.log("Attempting invalid control msg ID", key, logger.WARNING)
+			return None
+		if logger.logSent:
 			logger.log( "sending ", str(key) + " " + str(value), logger.INFO)
 			logger.log( "	raw: ", msg.replace("\a","@"), logger.INFO)
-		self.comlock.acquire(True)	#block until lock taken	
-		try:
-			retv = self.com.write(msg)
-		except (serial.serialutil.portNotOpenError, ValueError, serial.serialutil.SerialTimeoutException) as err:
-			logger.log("Writing to closed port", err, logger.WARNING)
-			return -1
-		except serial.SerialException as err:
-			logger.log("SerialException on write", err, logger.WARNING)
-			return -1
-		self.comlock.release()
+		return msg
+
+	# function PropCom.query( Int idx ) return outbound.Request completed with the words of the info packet answering a query of channel *idx*.
+	def query(self, idx):
+		return self.request(outbound.Request("query", idx, "info", idx))
+
+	# function PropCom.request( outbound.Request req ) return outbound.Request *req*, sent. See PropCom.requestMany.
+	def request(self, req):
+		self.requestMany([req])
+		return req
+
+	# function PropCom.requestMany( [outbound.Request] requests ) return outbound.RequestGroup Send every request in one write, each with its own message ID.
+	# An answer is matched to its request by the message ID the device echoes, so any number can be in flight.
+	# Unanswered requests are sent again after [com] request_timeout seconds, at most request_retries times, then completed with None.
+	# Registered callbacks still run for every answer.
+	def requestMany(self, requests):
+		now = time.time()
+		messages = []
+		with self.requestLock:
+			for req in requests:
+				msgID = self.nextMsgID()
+				old = self.requests.pop(msgID, None)	# IDs wrap after 255 packets. The old request will be retried under a new one.
+				if old is not None and msgID in old.msgIDs:
+					old.msgIDs.remove(msgID)
+				self.requests[msgID] = req
+				req.msgIDs.append(msgID)
+				req.sentTime = now
+				req.attempts += 1
+				messages.append((req.key, req.value, msgID))
+		if self.sendMany(messages).wait(0) == -1:	# written synchronously and failed, or the port is closed
+			self.expireRequests(requests, True)
+			return outbound.RequestGroup(requests)
+		t = threading.Timer(logger.options.get("request_timeout", 0.5), self.expireRequests, (requests,))
+		t.daemon = True
+		t.start()
+		return outbound.RequestGroup(requests)
+
+	# function PropCom.expireRequests( [outbound.Request] requests, Bool final ) Send the unanswered *requests* again, or complete them with None once out of retries.
+	def expireRequests(self, requests, final=False):
+		retry = []
+		for req in requests:
+			if req.done():
+				continue
+			if not final and self.isOpen() and req.attempts <= logger.options.get("request_retries", 2):
+				self.metrics.requestRetries += 1
+				retry.append(req)
+				continue
+			with self.requestLock:
+				for msgID in req.msgIDs:
+					if self.requests.get(msgID) is req:
+						del self.requests[msgID]
+			self.metrics.requestTimeouts += 1
+			logger.log("No answer to", str(req.key) + " " + str(req.value), logger.WARNING)
+			req.set(None)
+		if retry:
+			self.requestMany(retry)
+
+	# function PropCom.answerRequest( Int msgID, Int nameNum, [Int] val ) Complete the request waiting on message ID *msgID*, if this packet answers it.
+	def answerRequest(self, msgID, nameNum, val):
+		name = keyTable[nameNum] if nameNum < len(keyTable) else None
+		with self.requestLock:
+			req = self.requests.get(msgID)
+			if req is None or not req.matches(name, val):
+				return
+			for ID in req.msgIDs:
+				if self.requests.get(ID) is req:
+					del self.requests[ID]
+		req.set(val)
+		self.metrics.roundTrip(name, req.rtt)
+
+	# function PropCom.sendRaw( String msg ) return Int 1 if successful. -1 on most errors.
+	# Write already encoded packets to the serial port in one call. comlock is released however the write ends.
+	def sendRaw(self, msg):
+		with self.comlock:
+			try:
+				self.com.write(msg)
+			except (ValueError, serial.serialutil.SerialTimeoutException) as err:
+				logger.log("Writing to closed port", err, logger.WARNING)
+				return -1
+			except serial.SerialException as err:
+				logger.log("SerialException on write", err, logger.WARNING)
+				return -1
 		return 1 
 
 		# parse all the keys in "resp". 
-	# function PropCom.parse ( String ) return String any unused characters leftover after parsing all packets.
-	# Parse the given String for any packets. For any control packets, parseControl is called, for stream packets, parseStream is called.
-	def parse(self, msgBuffer ):
-	  global DBG1
- 	  DBG1=""
-	  #find last EOP
-	  n = 0
-	  end = 0
-	  
-	  while not end == -1:
-	    n = 0
-	    escaped = 0
-	    chksum = 0
-	    chk = 0
-	    state = 0
-	    packet = ""
-	    end = -1
-	    
-	    while end == -1:
-	      if n == len(msgBuffer):
-		end = -1
-		DBG1+="X"
-		break
-	      c = msgBuffer[n]
-	      n+=1
-	      if state == 0: # finding first EOP
-		if not escaped and c == EOP:
-		  state = 1
-		  DBG1+="{"
-		else:
-		  DBG1+="-"
-	      elif state == 1: # checksum of last packet. useless.
-		DBG1+="$("+str(ord(c))+")"
-		chksum=0
-		state = 2
-	      elif state == 2: # collect packet data
-		if not escaped and c == EOP:
-		  DBG1+="}"
-		  state = 3 #collect checksum
-		elif escaped or (not c==ESC and not c==EOP):
-		  packet+=c
-		  DBG1+=c.replace("\a","@")
-		  DBG1+="("+str(ord(c))+")"
-		  DBG1+="."
-		  chksum = ((chksum<<1) | (chksum>>7)) & 255 # left-rotate
-		  chksum = (chksum + ord(c)) & 255           # 8-bit addition
-	         
-	        if c==ESC and not escaped:
-		  DBG1+="/"
-	  	  escaped = 1
-		  chksum = ((chksum<<1) | (chksum>>7)) & 255 # left-rotate
-		  chksum = (chksum + ord(c)) &255            # 8-bit addition
-	        else:
-		  escaped = 0 
-	      elif state == 3: # storing checksum
-		chk = ord(c)
-		state = 2
-		DBG1+="#"
-		DBG1+="("+str(ord(c))+")"
-		end = n
-	    if logger.options["log_parsing"]:
-		    logger.write("parsed:[[" + DBG1.replace("\n","@").replace("\r","@") + "]]")
-		
-	    if end==-1:       
-		    pass # no packets found.
-	    else:
-	      msgBuffer = msgBuffer[n-2:]
-	      
-	      if len(packet) < 1:         
-	        logger.log( "Bad Packet","No bytes!", logger.WARNING)
-	      elif  chk != chksum and chk!=0 and not logger.options["ignore_checksum"]:
-		      if logger.options["log_bad_checksum"]:
-			logger.write( "BAD CHECKSUM!")
+	# function PropCom.parse( String data, [Framer framer] ) return String always empty. Partial packets are kept by the framer between calls.
+	# Feed *data* to the packet framer. For every complete packet, parseStream or parseControl is called.
+	# framer = the framing.Framer to use. Defaults to this PropCom's own framer, which follows the stream read by PropCom.run.
+	def parse(self, data, framer=None):
+		if framer is None:
+			framer = self.framer
+		self.dispatch(framer.feed(data))
+		return ""
+
+	# function PropCom.dispatch( [String] packets ) Hand each framed packet to parseStream or parseControl.
+	# Packets can be strings or memoryviews into the receive ring.
+	def dispatch(self, packets):
+		metrics = self.metrics
+		logMsg = logger.logMsg
+		for packet in packets:
 			if ord(packet[0]) & 128:
-				logger.write("BAD CHECKSUM! (stream)")
+				metrics.streamPackets += 1
+				metrics.streamBytes += len(packet)
+				self.parseStream(packet)
 			else:
-				logger.write("BAD CHECKSUM! (control)")
-			logger.write( "sent:"+str(chk)+" calculated:"+str(chksum))
-			if logger.options["debug_checksum"]:
-				logger.write(DBG1)
-	      else:
-	        if ord(packet[0]) & 128:
-	          self.parseStream(packet)
-	        else:
-		  if logger.options["log_msg"]:
-	            logger.log("found",packet.replace("\a","@"),logger.INFO)
-	          self.parseControl(packet)
-	    
-	  return msgBuffer
-	  
-  	# function PropCom.parseStream( string ) parses a single stream packet, and notifies any listeners registered to it.
+				metrics.controlPackets += 1
+				metrics.controlBytes += len(packet)
+				if logMsg:
+					logger.log("found",bytes(bytearray(packet)).replace("\a","@"),logger.INFO)
+				self.parseControl(packet)
+
+  	# function PropCom.parseStream( String ) parses a single stream packet, and notifies any listeners registered to it.
+	# The packet is unpacked by streamdecode.decode. Listeners get the same value list as before: rate, first timestamp, samples, last timestamp.
 	def parseStream(self, packet):
 		''' parses a stream packet and passes parsed values to any registered stream listener objects'''
-		c = ord(packet[0])
-		streamID = (ord(packet[0])>>4) & 7
-		if logger.options["log_stream"]:
+		streamID, head, samples, tail = streamdecode.decode(packet)
+		values = head + samples.tolist() + tail
+		if logger.logStream:
 			logger.log("Stream ["+str(streamID)+"]","",logger.INFO)
-
-		values = []
-		val = 0
-		valBits=32 # bits left to read for the current val
-		byteBits=4 # bits left in the current byte
-		packet = chr(ord(packet[0])&15) + packet[1:]
-		bytesLeft = len(packet) # bytes left in packet
-
-		n=0
-
-		for c in packet:
-			c=ord(c)
-			while byteBits>0:
-				if valBits >= byteBits: # read in byteBits amount of bits
-					val = (val<<byteBits) | c
-					valBits -= byteBits
-					byteBits = 0
-				else: 			# read in valBits amount of bits, remaining bits left in c.
-					val = (val<<valBits) | (c>>(byteBits-valBits))
-					byteBits -= valBits
-					c = c & (~(255<<valBits))
-					valBits = 0
-				if valBits <= 0:
-					values.append(val)
-					n+=1
-					if logger.options["log_stream"]:
-						logger.write( "   :" + str(val),True)
-					val = 0
-					if n<=1:
-						valBits = 32
-					elif bytesLeft <= 5:
-						valBits = 32
-					else:
-						valBits = 12
-			byteBits = 8 # prepare for next byte
-			bytesLeft -= 1
+			logger.write( "   :" + "   :".join([str(v) for v in values]))
 		self.callStream(streamID, values)
 
 	  
 	# function PropCom.parseControl( String ) Parse a single control packet and call any registered functions associated with the packets message type.
 	# If the packet contains any data aside from the message type, it is divided into 4byte Ints and sent as parameters to registered functions.
+	# The packet can be any buffer, including a memoryview into the receive ring.
 	def parseControl(self, packet):
-	  '''parses a control packet and calls any registered hooks for the packet's message ID type.'''
-	  curVal = 0 
-	  state = 0
-	  nameNum = -1
-	  n = 0
-	  m = 0
-	  exData = []
-	 
-	  while not n == len(packet):  
-	    
-	    c = packet[n]
-	    n+=1      
-	    if state == 0: #first byte: the message ID#
-		nameNum = ord(c)
-		state = 1
-		
-	    elif state == 1: #second byte: packet #
-		self.lastPkt = ord(c)  
-		state = 2
-	    elif state == 2: #collect packet data
-		curVal = curVal << 8
-		curVal += ord(c)
-		m += 1
-		if m==4:
-		  exData.append(curVal)
-		  curVal = 0
-		  m = 0
-          if nameNum != 13 and logger.options["log_control"]: # ignore point messages in coltrol log
-	    logger.write("::" + str(nameNum) + "-" + str(self.lastPkt) + " = ",True)
-	    for v in exData:
-	      logger.write(v,True)
-	    logger.write(" ")
-	  self.call(nameNum, exData)
-	  return  
+		'''parses a control packet and calls any registered hooks for the packet's message ID type.'''
+		n = len(packet)
+		msgID = None
+		if n >= 2:
+			nameNum, msgID = struct.unpack_from("BB", packet)
+			self.lastPkt = msgID
+		else:
+			nameNum = struct.unpack_from("B", packet)[0]
+		if n >= 6:
+			exData = list(struct.unpack_from(">%dI" % ((n - 2) >> 2), packet, 2))
+		else:
+			exData = []
+		if self.requests and msgID in self.requests:
+			self.answerRequest(msgID, nameNum, exData)
+		if nameNum != 13 and logger.logControl: # ignore point messages in coltrol log
+			logger.write("::" + str(nameNum) + "-" + str(self.lastPkt) + " = ",True)
+			for v in exData:
+				logger.write(v,True)
+			logger.write(" ")
+		self.call(nameNum, exData)
 
 
 
@@ -621,24 +1091,39 @@ class PropCom(threading.Thread):
   	# function PropCom.call( Int nameNum, List val ) Calls any functions associated with the given message type ID with each element in val passed as parameters.
 	# nameNum = the message type ID of the packet
 	# val = list of 4byte words found in the control packet.
+	# Callbacks registered for a channel index get only the packets about that channel, looked up in PropCom.routes. Then every other callback for the message type is called.
 	def call(self, nameNum, val=None):
-		global DBG1
-		if nameNum<len(keyTable):
-			name = keyTable[nameNum]
-			if name in self.callbacks:
-				for key, func in self.callbacks[name].items():
-					try:
-						if val is None or len(val)==0:
-							if func[0] is None or func[0](self): #test validator
-								func[1](self)
-						elif func[0] is None or func[0](self, *val): #test validator
-							func[1](self, *val)
-					except Exception as e:
-						dbugkey = name
-						logger.log( "failed call -{ " + str(dbugkey) + " }- " , str(e), logger.INFO)
-						logger.log( " debug",DBG1,logger.INFO)
-		else:
+		try:
+			route = self.routes[nameNum]
+		except IndexError:
+			self.metrics.unknownIDs += 1
 			logger.log("bad control ID", nameNum, logger.WARNING)
+			return
+		if route is None:
+			return
+		every, byIndex, shift = route
+		if val:
+			args = (self,) + tuple(val)
+			if byIndex:
+				funcs = byIndex.get(val[0] >> shift)
+				if funcs is not None:
+					self.callEach(nameNum, funcs, args)
+		else:
+			args = (self,)
+		if every:
+			self.callEach(nameNum, every, args)
+
+	# function PropCom.callEach( Int nameNum, [(Function test, Function func)] funcs, Tuple args ) Call each func whose test passes with *args*, the PropCom followed by the packet's words.
+	def callEach(self, nameNum, funcs, args):
+		for test, func in funcs:
+			try:
+				if test is None or test(*args): #test validator
+					func(*args)
+			except Exception as e:
+				self.metrics.callbackError(keyTable[nameNum], func)
+				logger.log( "failed call -{ " + keyTable[nameNum] + " }- " , str(e), logger.INFO)
+				if self.framer.lastTrace is not None:
+					logger.log( " debug",self.framer.lastTrace,logger.INFO)
 	# function PropCom.callStream(Int streamID, List values) Notifies any StreamListener objects about the incoming data. 
 	# StreamListener calls are given a reference to this PropCom object.
 	# streamID = The ID of the stream
@@ -648,74 +1133,106 @@ class PropCom(threading.Thread):
 			logger.log("Bad stream. StreamID too high!?", streamID, logger.ERROR)
 			raise Exception("StreamID Too High!")
 
-		for f in self.listeners[streamID].copy():
+		for f in self.listeners[streamID]:
 			try:
 				f(self, values)
 			except Exception as e:
+				self.metrics.callbackError("stream[" + str(streamID) + "]", f)
 				logger.log( "failed call -{ " + "stream[" + str(streamID) + "] }- ", e, logger.INFO)
 
 	# PropCom.openFirstProp( Function openFunc ) Open the first serial port that responds to a version request.
 	# When a serial port responds to a version control packet, the given function *openFunc* is called.
 	# openFunc can be used to open the port.
-	# openFirstProp opens all available ports and sends a version request control packet. After a small wait time specified by the global variable *DEFAULTTIMEOUT* the port is closed again.
-	# after the port is closed, any response is parsed using PropCom.parse and if a valid response was recieved, openFunc is called.
+	# The port the device was last found on is tried first, see PropCom.findKnownProp.
+	# Otherwise every available port is probed at once by PropCom.findProp. The first one to answer is closed again and passed to openFunc.
+	# If none answers, the user is asked whether to retry.
 	# openFunc = A function that takes 2 parameters, a PropCom object and a String representing the port
 	def openFirstProp(self, openFunc):
-		# store old version callback.
-		if "version" in self.callbacks:
-			oldVerCallback = self.callbacks["version"]
-		else:	
-			oldVerCallback = None
-		del self.callbacks["version"]
-		opened = [False]	# whether or not a valid port has been opened. 
 		retry = True		# whether or not function will retry opening
-		com = serial.Serial()
-		com.baudrate = self.com.baudrate
-
-
-		while opened[0] == False and retry == True:
-			# cycle through all available ports sending <version>, and waiting for response.
-			ports = serial.tools.list_ports.comports()
-			for p in ports:
-				logger.log("Testing port",p[0], logger.INFO)
-				com.port = p[0]
-				ID = 0
-				try:
-					com.open()
-
-					def verHandler(propCom,  ver):
-						logger.log("Response on port",com.port,logger.INFO)
-						if opened[0] == False:
-							opened[0] = True
-							com.close()	#make sure com is closed first
-							openFunc(propCom, com.port)	#open new port
-						return 0
-					ID = self.register("version",verHandler)
-				
-					verStr = chr(3) + chr(1) + EOP + chr(7)
-					self.comlock.acquire(True)	#block until lock taken	
+		while retry:
+			port = self.findKnownProp()
+			if port is None:
+				ports = [p[0] for p in serial.tools.list_ports.comports()]
+				port = self.findProp(ports, logger.options["timeout"])
+			if port is not None:
+				openFunc(self, port)	#open new port
+				return
+			retry = logger.ask("No Propeller detected. retry?", logger.QUESTION)
+
+	# function PropCom.findProp( [String] ports, Float timeout ) return String|None the first of *ports* to answer a version request within *timeout* seconds.
+	# Each port is probed on its own thread. A probe sends version every probe_interval seconds until it gets a version packet back,
+	# another probe has succeeded, or time runs out. Every probe port is closed again before this returns.
+	def findProp(self, ports, timeout=2.0):
+		found = []
+		done = threading.Event()
+		lock = threading.Lock()
+		deadline = time.time() + timeout
+
+		def probe(port):
+			com = serial.Serial()
+			com.baudrate = self.com.baudrate
+			com.port = port
+			try:
+				com.open()
+				if self.pollVersion(com, deadline, done) is not None:
+					with lock:
+						if not found:
+							found.append(port)
+							logger.log("Response on port",port,logger.INFO)
+					done.set()
+			except (serial.serialutil.SerialException, ValueError, OSError) as err:
+				logger.log("Error with port", port, logger.WARNING)
+			finally:
+				com.close() # make sure to close com port.
+
+		threads = []
+		for port in ports:
+			logger.log("Testing port",port, logger.INFO)
+			t = threading.Thread(target=probe, args=(port,), name="Probe-" + str(port))
+			t.daemon = True
+			t.start()
+			threads.append(t)
+		for t in threads:
+			t.join(max(deadline - time.time(), 0) + 1.0)
+		if found:
+			return found[0]
+		return None
+
+	# function PropCom.findKnownProp() return String|None the port the device was last found on, if it is there and answers a version request.
+	# The port is picked by USB serial number, vid and pid, or name, see devicestate.findPort. It is given [com] verify_timeout seconds to answer.
+	def findKnownProp(self):
+		fname = logger.options.get("state_file", "")
+		if not fname:
+			return None
+		port = devicestate.findPort(devicestate.load(fname), serial.tools.list_ports.comports())
+		if port is None:
+			return None
+		logger.log("Trying known port", port, logger.INFO)
+		return self.findProp([port], logger.options.get("verify_timeout", 2.0))
+
+	# function PropCom.pollVersion( serial.Serial com, Float deadline, threading.Event done ) return Int|None the version number the device on the open port *com* answers with.
+	# Sends version every probe_interval seconds until a version packet comes back, *done* is set, or the time *deadline* passes. Everything else read is dropped.
+	def pollVersion(self, com, deadline, done=None):
+		interval = logger.options.get("probe_interval", 0.25)
+		verStr = encoder.encode("version", 1)
+		versionNum = keyTable.index("version")
+		framer = framing.Framer()
+		timeout = com.timeout
+		com.timeout = 0.05
+		try:
+			nextSend = 0
+			while (done is None or not done.isSet()) and time.time() < deadline:
+				if time.time() >= nextSend:
 					com.write(verStr)
-					self.comlock.release()		#release comlock for others!	
-
-					time.sleep(logger.options["timeout"])
-					resp = com.read(com.inWaiting())
-					if logger.options["log_parsing"]:
-						logger.write(resp)
-					parsed = self.parse(EOP + " " + resp)
-				except (serial.serialutil.SerialException, ValueError, serial.serialutil.SerialTimeoutException) as err: 
-					logger.log("Error with port", com.port, logger.WARNING)
-					com.close()
-				finally:
-					com.close() # make sure to close com port. 
-					try:	# catch exceptions from invalid ID
-						self.deregister("version",ID)
-					except KeyError:
-						logger.log("Can't Deregister version handler","ID does not exist", logger.WARNING)
-					time.sleep(0.1)
-			if opened[0] == False:
-				retry = logger.ask("No Propeller detected. retry?", logger.QUESTION)
-		
-		if oldVerCallback is not None:
-			self.callbacks["version"] = oldVerCallback
-		else:
-			del self.callbacks["version"] 
+					nextSend = time.time() + interval
+				resp = com.read(max(com.inWaiting(), 1))
+				if logger.logParsing and resp:
+					logger.write(resp)
+				for packet in framer.feed(resp):
+					if ord(packet[0]) == versionNum:
+						if len(packet) >= 6:
+							return struct.unpack_from(">I", packet, 2)[0]
+						return 0
+			return None
+		finally:
+			com.timeout = timeout
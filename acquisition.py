@@ -0,0 +1,310 @@
+import ctypes
+import heapq
+import multiprocessing
+import struct
+import threading
+import time
+import Queue
+from multiprocessing import sharedctypes
+
+import numpy
+
+import logger
+import streamdecode
+import Propeller
+
+# acquisition.py Runs the serial side of PropCom in a separate process, so that acquisition gets its own core and GIL.
+# The acquisition process opens the port, reads, frames and decodes. Samples from each stream are published into a
+# SharedRing per stream. Control packets, and the messages sent to the device, travel over a multiprocessing Pipe.
+# In the GUI process a RemotePropCom stands in for PropCom, so Device, Channel and plugins work unchanged.
+# Every packet gets a sequence number in the acquisition process, and the GUI process handles them in that order.
+#
+# Messages from the GUI process:
+#	("write", String bytes)		write raw bytes to the serial port
+#	("answer", Bool)		the answer to an "ask"
+#	("close",)			close the port and end the process
+#	("flight", String, Bool dump)	PropCom.flightEvent on the acquisition process's flight recorder, which records the packets
+#	("dump", String fname, String reason)	write the flight recorder to a file
+# Messages from the acquisition process:
+#	("opened", String port)		the port is open
+#	("packet", Int seq, String)	a control packet
+#	("sync", Int tStamp, Float arrived)	the host time a sync packet was read, sent just before its "packet". See PropCom.syncArrival.
+#	("ask", String, Int mode)	logger.ask on behalf of the acquisition process. Must be answered.
+#	("message", String, Int mode)	logger.message on behalf of the acquisition process
+#	("closed",)			the port was closed, the process is ending
+
+NSTREAMS = 8
+GAP_TIMEOUT = 0.05	# seconds to wait for a missing sequence number before assuming it was lost in a ring overrun
+
+# class SharedRing A single-writer, single-reader ring of 32-bit words in shared memory.
+# A record is [length, seq, nHead, nTail, head..., tail..., samples...] where length counts every word of the record.
+# The writer only ever advances *head*. The reader keeps its own position and notices when it has been lapped.
+class SharedRing():
+	overruns = 0	# times the reader fell a whole ring behind and skipped ahead
+
+	# constructor SharedRing( Int words ) return SharedRing a ring of *words* words. Must be created before the acquisition process starts.
+	def __init__(self, words):
+		self.words = int(words)
+		self.data = sharedctypes.RawArray(ctypes.c_uint32, self.words)
+		self.head = sharedctypes.RawValue(ctypes.c_uint64, 0)	# words ever written
+		self.tail = 0		# words ever read, reader side only
+		self.overruns = 0
+		self.array = None
+
+	# function SharedRing.view() return numpy.uint32[] the shared words, without copying
+	def view(self):
+		if self.array is None:
+			self.array = numpy.frombuffer(self.data, numpy.uint32)
+		return self.array
+
+	# function SharedRing.write( Int seq, [Int] head, numpy.uint16[] samples, [Int] tail ) Publish one decoded stream packet.
+	def write(self, seq, head, samples, tail):
+		record = numpy.empty(4 + len(head) + len(tail) + len(samples), numpy.uint32)
+		record[0:4] = (len(record), seq, len(head), len(tail))
+		record[4:4+len(head)] = head
+		record[4+len(head):4+len(head)+len(tail)] = tail
+		record[4+len(head)+len(tail):] = samples
+		a = self.view()
+		h = self.head.value
+		start = h % self.words
+		first = min(len(record), self.words - start)
+		a[start:start+first] = record[:first]
+		a[0:len(record)-first] = record[first:]
+		self.head.value = h + len(record)
+
+	# function SharedRing.read() return [(Int seq, [Int] values)] every record published since the last read.
+	# values is the list PropCom.parseStream would hand to its listeners.
+	def read(self):
+		a = self.view()
+		h = self.head.value
+		tail = self.tail
+		if h - tail > self.words:
+			self.overruns += 1
+			self.tail = h
+			return []
+		records = []
+		while tail < h:
+			start = tail % self.words
+			length = int(a[start])
+			if length < 4 or length > self.words or self.head.value - tail > self.words:	# lapped, the length is garbage
+				self.overruns += 1
+				self.tail = self.head.value
+				return []
+			if start + length <= self.words:
+				record = a[start:start+length].copy()
+			else:
+				record = numpy.concatenate((a[start:], a[:start+length-self.words]))
+			tail += length
+			nHead = int(record[2])
+			nTail = int(record[3])
+			values = record[4:4+nHead].tolist() + record[4+nHead+nTail:].tolist() + record[4+nHead:4+nHead+nTail].tolist()
+			records.append((int(record[1]), values))
+		if self.head.value - self.tail > self.words:	# lapped while copying, the copies may be torn
+			self.overruns += 1
+			self.tail = self.head.value
+			return []
+		self.tail = tail
+		return records
+
+# class PipeWriter Takes the place of the serial port in RemotePropCom. Writes are forwarded to the acquisition process.
+class PipeWriter():
+	def __init__(self, conn):
+		self.conn = conn
+		self.port = None
+		self.baudrate = None
+
+	def write(self, msg):
+		self.conn.send(("write", msg))
+		return len(msg)
+
+	def close(self):
+		try:
+			self.conn.send(("close",))
+		except (IOError, EOFError):
+			pass
+
+# class AcquisitionPropCom The PropCom that runs in the acquisition process.
+# Once the port is open, stream packets are decoded into the shared rings and control packets are forwarded over the pipe.
+class AcquisitionPropCom(Propeller.PropCom):
+	def __init__(self, conn, rings):
+		Propeller.PropCom.__init__(self)
+		self.conn = conn
+		self.rings = rings
+		self.seq = 0
+
+	# Control packets are also handled here, for the version handshake and the startup log of PropCom.open.
+	def dispatch(self, packets):
+		for packet in packets:
+			self.seq += 1
+			if ord(packet[0]) & 128:
+				streamID, head, samples, tail = streamdecode.decode(packet)
+				self.rings[streamID].write(self.seq, head, samples, tail)
+			else:
+				packet = bytes(bytearray(packet))
+				if packet[0] == Propeller.SYNC and len(packet) >= 6:
+					tStamp = struct.unpack_from(">I", packet, 2)[0]
+					self.conn.send(("sync", tStamp, self.syncArrival(tStamp)))
+				self.conn.send(("packet", self.seq, packet))
+				self.parseControl(packet)
+
+	# The port is closed here, on the thread that reads it, once the read loop has noticed comOpen is False. See acquire.
+	def run(self):
+		self.open(self.port)
+		if self.isOpen():
+			self.conn.send(("opened", self.com.port))
+		self.receive()
+		while self.lost and self.reconnect():
+			self.receive()
+		try:
+			self.com.close()
+		except Exception:
+			pass
+		self.conn.send(("closed",))
+
+	# The GUI process remembers the settings sent, so it is the one to restore them.
+	def reopened(self):
+		self.conn.send(("reopened", self.com.port))
+
+# function acquire( String port, Dict options, Connection conn, [SharedRing] rings ) Entry point of the acquisition process.
+def acquire(port, options, conn, rings):
+	options = dict(options)
+	options.pop("file", None)	# the log file belongs to the GUI process
+	options["dispatch_threads"] = 0		# this process has nothing slow to shield the reader from
+	logger.setOptions(options)
+
+	answers = Queue.Queue()
+	def ask(message, mode=logger.QUESTION):
+		conn.send(("ask", message, mode))
+		return answers.get()
+	def message(message, mode=0):
+		conn.send(("message", message, mode))
+	logger.ask = ask
+	logger.message = message
+
+	propCom = AcquisitionPropCom(conn, rings)
+	propCom.port = port
+
+	# the pipe is read on its own thread, since the main thread spends its time blocked on the serial port
+	def pipeReader():
+		while True:
+			try:
+				msg = conn.recv()
+			except (EOFError, IOError):
+				msg = ("close",)
+			if msg[0] == "write":
+				with propCom.comlock:
+					try:
+						propCom.com.write(msg[1])
+					except Exception as e:
+						logger.log("Write failed in acquisition process", e, logger.WARNING)
+			elif msg[0] == "answer":
+				answers.put(msg[1])
+			elif msg[0] == "flight":
+				propCom.flightEvent(msg[1], msg[2])
+			elif msg[0] == "dump":
+				propCom.dumpFlightRecorder(msg[2], msg[1])
+			elif msg[0] == "close":	# the read loop ends within read_timeout, and AcquisitionPropCom.run closes the port
+				propCom.closing = True
+				propCom.comOpen = False
+				return
+	reader = threading.Thread(target=pipeReader)
+	reader.daemon = True
+	reader.start()
+	propCom.run()
+
+# class RemotePropCom A PropCom whose serial side lives in an acquisition process.
+# Registered callbacks and stream listeners run in this process, on the RemotePropCom thread, in the order the packets arrived.
+class RemotePropCom(Propeller.PropCom):
+	def __init__(self, callbacks=None):
+		Propeller.PropCom.__init__(self, callbacks)
+		self.rings = [SharedRing(logger.options.get("shm_ring_words", 1<<18)) for n in range(NSTREAMS)]
+		self.conn, self.childConn = multiprocessing.Pipe()
+		self.com = PipeWriter(self.conn)
+		self.process = None
+		self.nextSeq = 1
+		self.pending = []	# heap of (seq, kind, payload) waiting for an earlier sequence number
+		self.gapSince = None
+		self.recorder = None	# see flightEvent
+
+	# function RemotePropCom.run() Start the acquisition process and handle what it sends until it ends.
+	# Sends go through the writer thread, as they do in PropCom.receive, so they are coalesced and deduplicated before they reach the pipe.
+	def run(self):
+		self.startWriter()
+		self.process = multiprocessing.Process(target=acquire, args=(self.port, logger.options, self.childConn, self.rings))
+		self.process.daemon = True
+		self.process.start()
+		running = True
+		while running:
+			# rings first, then the pipe: any control packet older than a ring record read here is already in the pipe
+			for streamID in range(NSTREAMS):
+				for seq, values in self.rings[streamID].read():
+					heapq.heappush(self.pending, (seq, streamID, values))
+			try:
+				while self.conn.poll(0 if self.pending else 0.01):
+					running = self.handle(self.conn.recv()) and running
+			except (EOFError, IOError):
+				running = False
+			self.deliverPending()
+		self.comOpen = False
+
+	# function RemotePropCom.handle( Tuple msg ) return Bool False once the acquisition process is done
+	def handle(self, msg):
+		if msg[0] == "packet":
+			heapq.heappush(self.pending, (msg[1], -1, msg[2]))
+		elif msg[0] == "sync":
+			self.syncArrivals.append((msg[1], msg[2]))
+		elif msg[0] == "opened":
+			self.com.port = msg[1]
+			self.comOpen = True
+			self.firstSyncTime = time.time()
+		elif msg[0] == "reopened":	# written before the acquisition process's own version handshake answers and the channels are queried
+			self.com.port = msg[1]
+			self.restoreState()
+		elif msg[0] == "ask":
+			self.conn.send(("answer", logger.ask(msg[1], msg[2])))
+		elif msg[0] == "message":
+			logger.message(msg[1], msg[2])
+		elif msg[0] == "closed":
+			self.deliverPending(True)
+			return False
+		return True
+
+	# function RemotePropCom.deliverPending( Bool flush ) Handle queued packets in sequence order.
+	# A packet is held back while an earlier sequence number is missing, for at most GAP_TIMEOUT seconds.
+	def deliverPending(self, flush=False):
+		pending = self.pending
+		while pending:
+			if pending[0][0] > self.nextSeq and not flush:
+				if self.gapSince is None:
+					self.gapSince = time.time()
+				if time.time() - self.gapSince < GAP_TIMEOUT:
+					return
+			self.gapSince = None
+			seq, streamID, payload = heapq.heappop(pending)
+			self.nextSeq = seq + 1
+			if streamID < 0:
+				self.dispatch([payload])
+			else:
+				self.metrics.streamPackets += 1	# bytes are only counted in the acquisition process
+				self.callStream(streamID, payload)
+
+	# function RemotePropCom.overruns() return Int stream records lost because this process fell a whole ring behind
+	def overruns(self):
+		return sum([r.overruns for r in self.rings])
+
+	# Packets are recorded by the acquisition process, so events and dumps are passed on to its flight recorder.
+	def flightEvent(self, text, dump=True):
+		self.conn.send(("flight", text, dump))
+
+	def dumpFlightRecorder(self, reason="", fname=None):
+		if fname is None:
+			fname = time.strftime(logger.options.get("flight_file", "flight-%Y%m%d-%H%M%S.bin"))
+		self.conn.send(("dump", fname, reason))
+		return fname
+
+	# PropCom.close only sends ("close",) once it has given up waiting for this thread, so wait again for the acquisition process to close the port and say so.
+	def close(self):
+		Propeller.PropCom.close(self)
+		if self.isAlive() and threading.currentThread() is not self:
+			self.join(logger.options.get("read_timeout", 0.1) + 1.0)
+		self.comOpen = False
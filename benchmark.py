@@ -0,0 +1,492 @@
+import os
+import sys
+import tempfile
+import time
+import serial
+import numpy
+
+import config
+import logger
+
+# benchmark.py Measures how fast the acquisition path can absorb data, without a DataSpider attached.
+# A FakeSerial object replays a synthetic, protocol-correct byte stream through PropCom.receive
+# once for every read_mode, and the bytes per second each mode manages are printed.
+# usage: python benchmark.py [seconds of data] [samples per second per channel]
+#        python benchmark.py suite [results.json]
+#        python benchmark.py logging
+# The suite times each hot path of the acquisition path separately, see benchSuite. It runs without wx or a serial port.
+# logging compares the stream path with every logging flag off against the same path with its logging code taken out, see benchLogging.
+
+options = dict(config.options)
+del options["file"]		# no log file
+options["console"] = False
+options["log_sent"] = False
+options["dispatch_threads"] = 0	# count packets as they are read, not when a dispatcher gets to them
+options["flight_dump_interval"] = float("inf")	# the fake ports end with a SerialException, which is no reason to dump the flight recorder
+logger.setOptions(options)
+
+import Propeller
+import framing
+import streamdecode
+import capture
+
+EOP = Propeller.EOP
+ESC = Propeller.ESC
+CLOCKPERSEC = Propeller.PropCom.CLOCKPERSEC
+
+# function controlPacket( String key, [Int] values ) return String an encoded control packet
+def controlPacket(key, values):
+	return framing.controlPacket(Propeller.keyTable.index(key), values)
+
+streamPacket = framing.streamPacket
+
+# function makeStream( Float seconds, Int rate, Int nChannels, Int perPacket ) return String the bytes a DataSpider streaming *nChannels* channels would send in *seconds*
+def makeStream(seconds, rate, nChannels=4, perPacket=31):
+	period = CLOCKPERSEC // rate
+	data = ""
+	tStamp = 0
+	nextSync = 0
+	for n in range(int(seconds * rate / perPacket)):
+		while tStamp >= nextSync:
+			data += controlPacket("sync", [nextSync & Propeller.PropCom.MAX_CLOCK])
+			nextSync += Propeller.PropCom.SYNCPERIOD
+		for streamID in range(nChannels):
+			samples = [(n*perPacket + i + streamID*100) & 0xFFF for i in range(perPacket)]
+			data += streamPacket(streamID, period, tStamp & Propeller.PropCom.MAX_CLOCK, samples)
+		tStamp += period * perPacket
+	return data
+
+# class FakeSerial Stands in for serial.Serial. Serves a fixed byte string, *chunk* bytes at a time.
+# Raises SerialException once all data has been read, which ends PropCom's read loop.
+class FakeSerial():
+	timeout = None
+	def __init__(self, data, chunk=4096):
+		self.data = data
+		self.chunk = chunk
+		self.pos = 0
+
+	def inWaiting(self):
+		return min(len(self.data) - self.pos, self.chunk)
+
+	def read(self, size=1):
+		if self.pos >= len(self.data):
+			raise serial.SerialException("end of benchmark data")
+		chunk = self.data[self.pos:self.pos+size]
+		self.pos += len(chunk)
+		return chunk
+
+	def readinto(self, b):
+		chunk = self.read(len(b))
+		b[:len(chunk)] = chunk
+		return len(chunk)
+
+	def write(self, msg):
+		return len(msg)
+
+	def close(self):
+		pass
+
+# function benchStreamDecode( Int perPacket, Float seconds ) return (Float, Float) samples per second decoded by streamdecode.decodeLegacy and streamdecode.decode
+# Both decoders are checked to give the same values.
+def benchStreamDecode(perPacket=31, seconds=0.5):
+	packets = []
+	for n in range(50):
+		samples = [(n*perPacket + i) & 0xFFF for i in range(perPacket)]
+		framer = framing.Framer()
+		packets += framer.feed(streamPacket(n & 7, 2667, n*perPacket*2667, samples))
+	for p in packets:
+		streamID, head, samples, tail = streamdecode.decode(p)
+		assert (streamID, head + samples.tolist() + tail) == streamdecode.decodeLegacy(p), "decoders disagree"
+	results = []
+	for decode in [streamdecode.decodeLegacy, streamdecode.decode]:
+		count = 0
+		start = time.time()
+		while time.time() - start < seconds:
+			for p in packets:
+				decode(p)
+			count += len(packets)
+		results.append(count * perPacket / (time.time() - start))
+	return results
+
+# function benchReadMode( String mode, String data ) return (Float bytes per second, Int packets, Int bytes copied, Int bytes moved) Feed *data* through PropCom.receive using the given read_mode.
+# Bytes copied are those RxRing compaction moved to the front of the ring. Bytes moved are those the framer moved within the ring to remove escapes.
+def benchReadMode(mode, data):
+	logger.options["read_mode"] = mode
+	propCom = Propeller.PropCom()
+	propCom.com = FakeSerial(data)
+	propCom.comOpen = True
+	count = [0]
+	def listener(propCom, values):
+		count[0] += 1
+	for streamID in range(4):
+		propCom.addListener(streamID, listener)
+	start = time.time()
+	propCom.receive()
+	elapsed = time.time() - start
+	return len(data) / elapsed, count[0], propCom.ring.copied, propCom.framer.moved
+
+# function benchChecksumLoop( String data, Float seconds ) return Dict bytes per second of the checksum over the packet bytes of *data*, by each way of writing Framer.feedRing's loop.
+# "index" indexes the ring with xrange, "slice" iterates a slice of each run. Runs are the bytes between EOPs and ESCs, as feedRing sees them.
+def benchChecksumLoop(data, seconds=0.5):
+	buf = bytearray(data)
+	runs = []
+	i = 0
+	for n in range(len(buf)):
+		if buf[n] == ord(EOP) or buf[n] == ord(ESC):
+			if n > i:
+				runs.append((i, n))
+			i = n + 1
+	rotl = framing.ROTL
+	def index():
+		chksum = 0
+		for i, end in runs:
+			for k in xrange(i, end):
+				chksum = (rotl[chksum] + buf[k]) & 255
+		return chksum
+	def sliced():
+		chksum = 0
+		for i, end in runs:
+			for c in buf[i:end]:
+				chksum = (rotl[chksum] + c) & 255
+		return chksum
+	assert index() == sliced(), "checksum loops disagree"
+	total = sum([end - i for i, end in runs])
+	results = dict()
+	for name, loop in [("index", index), ("slice", sliced)]:
+		count = 0
+		start = time.time()
+		while time.time() - start < seconds:
+			loop()
+			count += total
+		results[name] = count / (time.time() - start)
+	return results
+
+# function benchReplay( String data, Int chunk ) return (Float bytes per second, Int packets) Write *data* to a capture file in *chunk* byte records,
+# then replay it as fast as possible through PropCom.open and PropCom.receive.
+def benchReplay(data, chunk=256):
+	fd, fname = tempfile.mkstemp(suffix=".cap")
+	os.close(fd)
+	try:
+		writer = capture.CaptureWriter(fname)
+		for n in range(0, len(data), chunk):
+			writer.write(data[n:n+chunk], n / 100000.0)
+		writer.close()
+		logger.options["read_mode"] = "bulk"
+		logger.options["replay_file"] = fname
+		logger.options["replay_speed"] = 0
+		propCom = Propeller.PropCom()
+		count = [0]
+		def listener(propCom, values):
+			count[0] += 1
+		for streamID in range(4):
+			propCom.addListener(streamID, listener)
+		start = time.time()
+		propCom.open()
+		propCom.receive()
+		elapsed = time.time() - start
+	finally:
+		logger.options["replay_file"] = ""
+		os.remove(fname)
+	return len(data) / elapsed, count[0]
+
+# ----- microbenchmark suite -----
+# Each hot path is fed synthetic, protocol-correct packets for 4 channels at the given sampling rate.
+# Results are dicts with ops/s, microseconds per sample and, where they can be counted, object allocations per packet.
+# Allocations are counted with sys.getcounts, which only interpreters built with COUNT_ALLOCS have. Elsewhere the figure is left out:
+# gc.get_count or tracemalloc would only show the objects that survive, not the per-packet temporaries the suite is meant to catch.
+
+PER_PACKET = 31		# samples per stream packet, as the firmware sends them
+SUITE_SECONDS = 0.3	# least time each benchmark runs for
+
+# function allocCounter() return (Function start, Function stop)|None a way to count object allocations, or None if this interpreter cannot. stop returns the count since start.
+def allocCounter():
+	if not hasattr(sys, "getcounts"):
+		return None
+	def allocated():
+		return sum([allocs for name, allocs, frees, most in sys.getcounts()])
+	def start():
+		return allocated()
+	def stop(began):
+		return allocated() - began
+	return start, stop
+
+# function timeRun( String name, Int rate, Function run, Int packets, Int samples ) return Dict the result of calling *run* until SUITE_SECONDS have passed.
+# run = called with no arguments. Handles *packets* packets holding *samples* samples per call.
+def timeRun(name, rate, run, packets, samples):
+	counter = allocCounter()
+	if counter is None:
+		run()	# warm up like the counted run would
+	else:
+		began = counter[0]()
+		run()
+		allocs = counter[1](began)
+	calls = 0
+	start = time.time()
+	while True:
+		run()
+		calls += 1
+		elapsed = time.time() - start
+		if elapsed >= SUITE_SECONDS:
+			break
+	result = {"name": name, "rate": rate,
+		"ops_per_sec": calls * packets / elapsed,
+		"us_per_sample": elapsed * 1e6 / (calls * max(samples, 1))}
+	if counter is not None:
+		result["allocs_per_packet"] = allocs / float(max(packets, 1))
+	return result
+
+# function suiteDevice() return (PropCom, [AnalogIn], Digitals) a headless PropCom with 4 analog inputs and the digital channel, synced to clock 0
+def suiteDevice():
+	import channels
+	propCom = Propeller.PropCom()
+	propCom.firstSyncTime = time.time()
+	propCom.onSync(0)
+	analogIn = [channels.AnalogIn(propCom, idx, name="Analog Input " + str(idx)) for idx in range(4)]
+	digitals = channels.Digitals(propCom, 6, 8, name="Digital I/O")
+	return propCom, analogIn, digitals
+
+# class SuiteWidgets Just enough of main.DigitalWidgets for Digitals.recordState to count pins.
+class SuiteWidgets():
+	def __init__(self, nPins):
+		self.lights = [None] * nPins
+		self.switches = [None] * nPins
+
+# class PointPlugin A plugin that keeps a running total of the samples, one at a time.
+class PointPlugin():
+	total = 0
+	def onPoint(self, chan, propCom, value, tStamp, rTime):
+		self.total += value
+
+# class PointsPlugin The same as PointPlugin, taking a packet of samples at a time.
+class PointsPlugin():
+	total = 0
+	def onPoints(self, chan, propCom, values, tstamps, rtimes):
+		self.total += int(values.sum())
+
+# function benchSuite( Int rate ) return [Dict] one result per hot path at *rate* samples per second per channel
+def benchSuite(rate):
+	results = []
+	period = CLOCKPERSEC // rate
+	data = makeStream(0.25, rate)
+	framer = framing.Framer()
+	packets = [p for p in framer.feed(data) if ord(p[0]) & 128]
+	nSamples = len(packets) * PER_PACKET
+	propCom, analogIn, digitals = suiteDevice()
+	tmp = tempfile.mkdtemp()
+
+	# PropCom.parse, from bytes to stream listeners
+	results.append(timeRun("parse", rate, lambda: propCom.parse(data, framing.Framer()), len(packets), nSamples))
+
+	# PropCom.parseStream on its own, with a listener that does nothing
+	bare = Propeller.PropCom()
+	for streamID in range(4):
+		bare.addListener(streamID, lambda propCom, values: None)
+	def parseStream():
+		for p in packets:
+			bare.parseStream(p)
+	results.append(timeRun("parseStream", rate, parseStream, len(packets), nSamples))
+
+	# PropCom.parseControl and call, with point packets going to the channels' point hooks
+	points = framer.feed("".join([controlPacket("point", [(n % 4)<<12 | (n & 0xFFF), n*period & Propeller.PropCom.MAX_CLOCK]) for n in range(rate // 10)]))
+	def parseControl():
+		for p in points:
+			propCom.parseControl(p)
+	results.append(timeRun("parseControl+call", rate, parseControl, len(points), len(points)))
+
+	# PropCom.realTime for every sample time
+	tStamps = [n*period & Propeller.PropCom.MAX_CLOCK for n in range(rate // 4)]
+	def realTime():
+		for t in tStamps:
+			propCom.realTime(t, 0)
+	results.append(timeRun("realTime", rate, realTime, len(tStamps) // PER_PACKET, len(tStamps)))
+
+	# AnalogIn.streamListener, through PropCom.callStream
+	decoded = [streamdecode.decode(p) for p in packets]
+	decoded = [(streamID, head + samples.tolist() + tail) for streamID, head, samples, tail in decoded]
+	def streamListener():
+		for streamID, values in decoded:
+			propCom.callStream(streamID, values)
+	results.append(timeRun("streamListener", rate, streamListener, len(decoded), nSamples))
+
+	# the same, with a plugin taking one sample per call through onPoint, then one packet per call through onPoints
+	for name, plugin in [("+onPoint", PointPlugin()), ("+onPoints", PointsPlugin())]:
+		for chan in analogIn:
+			chan.register(plugin)
+		results.append(timeRun("streamListener" + name, rate, streamListener, len(decoded), nSamples))
+		for chan in analogIn:
+			chan.deregister(plugin)
+
+	# AnalogIn.add, flushing to a recording file
+	chan = analogIn[0]
+	chan.filename = os.path.join(tmp, "analog.csv")
+	chan.openFile()
+	points = [(n & 0xFFF, n*period) for n in range(rate // 4)]
+	def add():
+		for v, t in points:
+			chan.add(v, t)
+		chan.flush()
+	results.append(timeRun("add+flush", rate, add, len(points) // PER_PACKET, len(points)))
+
+	# AnalogIn.addMany, a packet at a time, flushing to the same file
+	packed = [(numpy.array([v for v, t in points[n:n+PER_PACKET]], dtype=numpy.uint16), numpy.array([t for v, t in points[n:n+PER_PACKET]], dtype=numpy.int64))
+		for n in range(0, len(points), PER_PACKET)]
+	def addMany():
+		for values, ticks in packed:
+			chan.addMany(values, ticks)
+		chan.flush()
+	results.append(timeRun("addMany+flush", rate, addMany, len(packed), len(points)))
+	chan.closeFile()
+
+	# AnalogIn.window over the last second of history, and AnalogIn.last
+	for values, ticks in packed:
+		chan.addMany(values, ticks)
+	lastTick = int(chan.last(1)[0][0])
+	def window():
+		for n in range(PER_PACKET):
+			chan.window(lastTick - CLOCKPERSEC, lastTick)
+			chan.last(rate)
+	results.append(timeRun("window+last", rate, window, PER_PACKET, PER_PACKET))
+
+	# AnalogIn.buckets for a 2000 point plot of all the history, decimated from the samples, and the same from the pyramid
+	def buckets():
+		for n in range(PER_PACKET):
+			chan.buckets(0, lastTick, 2000)
+			chan.pyramid.buckets(0, lastTick, 2000)
+	results.append(timeRun("buckets", rate, buckets, PER_PACKET, PER_PACKET))
+
+	# Digitals.recordState, once per change of the digital inputs
+	digitals.widgets = SuiteWidgets(8)
+	digitals.filename = os.path.join(tmp, "digital.csv")
+	digitals.openFile()
+	digitals.oldValue = digitals.oldInVals = 0
+	def recordState():
+		for n in range(100):
+			digitals.inVals = n & 255
+			digitals.recordState()
+	results.append(timeRun("recordState", rate, recordState, 100, 100))
+	digitals.closeFile()
+
+	# PropCom.send once per message, against PropCom.sendMany, for the seven queries Device.queryChannel makes
+	propCom.com = FakeSerial("")
+	propCom.comOpen = True
+	queries = [("query", idx) for idx in range(7)]
+	def send():
+		for key, value in queries:
+			propCom.send(key, value)
+	results.append(timeRun("send", rate, send, len(queries), len(queries)))
+	results.append(timeRun("sendMany", rate, lambda: propCom.sendMany(queries), len(queries), len(queries)))
+	propCom.comOpen = False
+
+	for fname in os.listdir(tmp):
+		os.remove(os.path.join(tmp, fname))
+	os.rmdir(tmp)
+	return results
+
+# function benchLogging( Int rate, Int repeats ) return Dict microseconds per sample through parseStream, the channels' stream listeners and AnalogIn.addMany
+# "flags_off" is the code as it is with every log option False, "no_logging" the same path with its logging code taken out,
+# and "dict_lookups" the same path testing logger.options for every packet and sample, as it did before the flags were resolved by logger.setOptions.
+# Each is the best of *repeats* runs, taken in turns so that drift in the machine's speed hits all three alike.
+def benchLogging(rate=3000, repeats=7):
+	import types
+	data = makeStream(0.25, rate)
+	packets = [p for p in framing.Framer().feed(data) if ord(p[0]) & 128]
+	nSamples = len(packets) * PER_PACKET
+	propCom, analogIn, digitals = suiteDevice()
+	realParseStream = propCom.parseStream
+	realAdd = [chan.addMany for chan in analogIn]
+
+	def parseStreamNoLog(self, packet):
+		streamID, head, samples, tail = streamdecode.decode(packet)
+		self.callStream(streamID, head + samples.tolist() + tail)
+	addNoLog = analogIn[0].__class__.store.im_func	# addMany is store behind the log_points check
+	def parseStreamDict(self, packet):
+		streamID, head, samples, tail = streamdecode.decode(packet)
+		values = head + samples.tolist() + tail
+		if logger.options["log_stream"]:
+			logger.log("Stream ["+str(streamID)+"]","",logger.INFO)
+		self.callStream(streamID, values)
+	def addDict(self, values, ticks):
+		if logger.options["log_points"]:
+			for data in zip(ticks.tolist(), values.tolist()):
+				logger.write(self.name + " + (" + str(data) +")")
+		self.store(values, ticks)
+
+	def flagsOff():
+		propCom.parseStream = realParseStream
+		for chan, add in zip(analogIn, realAdd):
+			chan.addMany = add
+	def variant(parseStream, add):
+		def setup():
+			propCom.parseStream = types.MethodType(parseStream, propCom)
+			for chan in analogIn:
+				chan.addMany = types.MethodType(add, chan)
+		return setup
+	variants = [("flags_off", flagsOff), ("no_logging", variant(parseStreamNoLog, addNoLog)), ("dict_lookups", variant(parseStreamDict, addDict))]
+	best = dict()
+	for n in range(repeats):
+		for name, setup in variants:
+			setup()
+			start = time.time()
+			for p in packets:
+				propCom.parseStream(p)
+			elapsed = time.time() - start
+			for chan in analogIn:
+				chan.unflushed = 0	# nothing is recording, so flush writes nothing
+			best[name] = min(best.get(name, elapsed), elapsed)
+	flagsOff()
+	return dict([(name, t * 1e6 / nSamples) for name, t in best.items()])
+
+# function runSuite( String fname ) Run the suite at 3000 and 30000 samples per second, print a table and write the results to *fname* as JSON.
+def runSuite(fname=None):
+	import json
+	import platform
+	results = []
+	for rate in [3000, 30000]:
+		results += benchSuite(rate)
+	for r in results:
+		line = "%-18s %6d/s %12.0f ops/s %8.3f us/sample" % (r["name"], r["rate"], r["ops_per_sec"], r["us_per_sample"])
+		if "allocs_per_packet" in r:
+			line += " %8.2f allocs/packet" % r["allocs_per_packet"]
+		print(line)
+	report = {"python": platform.python_version(), "time": time.time(), "results": results}
+	if fname is not None:
+		f = open(fname, "w")
+		json.dump(report, f, indent=1, sort_keys=True)
+		f.close()
+	else:
+		print(json.dumps(report, sort_keys=True))
+
+def main():
+	if len(sys.argv) > 1 and sys.argv[1] == "suite":
+		runSuite(sys.argv[2] if len(sys.argv) > 2 else None)
+		return
+	if len(sys.argv) > 1 and sys.argv[1] == "logging":
+		for rate in [3000, 30000]:
+			r = benchLogging(rate)
+			print("stream path %6d/s: flags off %.3f us/sample, no logging code %.3f us/sample (%+.1f%%), dict lookups %.3f us/sample (%+.1f%%)" % (rate,
+				r["flags_off"], r["no_logging"], 100 * (r["no_logging"] / r["flags_off"] - 1), r["dict_lookups"], 100 * (r["dict_lookups"] / r["flags_off"] - 1)))
+		return
+	seconds = 2.0
+	rate = 3000
+	if len(sys.argv) > 1:
+		seconds = float(sys.argv[1])
+	if len(sys.argv) > 2:
+		rate = int(sys.argv[2])
+	data = makeStream(seconds, rate)
+	print("%d bytes, %.1f seconds of 4 channels at %d samples/s" % (len(data), seconds, rate))
+	results = dict()
+	for mode in ["byte", "bulk"]:
+		bytesPerSec, packets, copied, moved = benchReadMode(mode, data)
+		results[mode] = bytesPerSec
+		print("read_mode %-5s %12.0f bytes/s  %6d stream packets  %8d bytes copied  %8d bytes moved" % (mode, bytesPerSec, packets, copied, moved))
+	print("bulk / byte speedup: %.1fx" % (results["bulk"] / results["byte"]))
+	bytesPerSec, packets = benchReplay(data)
+	print("capture replay    %12.0f bytes/s  %6d stream packets" % (bytesPerSec, packets))
+	loops = benchChecksumLoop(data)
+	print("checksum loop: xrange index %9.0f bytes/s, slice %9.0f bytes/s" % (loops["index"], loops["slice"]))
+	for perPacket in [31, 255]:
+		legacy, vectorized = benchStreamDecode(perPacket)
+		print("stream decode, %3d samples/packet: legacy %9.0f samples/s, vectorized %9.0f samples/s" % (perPacket, legacy, vectorized))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,145 @@
+import struct
+import time
+
+import serial
+
+# capture.py Records the raw bytes read from the DataSpider, and plays them back.
+# A capture file starts with MAGIC and is followed by one record per read:
+#	Float64 host time the bytes were read, UInt32 byte count, the bytes
+# all big endian. The bytes are exactly what the serial port returned, before any framing.
+# ReplaySerial stands in for serial.Serial, so a capture goes through the same framing, decoding,
+# realTime and channel hooks as a live device.
+
+MAGIC = "SPCAP1\n"
+RECORD = struct.Struct(">dI")
+
+# class CaptureWriter Appends timestamped chunks of received bytes to a capture file.
+class CaptureWriter():
+	# constructor CaptureWriter( String fname ) return CaptureWriter a new capture file *fname*. An existing file is overwritten.
+	def __init__(self, fname):
+		self.fname = fname
+		self.f = open(fname, "wb")
+		self.f.write(MAGIC)
+		self.bytes = 0
+
+	# function CaptureWriter.write( buffer data, Float t ) Record the bytes in *data* as read at host time *t*, by default now.
+	def write(self, data, t=None):
+		if t is None:
+			t = time.time()
+		self.f.write(RECORD.pack(t, len(data)))
+		self.f.write(data)
+		self.bytes += len(data)
+
+	# function CaptureWriter.close() Flush and close the file.
+	def close(self):
+		if not self.f.closed:
+			self.f.close()
+
+# class CaptureReader Reads the records of a capture file in order.
+class CaptureReader():
+	# constructor CaptureReader( String fname ) return CaptureReader positioned on the first record. Raises IOError if *fname* is not a capture file.
+	def __init__(self, fname):
+		self.f = open(fname, "rb")
+		if self.f.read(len(MAGIC)) != MAGIC:
+			self.f.close()
+			raise IOError("Not a capture file: " + fname)
+
+	# function CaptureReader.next() return (Float t, String data) the next record, or None at the end of the file.
+	# A record cut short by a crash is treated as the end of the file.
+	def next(self):
+		head = self.f.read(RECORD.size)
+		if len(head) < RECORD.size:
+			return None
+		t, n = RECORD.unpack(head)
+		data = self.f.read(n)
+		if len(data) < n:
+			return None
+		return (t, data)
+
+	def close(self):
+		self.f.close()
+
+# class ReplaySerial Plays a capture file back through the parts of the serial.Serial interface PropCom uses.
+# Bytes become readable when their record is due: at the recorded pace divided by *speed*, or right away if speed is 0.
+# Writes are accepted and thrown away. Once every byte has been read, read raises serial.SerialException, like an unplugged port.
+class ReplaySerial():
+	MAX_PENDING = 65536	# records are not queued past this many bytes when replaying as fast as possible
+
+	# constructor ReplaySerial( String fname, Float speed ) return ReplaySerial a closed port for the capture file *fname*
+	def __init__(self, fname, speed=1.0):
+		self.port = fname
+		self.baudrate = None
+		self.timeout = None
+		self.speed = float(speed)
+		self.reader = None
+		self.is_open = False
+
+	# function ReplaySerial.open() Start the replay from the first record.
+	def open(self):
+		self.reader = CaptureReader(self.port)
+		self.pending = bytearray()
+		self.record = self.reader.next()
+		self.firstTime = None
+		if self.record is not None:
+			self.firstTime = self.record[0]
+		self.startTime = time.time()
+		self.is_open = True
+
+	def isOpen(self):
+		return self.is_open
+
+	# function ReplaySerial.due( Float t ) return Float the host time at which a record captured at *t* can be read
+	def due(self, t):
+		if self.speed <= 0:
+			return 0
+		return self.startTime + (t - self.firstTime) / self.speed
+
+	# function ReplaySerial.fill( Bool wait ) Move every record that is due into the pending bytes.
+	# wait = if nothing is pending, sleep until the next record is due, for at most *timeout* seconds.
+	def fill(self, wait):
+		if not self.is_open:
+			raise serial.SerialException("Replay is closed")
+		while self.record is not None and len(self.pending) < self.MAX_PENDING:
+			delay = self.due(self.record[0]) - time.time()
+			if delay > 0:
+				if not wait or self.pending:
+					return
+				if self.timeout is not None and delay > self.timeout:
+					time.sleep(self.timeout)
+					return
+				time.sleep(delay)
+			self.pending += self.record[1]
+			self.record = self.reader.next()
+		if self.record is None and not self.pending:
+			raise serial.SerialException("End of replay: " + self.port)
+
+	# function ReplaySerial.inWaiting() return Int bytes that can be read without waiting
+	def inWaiting(self):
+		self.fill(False)
+		return len(self.pending)
+
+	# function ReplaySerial.read( Int size ) return String up to *size* bytes. Waits at most *timeout* seconds for the first one.
+	def read(self, size=1):
+		self.fill(True)
+		data = bytes(self.pending[:size])
+		del self.pending[:size]
+		return data
+
+	# function ReplaySerial.readinto( buffer b ) return Int the number of bytes read into *b*
+	def readinto(self, b):
+		self.fill(True)
+		n = min(len(b), len(self.pending))
+		b[:n] = bytes(self.pending[:n])
+		del self.pending[:n]
+		return n
+
+	def write(self, data):
+		return len(data)
+
+	def flushInput(self):
+		pass
+
+	def close(self):
+		self.is_open = False
+		if self.reader is not None:
+			self.reader.close()
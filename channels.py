@@ -1,12 +1,18 @@
 import math
 import time
-import wx
+import numpy
+try:
+	import wx
+except ImportError: # headless, for benchmarks and tests. Widgets are not available.
+	wx = None
 import threading # used for locks
 #import wx.lib.buttons as buttons
 
 import logger
+import samplering
+import pyramid
 
-
+STEPS = numpy.arange(256, dtype=numpy.int64)	# sample numbers within a stream packet, sliced rather than made for every packet
 
 # --- Class that defines a channel. 
 # class Channel Represents a single input/output channel on the DataSpider module
@@ -22,7 +28,8 @@ class Channel():
 	outFile = None		# file descriptor to write output to. 
 
 	ID = 0		# fixme (used to make a new ID for repeating timers) better way than counter? uuid? TODO
-	hooks = dict()
+	hooks = ()	# registered objects. The tuple is replaced, never changed, so events can loop over it without copying.
+	pointHooks = ()	# the onPoints function of each registered object, see pointsHook. Replaced along with hooks.
 
 
 	
@@ -41,7 +48,9 @@ class Channel():
 		self.value = startval
 		self.propCom = propCom
 		self.started = False
-		self.hooks = set()
+		self.hooks = ()
+		self.pointHooks = ()
+		self.hooksLock = threading.Lock()
 		self.outfile = None
 		self.filename = None
 
@@ -123,16 +132,33 @@ class Channel():
 
 	#function Channel.register(Object obj) return Object the object passed in.
 	# Registers the given object to be notified of any events. The object must have methods for any events it wishes to be notified about.
+	# New samples go to its onPoints method if it has one, or else to its onPoint method once per sample, see pointsHook.
 	def register(self,obj):
-		self.hooks.add(obj)
+		with self.hooksLock:
+			if obj not in self.hooks:
+				self.hooks = self.hooks + (obj,)
+				self.pointHooks = tuple([f for f in map(pointsHook, self.hooks) if f is not None])
 		return obj
 	#function Channel.deregister(Object obj) Removes the object from being notified of future events on this channel. If the given object is not already registered, a KeyError is raised.
 	def deregister(self,obj):
-		try:
-			self.hooks.remove(obj)
-		except KeyError as E:
-			logger.log("No function registered in channel " + str(self.idx),  str(obj), logger.WARNING)
-			raise
+		with self.hooksLock:
+			if obj not in self.hooks:
+				logger.log("No function registered in channel " + str(self.idx),  str(obj), logger.WARNING)
+				raise KeyError(obj)
+			self.hooks = tuple([h for h in self.hooks if h is not obj])
+			self.pointHooks = tuple([f for f in map(pointsHook, self.hooks) if f is not None])
+
+	#function Channel.callPointHooks( numpy.ndarray values, numpy.ndarray tstamps ) Pass new samples to every registered object, as arrays.
+	# values = the samples, uint16
+	# tstamps = their device ticks since the first sync, int64. The seconds are worked out from them in one call to PropCom.clock.
+	def callPointHooks(self, values, tstamps):
+		propCom = self.propCom
+		rtimes = propCom.clock.seconds(tstamps)
+		for hook in self.pointHooks:
+			try:
+				hook(self, propCom, values, tstamps, rtimes)
+			except Exception as e:
+				logger.log("Error with onPoints (channels.py)", e, logger.WARNING)
 
 	#function Channel.start() Start this channel. Can have different meaning for different channels.
 	def start(self):
@@ -140,7 +166,7 @@ class Channel():
 		self.started = True
 		self.openFile()
 		self.widgets.startBtn.SetValue(True)
-		for obj in self.hooks.copy():
+		for obj in self.hooks:
 			try:
 				obj.onStart(self, self.propCom)
 			except Exception as e:
@@ -152,7 +178,7 @@ class Channel():
 		self.started = False
 		self.closeFile()
 		self.widgets.startBtn.SetValue(False)
-		for obj in self.hooks.copy():
+		for obj in self.hooks:
 			try:
 				obj.onStop(self, self.propCom)
 			except Exception as e:
@@ -162,7 +188,7 @@ class Channel():
 	#function Channel.setValue( Anything newval, [Bool limit] ) Set the value of this channel to *newval*. if limit=True then limit the value to safe values.
 	def setValue(self, newval, limit=False):
 		"""Change the value of this channel"""
-		for obj in self.hooks.copy():
+		for obj in self.hooks:
 			try:
 				obj.onSet(self, self.propCom, newval)
 			except Exception as e:
@@ -210,6 +236,29 @@ class Channel():
 #		return abstime
 
 
+#function pointsHook( Object obj ) return Function|None the function to give new samples of a channel to *obj*, or None if it takes none.
+# An object with an onPoints( Channel chan, PropCom propCom, numpy.ndarray values, numpy.ndarray tstamps, numpy.ndarray rtimes ) method gets every packet's samples in one call.
+# An object with only onPoint( Channel chan, PropCom propCom, Int value, Int tStamp, Float rTime ) gets one call per sample, as ints and floats, through an adapter.
+def pointsHook(obj):
+	if hasattr(obj, "onPoints"):
+		return obj.onPoints
+	if not hasattr(obj, "onPoint"):
+		return None
+	onPoint = obj.onPoint
+	def onPoints(chan, propCom, values, tstamps, rtimes):
+		debugPoints = logger.debugPoints
+		if debugPoints:
+			debugObj = "HighFreq - " + str(tstamps[1] - tstamps[0]) if len(tstamps) > 1 else "SlowFreq"
+		for value, tStamp, rTime in zip(values.tolist(), tstamps.tolist(), rtimes.tolist()):
+			try:
+				if debugPoints:
+					onPoint(chan, propCom, value, tStamp, rTime, debugObj)
+				else:
+					onPoint(chan, propCom, value, tStamp, rTime)
+			except Exception as e:
+				logger.log("Error with onPoint (channels.py)", e, logger.WARNING)
+	return onPoints
+
 #function scale_bitmap(wxImage bitmap, Int width, Int height) return a new image with the specified with and height
 def scale_bitmap(bitmap, width, height):
     image = wx.ImageFromBitmap(bitmap)
@@ -236,16 +285,15 @@ class Digitals(Channel):
 	# pinDir = the pin directions for all nPins pins. changing this is NYI.
 	def __init__(self, propCom, idx, nPins, widgets=None, name="?", startval=0, pinDir=0):
 		Channel.__init__(self, propCom, idx, widgets, name, startval)
-		self.onBitmapO = scale_bitmap(wx.Bitmap("green-led-on-md.png"), 30, 30)
-		self.offBitmapO = scale_bitmap(wx.Bitmap("green-led-off-md.png"), 30, 30)
-		self.onBitmapI = scale_bitmap(wx.Bitmap("blue-led-on-md.png"), 30, 30)
-		self.offBitmapI = scale_bitmap(wx.Bitmap("blue-led-off-md.png"), 30, 30)
+		if wx is not None:
+			self.onBitmapO = scale_bitmap(wx.Bitmap("green-led-on-md.png"), 30, 30)
+			self.offBitmapO = scale_bitmap(wx.Bitmap("green-led-off-md.png"), 30, 30)
+			self.onBitmapI = scale_bitmap(wx.Bitmap("blue-led-on-md.png"), 30, 30)
+			self.offBitmapI = scale_bitmap(wx.Bitmap("blue-led-off-md.png"), 30, 30)
 		self.pinDir=pinDir
 		self.nPins = nPins
 		self.inVals = 0 	
 		self.lock = threading.Lock()
-		def idxTest(propCom,  cIdx, *args):
-			return cIdx == self.idx
 		def dirHook(propCom,  dirs):
 			self.pinDirs = dirs
 			self.setDir(dirs)
@@ -253,7 +301,7 @@ class Digitals(Channel):
 		def digHook(propCom,  dVal, tStamp):
 			rTime = propCom.realTime(tStamp, self.idx)
 			with self.lock:
-				for obj in self.hooks.copy():
+				for obj in self.hooks:
 						try:
 							if obj.digIdx is not None:
 								idxmask =  (1<<obj.digIdx) 
@@ -282,16 +330,16 @@ class Digitals(Channel):
 		#	bitmask = 1 << 31
 		#	pVal = (pVal | bitmask) ^ bitmask
 			logger.write( pVal )
-			self.setValue(int(pVal))
+			self.setValue(int(pVal), send=False)
 			if self.pinDirs != dirs:
 				self.pinDirs = dirs
 				self.setDir(dirs)
 				self.resetWidgets()
 
-	#	propCom.register("set", setHook, test=idxTest)
+	#	propCom.register("set", setHook, index=self.idx)
 	#	propCom.register("dir", dirHook)
 		propCom.register("dig", digHook)
-		propCom.register("info", infoHook, test=idxTest)
+		propCom.register("info", infoHook, index=self.idx)
 		
 
 	# function Digitals.start() do nothing.
@@ -300,11 +348,12 @@ class Digitals(Channel):
 	# function Digitals.stop() do nothing.
 	def stop(self):
 		pass
-	# function Digitals.setValue( Int newval, Int pinmask ) 
+	# function Digitals.setValue( Int newval, Int pinmask, Bool send ) 
 	# set the state of all digital outputs as a bitmask. pinmask is used to set only a subset of digital outputs. 1=HIGH 0=LOW
 	# newval = The new state of digital outputs, as a bitmask
 	# pinmask = A bitmask of only the digital outputs to be changed. use None to affect all pins. 1=change, 0=dont change
-	def setValue(self, newval, pinmask=None):
+	# send = False to only take on a value the device reported, without sending it back
+	def setValue(self, newval, pinmask=None, send=True):
 		with self.lock:
 			if pinmask is not None: 
 				newval = ((self.value | pinmask) ^ pinmask) | (newval & pinmask)
@@ -317,7 +366,8 @@ class Digitals(Channel):
 			self.recordState()
 			#bitmask = 1<<31
 			#bitmask = bitmask | self.value
-			self.propCom.send("set",[self.idx, self.value])
+			if send:
+				self.propCom.send("set",[self.idx, self.value])
 			self.resetWidgets()
 		
 	# function Digitals.recordState() saves the current state of all digital channels to the recording file set by Digitals.setFile
@@ -432,18 +482,16 @@ class AnalogOut(Channel):
 	# startval = The output power of the analog output channel from 0-1000
 	def __init__(self, propCom, idx, widgets=None, name="?", startval=0000):
 		Channel.__init__(self, propCom, idx, widgets, name, startval)
-		def idxTest(propCon,  cIdx, *args):
-			return cIdx == self.idx
 
 		def infoHook(propCom,  cIdx, pVal, period):
-			self.setValue( int(pVal) )
+			self.setValue( int(pVal), send=False )
 			if bool(pVal) != self.started:
 				if bool(pVal):
 					self.start()
 				else:
 					self.stop()
 
-		propCom.register("info", infoHook, test=idxTest)
+		propCom.register("info", infoHook, index=self.idx)
 
 
 	# function AnalogOut.start() turns the channel on, and outputs the desired power.
@@ -454,12 +502,14 @@ class AnalogOut(Channel):
 	def stop(self):
 		Channel.stop(self)
 		self.propCom.send("set", [self.idx, 0])
-	# function AnalogOut.setValue(Int newVal) Set the output power of this channel. If this channel is not on, it will **not** emit power.
+	# function AnalogOut.setValue(Int newVal, Bool limit, Bool send) Set the output power of this channel. If this channel is not on, it will **not** emit power.
 	# newVal = Desired output level from 0-1000
-	def setValue(self, newval, limit=False):
+	# send = False to only take on a value the device reported, without sending it back
+	# dedupe = True to skip sending a value the same as the one just sent, see outbound.py. For values typed into the GUI.
+	def setValue(self, newval, limit=False, send=True, dedupe=False):
 		Channel.setValue(self, int(newval))
-		if self.started:
-			self.propCom.send("set", [self.idx, self.value])
+		if self.started and send:
+			self.propCom.send("set", [self.idx, self.value], dedupe=dedupe)
 		self.widgets.channelValue.SetValue( str(self.value) )
 
 		if self.outfile is not None:
@@ -485,7 +535,10 @@ class AnalogOut(Channel):
 #class Channel.AnalogIn A class for an Analog Input channel 
 class AnalogIn(Channel):
 	started = False
-	values = []		#list queue to store values before flushing to disk.
+	history = None	# samplering.SampleRing of the last history_seconds of samples. Recordings are written from it too.
+	unflushed = 0	# samples in history not yet written by flush
+	pyramid = None	# pyramid.Pyramid of min, max and mean buckets over a much longer time than history, for plotting
+	unpyramided = 0	# samples in history not yet added to pyramid
 	clockFreq = 80000000
 
 
@@ -501,11 +554,13 @@ class AnalogIn(Channel):
 		self.H = (math.pow(2,32) -1 ) / self.clockFreq
 		self.lastTStamp = None
 		self.periods = 0
-		def idxTest(propCom,  cIdx, *args):
-			return cIdx == self.idx
-		def pointIdxTest(propCom, val, *args):
-			cIdx = val >> 12
-			return cIdx == self.idx
+		self.history = samplering.SampleRing(logger.options.get("history_seconds", 60) * logger.options.get("history_rate", 3000))
+		self.unflushed = 0
+		self.pyramid = pyramid.Pyramid(self.history.capacity // 16, logger.options.get("pyramid_levels", 16))
+		self.unpyramided = 0
+		# samples added to the pyramid at once, whole level 0 buckets and well inside the history
+		size = self.pyramid.levels[0].size
+		self.pyramidBatch = max(min(int(logger.options.get("pyramid_batch", 1024)), self.history.capacity // 2) // size, 1) * size
 
 
 		
@@ -515,7 +570,7 @@ class AnalogIn(Channel):
 				pVal = 1
 				logger.log("AI infohook", "Rate is infinite!", logger.ERROR)
 			sampPsec = (self.clockFreq / float(pVal))
-			self.setValue(sampPsec)			
+			self.setValue(sampPsec, send=False) # the device already has this rate. Sending it back would be answered with another info packet.
 
 			onstate = (startmask & 1<<cIdx)
 			if bool(onstate) != self.started:
@@ -524,63 +579,33 @@ class AnalogIn(Channel):
 				else:
 					self.stop()
 
+		# point and stream timestamps are turned into this channel's unwrapped ticks by PropCom.streamTicks.
+		# Registered objects get the ticks as tstamps, and the seconds from PropCom.clock as rtimes, see Channel.callPointHooks.
 		def pointHook(propCom, pVal, tStamp):
 			pVal = pVal & 0xFFF
-			rTime = propCom.realTime(tStamp, self.idx)
-			self.add(pVal, tStamp, rTime)
-			for obj in self.hooks.copy():
-				try:
-					if logger.options["debug_points"]:
-						obj.onPoint(self, propCom, pVal, tStamp, rTime, "SlowFreq")
-					else:
-						obj.onPoint(self,propCom, pVal, tStamp, rTime)
-				except Exception as e:
-					logger.log("Error with pointHook (channels.py)", e, logger.WARNING)
+			ticks = propCom.streamTicks(tStamp, self.idx)
+			self.add(pVal, ticks)
+			if self.pointHooks:
+				self.callPointHooks(numpy.array([pVal], dtype=numpy.uint16), numpy.array([ticks], dtype=numpy.int64))
 
+		# Sample n of a packet is at the first timestamp plus n times the packet's period, worked out from its first and last timestamps.
 		def streamListener(propCom, values):
-			rate = values[0]
-			tStamp = values[1]
-			lastTStamp = values[-1]
-			nPoints = len(values[2:-1]) - 1
-			if nPoints == 0:
-				rate = 0
-			else:
-				if tStamp > lastTStamp:
-					rate = ((propCom.MAX_CLOCK - tStamp) + lastTStamp) /nPoints
-				else:
-					rate = (lastTStamp - tStamp)/nPoints
-
-			rTime = propCom.realTime(tStamp, self.idx)
-			lastRTime = propCom.realTime(lastTStamp, self.idx)
-			rTimeRate =  (float(rate)/propCom.CLOCKPERSEC)
-
-
-			points = []
-			n = 0
-			for v in values[2:-1]:
-				curTStamp =  tStamp + rate*n
-				if curTStamp > propCom.MAX_CLOCK:
-					curTStamp = curTStamp - propCom.MAX_CLOCK
-				curRTime = rTime + rTimeRate *n
-				if curRTime > lastRTime + rTimeRate/3:
-					logger.log("Time is too late! math error in streamListener",  str(curRTime) + ">" + str(lastRTime) + " dif:" + str(curRTime - lastRTime))
-				if curTStamp > 1<<32:
-					curTStamp -= (1<<32)
-				point = (v, curTStamp, curRTime )
-				points.append( point )
-				self.add(*point)
-				for obj in self.hooks.copy():
-					try:
-						if logger.options["debug_points"]:
-							obj.onPoint(self, propCom, *point, debugObj="HighFreq - " + str(rate))
-						else:
-							obj.onPoint(self, propCom, *point)
-					except Exception as e:
-						logger.log("Error with streamListener (channels.py)", e, logger.WARNING)
-				n+=1
-
-		propCom.register("info", infoHook, test=idxTest)
-		propCom.register("point", pointHook, test=pointIdxTest)
+			samples = values[2:-1]
+			ticks = propCom.streamTicks(values[1], self.idx)
+			lastTicks = propCom.streamTicks(values[-1], self.idx)
+			nPoints = len(samples) - 1
+			rate = 0
+			if nPoints > 0:
+				rate = max((lastTicks - ticks) // nPoints, 0)
+			steps = STEPS[:len(samples)] if len(samples) <= len(STEPS) else numpy.arange(len(samples), dtype=numpy.int64)
+			samples = numpy.array(samples, dtype=numpy.uint16)
+			allTicks = steps * rate + ticks
+			self.addMany(samples, allTicks)
+			if self.pointHooks:
+				self.callPointHooks(samples, allTicks)
+
+		propCom.register("info", infoHook, index=self.idx)
+		propCom.register("point", pointHook, index=self.idx)
 		propCom.addListener(self.idx,streamListener)
 
 	def setFile(self, fname):
@@ -597,7 +622,10 @@ class AnalogIn(Channel):
 			self.outfile = open(self.filename, "w")
 			date = '"' + time.asctime() + '"'
 			self.outfile.write("Analog Input " + str(self.idx) + "," + date + ',' + 'optical fiber systems\n')
-			self.outfile.write("time (seconds), value\n" )
+			if logger.options.get("record_ticks", False):
+				self.outfile.write("Device clock, time (seconds), value\n" )
+			else:
+				self.outfile.write("time (seconds), value\n" )
 			self.closeFile()
 			logger.log("header written", self.filename, logger.INFO)
 
@@ -615,8 +643,7 @@ class AnalogIn(Channel):
 	#AnalogIn.refresh() Resend desired sampling rate, and query the device for its new rate. (The returned rate should be the same.)
 	def refresh(self):
 		Channel.refresh(self)
-		self.propCom.send("set",[self.idx, self.value])
-		self.propCom.send("set",[self.idx])
+		self.propCom.sendMany([("set",[self.idx, self.value]), ("set",[self.idx])])
 
 	# AnalogIn.testAverage() Tests the PropCom's sampling average filter to make sure it is safe at the current sample rate. 
 	#If the value is too high use PropCom.nAvg to set the desired average rate to a safer value.
@@ -628,9 +655,11 @@ class AnalogIn(Channel):
 			self.propCom.send("avg",self.propCom.nAvg)
 
 
-	#AnalogIn.setValue(Int newval) Change the sampling rate of this channel to *newval* in samples per second.
+	#AnalogIn.setValue(Int newval, Bool limit, Bool send) Change the sampling rate of this channel to *newval* in samples per second.
 	# newval = the desired sampling rate specified in samples-per-second
-	def setValue(self, newval, limit=False):
+	# send = False to only take on a rate the device reported, without sending it back
+	# dedupe = True to skip sending a rate the same as the one just sent, see outbound.py. For rates typed into the GUI.
+	def setValue(self, newval, limit=False, send=True, dedupe=False):
 		"""sets a new sample rate, specified in samples per second, for this channel"""
 		if limit and newval > self.propCom.MAX_RATE:
 			newval = self.propCom.MAX_RATE
@@ -638,34 +667,104 @@ class AnalogIn(Channel):
 
 		self.testAverage()
 		
-		self.propCom.send("set",[self.idx, self.value])
+		if send:
+			self.propCom.send("set",[self.idx, self.value], dedupe=dedupe)
 		self.widgets.channelValue.SetValue(str(newval))
 
 	#AnalogIn.flush() Flush any queued data out to the recording file.
+	# Each line is the seconds since recording started and the value, after the device ticks since the first sync if the record_ticks option is set. The ticks are converted to seconds here, all at once.
 	def flush(self):	
 		"""flushes any queued data out to a file"""
-		for val in self.values:
-			if self.outfile is not None:
-				strfmt = "{0:.5f},{1}\n".format( self.relativeTime(val[1]) , val[2])
-				#strfmt = str( val[0] ) + ","
-				#strfmt = str( self.relativeTime(val[1]) ) + ","
-				#strfmt += str( val[2] ) + "\n"
-				try:
-					self.outfile.write( strfmt )
-				except ValueError:
-					logger.log("Write to file failed", self.filename, logger.WARNING)
+		n = self.unflushed
+		self.unflushed = 0
+		if self.outfile is None or n == 0:
+			return
+		ticks, values = self.history.last(n)
+		seconds = self.propCom.clock.seconds(ticks).tolist()
+		ticks = ticks.tolist()
+		values = values.tolist()
+		withTicks = logger.options.get("record_ticks", False)
+		for n in range(len(values)):
+			if withTicks:
+				strfmt = "{0},{1:.5f},{2}\n".format( ticks[n], self.relativeTime(seconds[n]) , values[n])
 			else:
-				pass
-		self.values = []
-	#function AnalogIn.add(Int Val, Int tStamp, Float rTime) Add a value into this channel's data queue.
+				strfmt = "{0:.5f},{1}\n".format( self.relativeTime(seconds[n]) , values[n])
+			try:
+				self.outfile.write( strfmt )
+			except ValueError:
+				logger.log("Write to file failed", self.filename, logger.WARNING)
+	#function AnalogIn.add(Int Val, Int ticks) Add a value to this channel's history.
+	# ticks = the device ticks since the first sync, from PropCom.streamTicks
 	#If there is sufficient data, AnalogIn.flush is called.
-	def add(self, Val, tStamp, rTime):
+	def add(self, Val, ticks):
 		"""add a value into the data queue"""
-		data = (tStamp, rTime, Val)
-		if logger.options["log_points"]:
-			logger.write(self.name + " + (" + str(data) +")")
-		self.values.append(data)
-		if len(self.values) > logger.options["buffer_size"]:
+		if logger.logPoints:
+			logger.write(self.name + " + (" + str((ticks, Val)) +")")
+		self.history.append(Val, ticks)
+		self.unflushed += 1
+		self.unpyramided += 1
+		if self.unflushed > logger.options["buffer_size"]:
+			self.flush()
+		if self.unpyramided >= self.pyramidBatch:
+			self.feedPyramid()
+	#function AnalogIn.addMany(numpy.ndarray values, numpy.ndarray ticks) Add the samples of a packet to this channel's history, like AnalogIn.add.
+	def addMany(self, values, ticks):
+		if logger.logPoints:
+			for data in zip(ticks.tolist(), values.tolist()):
+				logger.write(self.name + " + (" + str(data) +")")
+		self.store(values, ticks)
+	#function AnalogIn.store(numpy.ndarray values, numpy.ndarray ticks) AnalogIn.addMany without the logging: add the samples to the history, and flush and feed the pyramid when due.
+	def store(self, values, ticks):
+		self.history.extend(values, ticks)
+		self.unflushed += len(values)
+		self.unpyramided += len(values)
+		if self.unflushed > logger.options["buffer_size"]:
 			self.flush()
+		if self.unpyramided >= self.pyramidBatch:
+			self.feedPyramid()
+	#function AnalogIn.feedPyramid() Add the samples in history not yet in the pyramid, in whole level 0 buckets. The rest wait for the next batch.
+	def feedPyramid(self):
+		size = self.pyramid.levels[0].size
+		n = min(self.unpyramided, self.history.count)
+		n -= n % size
+		if n == 0:
+			return
+		ticks, values = self.history.last(self.unpyramided)
+		self.pyramid.extend(values[:n], ticks[:n])
+		self.unpyramided -= n
+	#function AnalogIn.last(Int n) return (numpy.ndarray, numpy.ndarray) views of the ticks and values of the last *n* samples, see samplering.SampleRing.last
+	def last(self, n):
+		return self.history.last(n)
+	#function AnalogIn.window(Int t0, Int t1) return (numpy.ndarray, numpy.ndarray) views of the ticks and values of the samples from ticks *t0* up to *t1*, see samplering.SampleRing.window
+	# Use PropCom.streamTicks or the tstamps given to hooks for ticks.
+	def window(self, t0, t1):
+		return self.history.window(t0, t1)
+	#function AnalogIn.buckets(Int t0, Int t1, Int n) return (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray) the ticks, mins, maxs and means of at most *n* buckets covering ticks *t0* up to *t1*, for plotting.
+	# Each bucket's ticks are those of its first sample. A plot draws a line through the means, or fills between the mins and maxs so no spike is lost.
+	# While the history still holds t0, the buckets are made from its samples, one per sample if there are no more than n.
+	# Further back, they come from the pyramid, at the finest level that fits in n buckets, so an 8 hour plot touches a few thousand values
+	# whatever the sample rate. The pyramid lags the history by up to pyramid_batch samples.
+	def buckets(self, t0, t1, n):
+		n = max(int(n), 1)
+		history = self.history
+		if history.count and (history.total == history.count or history.last(history.count)[0][0] <= t0):
+			ticks, values = history.window(t0, t1)
+			if len(values) <= n:
+				return ticks, values, values, values.astype(numpy.float32)
+			size = 1 << int(math.ceil(math.log(len(values) / float(n), 2)))
+			whole = len(values) - len(values) % size
+			rows = values[:whole].reshape(-1, size)
+			mins, maxs, means = rows.min(1), rows.max(1), rows.mean(1, dtype=numpy.float32)
+			if whole < len(values):
+				rest = values[whole:]
+				mins = numpy.append(mins, rest.min())
+				maxs = numpy.append(maxs, rest.max())
+				means = numpy.append(means, numpy.float32(rest.mean()))
+			return ticks[::size], mins, maxs, means
+		found = self.pyramid.buckets(t0, t1, n)
+		if found is None:
+			empty = numpy.zeros(0, dtype=numpy.uint16)
+			return numpy.zeros(0, dtype=numpy.int64), empty, empty, numpy.zeros(0, dtype=numpy.float32)
+		return found
 	
 
@@ -0,0 +1,88 @@
+import collections
+import time
+
+import numpy
+
+# clockmodel.py Converts device clock ticks to seconds with a model of the device clock fitted from sync packets.
+# The Propeller's 80MHz crystal runs a little fast or slow, and its rate wanders with temperature. Dividing ticks by CLOCKPERSEC
+# drifts away from the host clock by that much, tens of milliseconds an hour for a crystal off by 10ppm.
+# Every sync packet pairs the device's tick count with the host time it arrived. ClockModel fits a line through the last
+# *window* of these pairs by least squares:
+#	seconds = mid seconds + slope * (ticks - mid ticks)
+# The slope tracks the drift, and the fit averages out the jitter of the arrival times.
+# Seconds are counted from the first sync, like PropCom.curTime.
+# A sync that lands further than *outlier* seconds from the line is not used, e.g. one that waited behind a busy dispatcher.
+# One further than *reset* seconds means the clock jumped (the device restarted, or the host clock was set). The model then
+# starts over from that sync, and the seconds it returns step to the host clock, as PropCom.onSync used to do.
+
+# class ClockModel A fitted line from device ticks to seconds since the first sync.
+class ClockModel():
+	# constructor ClockModel( Int clockPerSec, Int window, Float outlier, Float reset, Int minSyncs ) return ClockModel a model with no syncs yet
+	# minSyncs = syncs needed before the slope is fitted. Fewer than that keep the nominal slope 1/clockPerSec and only fit the offset.
+	def __init__(self, clockPerSec=80000000, window=300, outlier=0.05, reset=1.0, minSyncs=10):
+		self.nominal = 1.0 / clockPerSec
+		self.window = max(int(window), 2)
+		self.outlier = outlier
+		self.reset = reset
+		self.minSyncs = max(int(minSyncs), 2)
+		self.syncs = collections.deque(maxlen=self.window)	# (ticks, host seconds since the first sync)
+		self.fit = (0, 0.0, self.nominal)	# (mid ticks, mid seconds, seconds per tick), replaced whole so readers need no lock
+		self.firstHost = None	# host time of the first sync
+		self.jitter = 0.0	# RMS distance of the syncs in the window from the line, in seconds
+		self.outliers = 0	# syncs not used
+		self.resets = 0		# times the model started over
+		self.skipped = 0	# outliers in a row
+
+	# function ClockModel.add( Int ticks, Float hostTime ) return Float how far the sync was from the line, in seconds. Positive if it arrived late.
+	# ticks = device ticks since the first sync, unwrapped
+	# hostTime = time.time() when the sync arrived
+	def add(self, ticks, hostTime=None):
+		if hostTime is None:
+			hostTime = time.time()
+		if self.firstHost is None:
+			self.firstHost = hostTime - ticks * self.nominal
+		host = hostTime - self.firstHost
+		error = host - self.seconds(ticks)
+		if self.syncs and abs(error) > self.outlier:
+			self.skipped += 1
+			if abs(error) <= self.reset and self.skipped < self.minSyncs:
+				self.outliers += 1
+				return error
+			# the clock jumped, or the line is wrong: start over from here
+			self.resets += 1
+			self.syncs.clear()
+		self.skipped = 0
+		self.syncs.append((ticks, host))
+		self.refit()
+		return error
+
+	# function ClockModel.refit() Fit the line through the syncs in the window.
+	def refit(self):
+		ticks = numpy.array([s[0] for s in self.syncs], dtype=numpy.float64)
+		host = numpy.array([s[1] for s in self.syncs], dtype=numpy.float64)
+		midTicks = ticks.mean()
+		midHost = host.mean()
+		dt = ticks - midTicks
+		slope = self.nominal
+		if len(ticks) >= self.minSyncs:
+			sxx = (dt * dt).sum()
+			if sxx > 0:
+				slope = (dt * (host - midHost)).sum() / sxx
+		residuals = host - (midHost + slope * dt)
+		self.jitter = float(numpy.sqrt((residuals * residuals).mean()))
+		self.fit = (float(midTicks), float(midHost), float(slope))
+
+	# function ClockModel.seconds( Int|numpy.ndarray ticks ) return Float|numpy.ndarray seconds since the first sync for device ticks since the first sync.
+	# An array of ticks is converted in one call.
+	def seconds(self, ticks):
+		midTicks, midHost, slope = self.fit
+		return midHost + slope * (ticks - midTicks)
+
+	# function ClockModel.drift() return Float how much faster than nominal the device clock runs, in parts per million
+	def drift(self):
+		return (self.nominal / self.fit[2] - 1.0) * 1e6
+
+	# function ClockModel.stats() return Dict the drift, jitter and counters, for Metrics.snapshot
+	def stats(self):
+		return {"drift_ppm": self.drift(), "jitter_ms": self.jitter * 1000, "syncs": len(self.syncs),
+			"outliers": self.outliers, "resets": self.resets}
@@ -19,14 +19,56 @@ config.set("logging", "log_parsing", "False") # log the parsing process
 config.set("logging", "log_bad_checksum", "False") # log all bad checksums
 config.set("logging", "debug_points", "False") # add debug information about points (for graph tools/recordings)
 config.set("logging", "debug_dialog", "False") # Show dialog on debug packet
+config.set("logging", "log_flush_interval", ".5") # seconds between writes of queued log messages to the console and log file
+config.set("logging", "log_batch_size", "500") # queued messages that trigger a write before log_flush_interval
+config.set("logging", "log_queue_max", "10000") # messages that can wait to be written. Further messages are dropped and counted
+config.set("logging", "log_max_bytes", "1000000") # rotate the log file once it is this big. 0 for no limit
+config.set("logging", "log_rotate_seconds", "0") # rotate the log file once it is this many seconds old. 0 for never
+config.set("logging", "log_backups", "3") # rotated log files kept, as log.txt.1 (newest) to log.txt.3
+config.set("logging", "metrics_file", "metrics.txt") # File > Save Metrics appends a JSON snapshot of the protocol counters here
+config.set("logging", "flight_records", "8192") # packets and events kept in memory by the flight recorder. 0 turns it off
+config.set("logging", "flight_slot_bytes", "128") # bytes per flight recorder record, 34 of them header. Longer packets are cut short
+config.set("logging", "flight_file", "flight-%Y%m%d-%H%M%S.bin") # flight recorder dumps go here, formatted by time.strftime. Decode with python flightrec.py
+config.set("logging", "flight_dump_interval", "10") # least seconds between automatic flight recorder dumps
+config.set("logging", "flight_bad_checksum_burst", "5") # bad checksums within a second that dump the flight recorder. 0 for never
 
 config.add_section("com")
 config.set("com", "baud", "115200") #baud rate
-config.set("com", "timeout", ".5") # timeout for initial port communication test
+config.set("com", "timeout", "2") # seconds to wait for any port to answer a version request when searching for the device
+config.set("com", "probe_interval", ".25") # seconds between version requests while searching for the device or waiting for it to boot
+config.set("com", "handshake_timeout", "5") # seconds to keep sending version after the port opens, until the device answers
+config.set("com", "state_file", "state.txt") # remembers the port, USB ids and firmware version of the last device found, to try it first. Empty to always search every port
+config.set("com", "verify_timeout", "2") # seconds the remembered port gets to answer before every port is searched
+config.set("com", "auto_reconnect", "True") # search for the device again when its port fails, and restore the rates, averaging, digital directions and started channels
+config.set("com", "reconnect_timeout", "30") # seconds to keep searching before giving up on a lost device
+config.set("com", "clock_window", "300") # sync packets, one a second, that the device clock model is fitted over
+config.set("com", "clock_outlier", ".05") # seconds a sync can be off the clock model before it is left out of the fit
+config.set("com", "clock_reset", "1") # seconds a sync can be off the clock model before the model starts over from it
 config.set("com", "thread_sleep", ".1") # ??
 config.set("com", "flush", "1") # ??
 config.set("com", "ignore_checksum", "False") # Ignore bad checksums
 config.set("com", "buffer_size", "500") # buffer size for each channel
+config.set("com", "history_seconds", "60") # seconds of samples each analog input keeps in memory, for recordings and plugins
+config.set("com", "record_ticks", "False") # put the device clock ticks of each sample in a first column of analog input recordings
+config.set("com", "history_rate", "3000") # samples per second the history is sized for. Each sample kept takes 20 bytes
+config.set("com", "pyramid_levels", "16") # levels of min/max/mean buckets kept for plotting long runs, each with buckets twice the size of the one below. 16 reach back a month at 3000 samples per second, in 1.6 times the memory of the history
+config.set("com", "pyramid_batch", "1024") # samples an analog input collects before adding them to its bucket pyramid
+config.set("com", "read_mode", "bulk") # "bulk" drains everything waiting in one read, "byte" reads one byte per call
+config.set("com", "read_size", "4096") # largest chunk read in one call in bulk mode
+config.set("com", "read_timeout", ".1") # seconds a bulk read waits for data before checking that the port is still open
+config.set("com", "rx_buffer_size", "65536") # bytes in the receive ring that bulk reads go into
+config.set("com", "dispatch_threads", "1") # threads running packet callbacks. 0 runs them on the serial thread
+config.set("com", "queue_size", "1000") # stream packets that can wait for a dispatcher thread. Control packets are always queued
+config.set("com", "queue_policy", "drop_oldest") # when the queue is full of stream packets: block, drop_oldest or drop_newest
+config.set("com", "writer_thread", "True") # send control packets from a writer thread, merging superseded set and avg messages
+config.set("com", "send_dedupe_window", "0") # seconds a set or avg typed into the GUI and identical to the last one written is not sent again. 0 for never
+config.set("com", "request_timeout", ".5") # seconds to wait for the answer to a query before sending it again
+config.set("com", "request_retries", "2") # times an unanswered query is sent again before giving up
+config.set("com", "capture_file", "") # if set, every byte read from the device is recorded to this file
+config.set("com", "replay_file", "") # if set, this capture file is played back instead of opening a serial port
+config.set("com", "replay_speed", "1") # replay pace relative to the capture. 0 replays as fast as possible
+config.set("com", "acquisition_process", "False") # read and decode the serial port in a separate process
+config.set("com", "shm_ring_words", "262144") # 32-bit words in each stream's shared memory ring when acquisition_process is on
 
 config.read("config.txt")
 
@@ -0,0 +1,78 @@
+import ConfigParser
+
+import serial.tools.list_ports
+
+import logger
+
+# devicestate.py Remembers the last DataSpider found, in a small state file next to config.txt, so it can be found again quickly.
+# [device]
+# port = the port it answered on, like COM3 or /dev/ttyUSB0
+# vid, pid, serial_number = USB identity of the port's adapter, when the OS reports them. Used when the same adapter comes back under another name.
+# version = the firmware version from the version packet
+
+FIELDS = ["port", "vid", "pid", "serial_number", "version"]
+
+# function load( String fname ) return Dict the remembered device, or an empty Dict if there is none
+def load(fname):
+	state = ConfigParser.RawConfigParser()
+	try:
+		if not state.read(fname) or not state.has_section("device"):
+			return dict()
+		return dict(state.items("device"))
+	except ConfigParser.Error as e:
+		logger.log("Bad device state file", e, logger.WARNING)
+		return dict()
+
+# function save( String fname, Dict device ) Write *device* to the state file *fname*. Fields that are None are left out.
+def save(fname, device):
+	state = ConfigParser.RawConfigParser()
+	state.add_section("device")
+	for field in FIELDS:
+		if device.get(field) is not None:
+			state.set("device", field, str(device[field]))
+	try:
+		f = open(fname, "w")
+		try:
+			state.write(f)
+		finally:
+			f.close()
+	except IOError as e:
+		logger.log("Could not save device state", e, logger.WARNING)
+
+# function portInfo( String port ) return Dict the port name and the USB vid, pid and serial number of *port*, those that are known
+def portInfo(port):
+	info = {"port": port}
+	for p in serial.tools.list_ports.comports():
+		if p[0] == port:
+			for field in ["vid", "pid", "serial_number"]:
+				value = getattr(p, field, None)
+				if value is not None:
+					info[field] = value
+	return info
+
+# function findPort( Dict device, [ListPortInfo] ports ) return String|None the port among *ports* that is most likely the remembered *device*.
+# In order of preference: the same USB serial number, the same name with the same vid and pid, the first port with the same vid and pid, the same name.
+def findPort(device, ports):
+	if not device:
+		return None
+	byName = None
+	byID = None
+	byNameAndID = None
+	for p in ports:
+		vid = getattr(p, "vid", None)
+		pid = getattr(p, "pid", None)
+		serialNumber = getattr(p, "serial_number", None)
+		if serialNumber is not None and str(serialNumber) == device.get("serial_number"):
+			return p[0]
+		sameID = vid is not None and str(vid) == device.get("vid") and str(pid) == device.get("pid")
+		sameName = p[0] == device.get("port")
+		if sameID and sameName:
+			byNameAndID = p[0]
+		if sameID and byID is None:
+			byID = p[0]
+		if sameName:
+			byName = p[0]
+	for port in [byNameAndID, byID, byName]:
+		if port is not None:
+			return port
+	return None
@@ -0,0 +1,156 @@
+import collections
+import threading
+
+import logger
+
+# dispatch.py Decouples reading the serial port from running packet callbacks.
+# The serial thread only frames packets and puts them into a bounded PacketQueue.
+# One or more Dispatcher threads take them out and run the decoders and every registered callback,
+# so a slow plugin delays the dispatcher instead of the UART reader.
+# Packets can be views into the receive ring. Each is queued with its holder, the framing.RxBlock it is a view into,
+# and released once it has been dispatched or dropped, so the ring keeps those bytes until then. See framing.RxRing.hold.
+#
+# Only stream packets count towards the queue's size and are subject to its policy. Control packets (sync, info,
+# version and the answers to requests) are few, and losing one throws off the clock model, leaves a request waiting
+# or the channels out of step with the device, so they are always queued, in order with the stream packets.
+
+BLOCK = "block"			# the reader waits for room. The device may overflow instead.
+DROP_OLDEST = "drop_oldest"	# the oldest queued stream packet is thrown away to make room.
+DROP_NEWEST = "drop_newest"	# the stream packet being added is thrown away.
+POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+# class PacketQueue A thread-safe FIFO of packets, bounded in stream packets, with a configurable overflow policy.
+# Keeps counters of packets queued and dropped, and of the highest depth reached.
+class PacketQueue():
+	queued = 0	# packets accepted
+	dropped = 0	# stream packets thrown away because the queue was full
+	maxDepth = 0	# most packets waiting at once since the last resetStats
+
+	# constructor PacketQueue( Int maxsize, String policy, Function release ) return PacketQueue an empty queue
+	# maxsize = the most stream packets that can wait at once
+	# policy = one of BLOCK, DROP_OLDEST or DROP_NEWEST. Decides what put does with a stream packet when the queue is full.
+	# release = called with a list of the holders of packets dispatched or dropped, like framing.RxRing.release
+	def __init__(self, maxsize=1000, policy=DROP_OLDEST, release=None):
+		if policy not in POLICIES:
+			logger.log("Unknown queue policy, using " + DROP_OLDEST, policy, logger.WARNING)
+			policy = DROP_OLDEST
+		self.maxsize = max(int(maxsize), 1)
+		self.policy = policy
+		self.releaseHolders = release
+		self.packets = collections.deque()
+		self.holders = collections.deque()	# the holder of each packet in packets
+		self.streams = 0	# stream packets in packets
+		self.cond = threading.Condition(threading.Lock())
+		self.closed = False
+		self.queued = 0
+		self.dropped = 0
+		self.maxDepth = 0
+
+	# function PacketQueue.put( [String] packets, Object holder ) Add a batch of packets, applying the overflow policy to stream packets that do not fit.
+	# holder = what the packets are views into, or None. Released with each packet.
+	# The lock is taken once per batch, not once per packet.
+	def put(self, packets, holder=None):
+		dropped = []
+		with self.cond:
+			q = self.packets
+			holders = self.holders
+			for p in packets:
+				if ord(p[0]) & 128:
+					if self.streams >= self.maxsize:
+						if self.policy == DROP_OLDEST:
+							n = 0
+							while not ord(q[n][0]) & 128:	# control packets are kept
+								n += 1
+							del q[n]
+							dropped.append(holders[n])
+							del holders[n]
+							self.streams -= 1
+							self.dropped += 1
+						elif self.policy == DROP_NEWEST:
+							dropped.append(holder)
+							self.dropped += 1
+							continue
+						else:
+							while self.streams >= self.maxsize and not self.closed:
+								self.cond.notify()
+								self.cond.wait(0.1)
+							if self.closed:
+								dropped.append(holder)
+								continue
+					self.streams += 1
+				q.append(p)
+				holders.append(holder)
+				self.queued += 1
+			if len(q) > self.maxDepth:
+				self.maxDepth = len(q)
+			self.cond.notify()
+		if dropped:
+			self.release(dropped)
+
+	# function PacketQueue.get( Int most, Float timeout ) return ([String], [Object]) up to *most* packets, oldest first, and their holders.
+	# Waits up to *timeout* seconds for a packet. Returns empty lists on timeout or once the queue is closed.
+	# Pass the holders to PacketQueue.release once the packets have been dispatched.
+	def get(self, most=64, timeout=0.1):
+		with self.cond:
+			q = self.packets
+			holders = self.holders
+			if not q and not self.closed:
+				self.cond.wait(timeout)
+			batch = []
+			held = []
+			streams = 0
+			while q and len(batch) < most:
+				p = q.popleft()
+				if ord(p[0]) & 128:
+					streams += 1
+				batch.append(p)
+				held.append(holders.popleft())
+			self.streams -= streams
+			if streams and self.policy == BLOCK:
+				self.cond.notify_all()	# wake a reader waiting for room
+			return batch, held
+
+	# function PacketQueue.release( [Object] holders ) Release packets taken by get, or dropped, from their holders.
+	def release(self, holders):
+		if self.releaseHolders is not None:
+			self.releaseHolders(holders)
+
+	# function PacketQueue.depth() return Int the number of packets waiting
+	def depth(self):
+		return len(self.packets)
+
+	# function PacketQueue.stats() return Dict the current depth, capacity, policy and counters. maxsize is in stream packets, depth and max_depth count every packet.
+	def stats(self):
+		return {"depth": len(self.packets), "maxsize": self.maxsize, "policy": self.policy,
+			"queued": self.queued, "dropped": self.dropped, "max_depth": self.maxDepth}
+
+	# function PacketQueue.resetStats() Restart the high water mark from the current depth.
+	def resetStats(self):
+		self.maxDepth = len(self.packets)
+
+	# function PacketQueue.close() Wake up every thread waiting on the queue and make them return.
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+
+# class Dispatcher A thread that takes packets off a PacketQueue and hands them to PropCom.dispatch.
+class Dispatcher(threading.Thread):
+	# constructor Dispatcher( PropCom propCom, PacketQueue queue, Int n ) return Dispatcher a daemon thread, not yet started.
+	def __init__(self, propCom, queue, n=0):
+		threading.Thread.__init__(self, name="Dispatcher-" + str(n))
+		self.daemon = True
+		self.propCom = propCom
+		self.queue = queue
+
+	def run(self):
+		while not self.queue.closed:
+			batch, holders = self.queue.get()
+			if not batch:
+				continue
+			try:
+				self.propCom.dispatch(batch)
+			except Exception as e:
+				logger.log("Dispatcher error", e, logger.ERROR)
+			finally:
+				self.queue.release(holders)
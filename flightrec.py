@@ -0,0 +1,151 @@
+import struct
+import sys
+import time
+import itertools
+import threading
+
+# flightrec.py An always-on flight recorder: the last few thousand packets and events, kept in memory in a fixed-size ring of binary records.
+# PropCom records every packet it reads, and dumps the ring to a file when something goes wrong (see PropCom.flightEvent) or when asked from the File menu.
+# The ring is a bytearray of equal slots, one record per slot:
+#	UInt64 record number, Float64 host time, UInt8 kind, UInt8 message type, UInt8 channel, UInt8 flags (SYNCED once the first sync was seen),
+#	UInt32 device time of the last sync, Int64 clock ticks counted since the first sync, UInt16 length of the data,
+#	then the data itself, cut short if it does not fit the slot
+# all little endian. For packets the data is the raw packet, unescaped, without EOP and checksum. For events it is a text.
+# Recording a packet packs one header and copies the bytes, with no allocation per record.
+# Records are not locked. Two threads recording at once take different record numbers, so the worst that can happen is a slot overwritten early.
+#
+# A dump file starts with MAGIC and DUMP_HEAD (slot size, slot count, records made), followed by the slots as they were in memory.
+# usage: python flightrec.py dumpfile	prints every record of a dump, oldest first
+
+MAGIC = "SPFLT1\n"
+DUMP_HEAD = struct.Struct("<IIQ")
+HEAD = struct.Struct("<QdBBBBIqH")
+
+STREAM = 0
+CONTROL = 1
+EVENT = 2
+KINDS = ["stream", "control", "event"]
+NO_CHANNEL = 255
+SYNCED = 1
+
+# class FlightRecorder The ring of records.
+class FlightRecorder():
+	# constructor FlightRecorder( Int nSlots, Int slotSize ) return FlightRecorder an empty ring holding the last *nSlots* records of at most *slotSize* bytes each
+	def __init__(self, nSlots=8192, slotSize=128):
+		self.slotSize = max(int(slotSize), HEAD.size + 8)
+		self.nSlots = max(int(nSlots), 1)
+		self.room = self.slotSize - HEAD.size	# data bytes kept per record
+		self.buf = bytearray(self.slotSize * self.nSlots)
+		self.counter = itertools.count()
+		self.count = 0		# records made
+		self.lastDump = 0	# host time of the last automatic dump
+
+	# function FlightRecorder.record( Int kind, Int msgType, Int channel, buffer data, Int lastSync, Int ticks ) Add a record, overwriting the oldest.
+	# kind = STREAM, CONTROL or EVENT
+	# msgType = the control message type, or the stream ID
+	# channel = the channel index the packet is about, or NO_CHANNEL
+	# lastSync, ticks = the sync state, PropCom.lastTime and PropCom.cnt
+	def record(self, kind, msgType, channel, data, lastSync=0, ticks=0, flags=0):
+		n = next(self.counter)
+		self.count = n + 1
+		offset = (n % self.nSlots) * self.slotSize
+		length = len(data)
+		HEAD.pack_into(self.buf, offset, n, time.time(), kind, msgType, channel, flags, lastSync & 0xFFFFFFFF, ticks, length)
+		if length > self.room:
+			data = data[:self.room]
+			length = self.room
+		offset += HEAD.size
+		self.buf[offset:offset+length] = data
+
+	# function FlightRecorder.snapshot() return String the dump file contents: MAGIC, DUMP_HEAD and a copy of the ring
+	def snapshot(self):
+		return MAGIC + DUMP_HEAD.pack(self.slotSize, self.nSlots, self.count) + bytes(self.buf)
+
+	# function FlightRecorder.dump( String fname, Bool wait ) Write a snapshot to the file *fname*.
+	# The ring is copied right away. The file is written on a new thread, unless *wait* is True.
+	def dump(self, fname, wait=False):
+		data = self.snapshot()
+		def write():
+			try:
+				f = open(fname, "wb")
+				try:
+					f.write(data)
+				finally:
+					f.close()
+			except IOError as e:
+				import logger
+				logger.log("Could not write flight recorder dump", e, logger.ERROR)
+		if wait:
+			write()
+			return
+		t = threading.Thread(target=write, name="FlightDump")
+		t.daemon = True
+		t.start()
+
+# function load( String fname ) return [(Int seq, Float t, Int kind, Int msgType, Int channel, Int flags, Int lastSync, Int ticks, Int length, String data)] the records of a dump, oldest first.
+# Raises IOError if *fname* is not a dump file.
+def load(fname):
+	f = open(fname, "rb")
+	try:
+		if f.read(len(MAGIC)) != MAGIC:
+			raise IOError("Not a flight recorder dump: " + fname)
+		slotSize, nSlots, count = DUMP_HEAD.unpack(f.read(DUMP_HEAD.size))
+		buf = f.read(slotSize * nSlots)
+	finally:
+		f.close()
+	records = []
+	for n in range(min(nSlots, len(buf) // slotSize)):
+		offset = n * slotSize
+		head = HEAD.unpack_from(buf, offset)
+		if head[1] == 0:
+			continue	# never written
+		kept = min(head[8], slotSize - HEAD.size)
+		records.append(head + (buf[offset+HEAD.size:offset+HEAD.size+kept],))
+	records.sort()
+	return records
+
+# function describe( Tuple record, [String] keyTable, Function decode ) return String one line of text for a record returned by load
+# keyTable = names of the control message types, Propeller.keyTable
+# decode = if given, whole stream packets are shown decoded by it, like streamdecode.decode, rather than in hex
+def describe(record, keyTable=None, decode=None):
+	seq, t, kind, msgType, channel, flags, lastSync, ticks, length, data = record
+	line = "%8d %.6f %-7s" % (seq, t, KINDS[kind] if kind < len(KINDS) else str(kind))
+	if kind == EVENT:
+		return line + " " + data
+	if kind == CONTROL and keyTable is not None and msgType < len(keyTable):
+		line += " %-11s" % keyTable[msgType]
+	else:
+		line += " %-11s" % (("stream[%d]" % msgType) if kind == STREAM else str(msgType))
+	line += " ch=%-3s" % ("-" if channel == NO_CHANNEL else str(channel))
+	if flags & SYNCED:
+		line += " sync=%d ticks=%d" % (lastSync, ticks)
+	else:
+		line += " unsynced"
+	line += " len=%d" % length
+	if kind == CONTROL and len(data) >= 2:
+		words = [struct.unpack_from(">I", data, i)[0] for i in range(2, len(data) - 3, 4)]
+		line += " id=%d %s" % (ord(data[1]), words)
+	elif kind == STREAM and decode is not None and len(data) == length:
+		streamID, head, samples, tail = decode(data)
+		line += " %s" % (head + samples.tolist() + tail)
+	else:
+		line += " " + data.encode("hex")
+	if len(data) < length:
+		line += " (cut)"
+	return line
+
+def main():
+	if len(sys.argv) < 2:
+		print("usage: python flightrec.py dumpfile")
+		return
+	try:
+		from Propeller import keyTable
+		from streamdecode import decode
+	except Exception:
+		keyTable = None
+		decode = None
+	for record in load(sys.argv[1]):
+		print(describe(record, keyTable, decode))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,478 @@
+import struct
+import threading
+import time
+
+import logger
+
+# framing.py Splits the raw byte stream from the DataSpider into packets.
+# On the wire every packet is sent as
+#	<escaped packet bytes> EOP <checksum>
+# Any EOP or ESC inside the packet is preceded by an ESC. The checksum is a rotate-add over the escaped bytes, ESCs included.
+# A checksum of 0 means "not checked".
+
+EOP = ord("|")
+ESC = ord("`")
+
+MAX_PACKET = 800	# bytes of the longest packet on the wire: a stream packet of 255 samples, every byte escaped
+
+# ROTL[n] is the byte n rotated left by one bit. Used by the rotate-add checksum.
+ROTL = [((n<<1) | (n>>7)) & 255 for n in range(256)]
+
+# function checksum( String data, Int chksum ) return Int the rotate-add checksum of *data*, continuing from *chksum*
+def checksum(data, chksum=0):
+	rotl = ROTL
+	for c in bytearray(data):
+		chksum = (rotl[chksum] + c) & 255
+	return chksum
+
+# function encodePacket( String body ) return String *body* escaped and framed as it appears on the wire, followed by its checksum.
+def encodePacket(body):
+	if "`" in body or "|" in body:
+		body = body.replace("`", "``").replace("|", "`|")
+	return body + "|" + chr(checksum(body))
+
+# function controlPacket( Int nameNum, [Int] values, Int msgID ) return String an encoded control packet of message type *nameNum*, with one 4 byte word per value.
+def controlPacket(nameNum, values=(), msgID=0):
+	return encodePacket(chr(nameNum) + chr(msgID & 255) + "".join([struct.pack(">I", v & 0xFFFFFFFF) for v in values]))
+
+# class Encoder Builds control packets to send to the device.
+# Message type names are looked up in a dict, and the header and words of a packet are packed by a struct.Struct
+# that is compiled once for each number of words.
+class Encoder():
+	# constructor Encoder( [String] keyTable ) return Encoder an encoder for the message types in *keyTable*, indexed by message type ID
+	def __init__(self, keyTable):
+		self.keyNums = dict([(key, n) for n, key in enumerate(keyTable)])
+		self.structs = dict()
+
+	# function Encoder.encode( String|Int key, Int msgID, Int|[Int] value ) return String the packet as it goes on the wire.
+	# key = a message type name from keyTable, or a message type ID. Raises KeyError for an unknown name.
+	# value = None, one Int or a list of Ints. Each becomes a 4 byte word.
+	def encode(self, key, msgID, value=None):
+		if isinstance(key, basestring):
+			nameNum = self.keyNums[key]
+		else:
+			nameNum = key
+		if value is None:
+			words = ()
+		elif isinstance(value, (int, long, float)):
+			words = (int(value) & 0xFFFFFFFF,)
+		else:
+			words = [int(v) & 0xFFFFFFFF for v in value]
+		packer = self.structs.get(len(words))
+		if packer is None:
+			packer = self.structs[len(words)] = struct.Struct(">BB%dI" % len(words))
+		return encodePacket(packer.pack(nameNum, msgID & 255, *words))
+
+# function streamPacket( Int streamID, Int rate, Int tStamp, [Int] samples ) return String an encoded stream packet.
+# The packet holds the stream ID in 4 bits, then the rate and first timestamp in 32 bits each, every sample in 12 bits
+# and the timestamp of the last sample in 32 bits, zero padded to a whole byte. See streamdecode.py.
+def streamPacket(streamID, rate, tStamp, samples):
+	lastTStamp = (tStamp + rate*(len(samples)-1)) & 0xFFFFFFFF
+	bits = 8 | streamID
+	nBits = 4
+	for v, n in [(rate, 32), (tStamp, 32)] + [(s, 12) for s in samples] + [(lastTStamp, 32)]:
+		bits = (bits << n) | (v & ((1<<n) - 1))
+		nBits += n
+	if nBits % 8:
+		bits = bits << (8 - nBits % 8)
+		nBits += 8 - nBits % 8
+	return encodePacket("".join([chr((bits >> n) & 255) for n in range(nBits - 8, -8, -8)]))
+
+# class Framer A stateful packet framer. Bytes can be fed in chunks of any size, and a packet split across chunks
+# is picked up where the last chunk left off. Every byte is looked at exactly once.
+# Framer.feed returns the complete, unescaped packets that passed their checksum. Bad packets are counted and logged.
+class Framer():
+	SEEK = 0		# looking for an EOP to synchronise on
+	SKIP = 1		# the byte after the first EOP: the checksum of a packet we did not see
+	DATA = 2		# collecting packet bytes
+	CHECKSUM = 3		# the byte after an EOP: the checksum of the packet just collected
+
+	badChecksums = 0	# packets dropped because of a bad checksum
+	badStreamChecksums = 0	# the stream packets among badChecksums
+	moved = 0		# bytes moved within an RxRing to remove escapes
+	emptyPackets = 0	# packets dropped because they had no bytes
+	lastTrace = None	# trace of the last packet, only kept while tracing
+
+	# constructor Framer( Bool synced, Bool trace ) return Framer a new framer
+	# synced = if True the first byte fed starts a packet, as if an EOP and checksum had just been read. Otherwise bytes are skipped up to the first EOP.
+	# trace = record a human-readable trace of the parsing. By default tracing is on if the log_parsing option, or both log_bad_checksum and debug_checksum, are set.
+	def __init__(self, synced=True, trace=None):
+		self.badChecksums = 0
+		self.badStreamChecksums = 0
+		self.emptyPackets = 0
+		self.moved = 0
+		if trace is None:
+			trace = logger.logParsing or (logger.logBadChecksum and logger.debugChecksum)
+		self.setTracing(trace)
+		self.reset(synced)
+
+	# function Framer.reset( Bool synced ) Drop any partially collected packet.
+	def reset(self, synced=True):
+		if synced:
+			self.state = self.DATA
+		else:
+			self.state = self.SEEK
+		self.packet = bytearray()
+		self.chksum = 0
+		self.escaped = False
+		self.trace = []
+		self.shift = 0
+
+	# function Framer.setTracing( Bool on ) Switch between the fast feed and the tracing feed.
+	def setTracing(self, on):
+		self.tracing = on
+		if on:
+			self.feed = self.feedTraced
+		else:
+			self.feed = self.feedFast
+			self.lastTrace = None
+
+	# function Framer.feed( String data ) return [String] all packets completed by *data*, unescaped and checksum-verified.
+	# Bound to feedFast or feedTraced by setTracing.
+	def feed(self, data):
+		return self.feedFast(data)
+
+	# function Framer.feedFast( String data ) Framer.feed without tracing.
+	# Runs of plain packet bytes are found with bytearray.find and copied as one slice.
+	def feedFast(self, data):
+		if not isinstance(data, bytearray):
+			data = bytearray(data)
+		packets = []
+		state = self.state
+		packet = self.packet
+		chksum = self.chksum
+		escaped = self.escaped
+		rotl = ROTL
+		n = len(data)
+		i = 0
+		nextEOP = -1
+		nextESC = -1
+		while i < n:
+			if state == self.DATA:
+				if escaped:
+					c = data[i]
+					i += 1
+					packet.append(c)
+					chksum = (rotl[chksum] + c) & 255
+					escaped = False
+					continue
+				if nextEOP < i:
+					nextEOP = data.find(b"|", i)
+					if nextEOP == -1:
+						nextEOP = n
+				if nextESC < i:
+					nextESC = data.find(b"`", i)
+					if nextESC == -1:
+						nextESC = n
+				end = min(nextEOP, nextESC)
+				if end > i:
+					run = data[i:end]
+					for c in run:
+						chksum = (rotl[chksum] + c) & 255
+					packet += run
+					i = end
+					if i == n:
+						break
+				c = data[i]
+				i += 1
+				if c == EOP:
+					state = self.CHECKSUM
+				else:
+					escaped = True
+					chksum = (rotl[chksum] + c) & 255
+			elif state == self.CHECKSUM:
+				self.finish(bytes(packet), chksum, data[i], packets)
+				i += 1
+				packet = bytearray()
+				chksum = 0
+				state = self.DATA
+			elif state == self.SKIP:
+				i += 1
+				state = self.DATA
+			else: # SEEK
+				i = data.find(b"|", i) + 1
+				if i == 0:
+					break
+				state = self.SKIP
+		self.state = state
+		self.packet = packet
+		self.chksum = chksum
+		self.escaped = escaped
+		return packets
+
+	# function Framer.feedTraced( String data ) Framer.feed, recording a trace of every byte.
+	# The trace uses the same notation as the original parser:
+	# { first EOP, - skipped byte, $(n) skipped checksum, c(n). packet byte, / escape, } end of packet, #(n) checksum
+	def feedTraced(self, data):
+		packets = []
+		trace = self.trace
+		for c in bytearray(data):
+			if self.state == self.DATA:
+				if self.escaped or (c != EOP and c != ESC):
+					self.packet.append(c)
+					self.chksum = (ROTL[self.chksum] + c) & 255
+					self.escaped = False
+					trace.append(chr(c).replace("\a","@") + "(" + str(c) + ").")
+				elif c == EOP:
+					self.state = self.CHECKSUM
+					trace.append("}")
+				else:
+					self.escaped = True
+					self.chksum = (ROTL[self.chksum] + c) & 255
+					trace.append("/")
+			elif self.state == self.CHECKSUM:
+				trace.append("#(" + str(c) + ")")
+				self.lastTrace = "".join(trace).replace("\n","@").replace("\r","@")
+				if logger.logParsing:
+					logger.write("parsed:[[" + self.lastTrace + "]]")
+				self.finish(bytes(self.packet), self.chksum, c, packets)
+				self.packet = bytearray()
+				self.chksum = 0
+				self.state = self.DATA
+				trace = self.trace = []
+			elif self.state == self.SKIP:
+				trace.append("$(" + str(c) + ")")
+				self.state = self.DATA
+			elif c == EOP: # SEEK
+				trace.append("{")
+				self.state = self.SKIP
+			else:
+				trace.append("-")
+		return packets
+
+	# function Framer.feedRing( RxRing ring ) return [memoryview] all packets completed by the bytes committed to *ring* since the last call.
+	# Works like feedFast, but packets are returned as views into the ring buffer instead of copies.
+	# Escapes are removed in place: the packet bytes after an ESC are moved down over it, so the unescaped packet
+	# is always view[mark:i-shift]. The bytes written never reach past the byte being read.
+	# The views stay valid until the next RxRing.reserve, or until they are released if they are held. While tracing, this falls back to feedTraced.
+	#
+	# The checksum is a Python loop over each run of plain bytes. It cannot be done a run at a time, since each step
+	# depends on the last. Iterating a slice of the run is faster than indexing the ring with xrange, see benchChecksumLoop in benchmark.py.
+	def feedRing(self, ring):
+		if self.tracing:
+			packets = self.feedTraced(ring.view[ring.pos:ring.end])
+			ring.mark = ring.pos = ring.end
+			return packets
+		packets = []
+		buf = ring.buf
+		view = ring.view
+		state = self.state
+		shift = self.shift	# escapes removed from the packet being collected
+		chksum = self.chksum
+		escaped = self.escaped
+		rotl = ROTL
+		mark = ring.mark
+		i = ring.pos
+		n = ring.end
+		nextEOP = -1
+		nextESC = -1
+		while i < n:
+			if state == self.DATA:
+				if escaped:
+					c = buf[i]
+					buf[i-shift] = c
+					self.moved += 1
+					i += 1
+					chksum = (rotl[chksum] + c) & 255
+					escaped = False
+					continue
+				if nextEOP < i:
+					nextEOP = buf.find(b"|", i, n)
+					if nextEOP == -1:
+						nextEOP = n
+				if nextESC < i:
+					nextESC = buf.find(b"`", i, n)
+					if nextESC == -1:
+						nextESC = n
+				end = min(nextEOP, nextESC)
+				if end > i:
+					for c in buf[i:end]:
+						chksum = (rotl[chksum] + c) & 255
+					if shift:
+						view[i-shift:end-shift] = view[i:end]	# memoryview assignment copes with the overlap
+						self.moved += end - i
+					i = end
+					if i == n:
+						break
+				c = buf[i]
+				i += 1
+				if c == EOP:
+					state = self.CHECKSUM
+				else:
+					escaped = True
+					shift += 1
+					chksum = (rotl[chksum] + c) & 255
+			elif state == self.CHECKSUM:
+				self.finish(view[mark:i-1-shift], chksum, buf[i], packets)	# i-1 is the EOP
+				i += 1
+				shift = 0
+				chksum = 0
+				mark = i
+				state = self.DATA
+			elif state == self.SKIP:
+				i += 1
+				mark = i
+				state = self.DATA
+			else: # SEEK
+				i = buf.find(b"|", i, n) + 1
+				if i == 0:
+					i = n
+					mark = n
+					break
+				mark = i
+				state = self.SKIP
+		self.state = state
+		self.shift = shift
+		self.chksum = chksum
+		self.escaped = escaped
+		ring.mark = mark
+		ring.pos = i
+		return packets
+
+	# function Framer.finish( String packet, Int chksum, Int chk, [String] packets ) Check a collected packet and append it to *packets* if it is good.
+	# chksum = the checksum calculated over the packet
+	# chk = the checksum byte sent after the packet
+	def finish(self, packet, chksum, chk, packets):
+		if len(packet) < 1:
+			self.emptyPackets += 1
+			logger.log( "Bad Packet","No bytes!", logger.WARNING)
+		elif chk != chksum and chk != 0 and not logger.options["ignore_checksum"]:
+			self.badChecksums += 1
+			stream = bytearray(packet[:1])[0] & 128
+			if stream:
+				self.badStreamChecksums += 1
+			if logger.logBadChecksum:
+				if stream:
+					logger.write("BAD CHECKSUM! (stream)")
+				else:
+					logger.write("BAD CHECKSUM! (control)")
+				logger.write( "sent:"+str(chk)+" calculated:"+str(chksum))
+				if logger.debugChecksum and self.lastTrace is not None:
+					logger.write(self.lastTrace)
+		else:
+			packets.append(packet)
+
+
+# class RxBlock One buffer of an RxRing, with a count of the packets in it that are still in use.
+class RxBlock():
+	# constructor RxBlock( Int size ) return RxBlock a buffer of *size* bytes with no packets held
+	def __init__(self, size):
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+		self.held = 0	# packets handed out as views into buf and not yet released, see RxRing.hold
+
+# class RxRing A preallocated receive buffer the serial port is read into directly.
+# The framer scans it in place and hands out packets as memoryview slices of it.
+# Bytes before *mark* (the start of the packet being collected) are no longer needed. When there is too little room
+# left at the end, the bytes from *mark* on are moved to the front. Only that partial packet is copied.
+# Packets queued for another thread are held, see RxRing.hold. While any are, the buffer is not overwritten:
+# the partial packet moves to the front of another buffer instead, a spare one if all its packets have been released,
+# or else a new one. Without a queue nothing is held, and a single buffer is reused.
+# At most maxSpares spares are kept, see RxRing.limitSpares. Buffers beyond that are dropped once they are switched away from,
+# and freed when their last packet is released, so a stalled dispatcher does not leave the ring bigger for the rest of the session.
+class RxRing():
+	copied = 0	# bytes moved by compaction
+	allocated = 0	# buffers allocated after the first, because every spare was still held
+
+	# constructor RxRing( Int size ) return RxRing an empty receive buffer of *size* bytes
+	def __init__(self, size=65536):
+		self.size = size
+		self.block = RxBlock(size)	# the buffer being read into
+		self.buf = self.block.buf
+		self.view = self.block.view
+		self.spares = []	# buffers left with packets still held
+		self.maxSpares = 1
+		self.lock = threading.Lock()	# guards RxBlock.held
+		self.mark = 0	# start of the bytes the framer still needs
+		self.pos = 0	# next byte for the framer to look at
+		self.end = 0	# end of the bytes read so far
+		self.copied = 0
+		self.allocated = 0
+		self.lastCopied = 0
+		self.lastCopyTime = time.time()
+
+	# function RxRing.reserve( Int want ) return memoryview room for up to *want* more bytes, to be filled by readinto and passed to RxRing.commit.
+	# If *want* bytes do not fit at the end, the partial packet is moved to the front first.
+	# If the partial packet fills the whole buffer it is garbage: the buffer is emptied and an empty view is returned, so the caller can resync its framer.
+	def reserve(self, want):
+		if self.size - self.end < want and self.mark > 0:
+			kept = self.end - self.mark
+			old = self.view
+			if self.block.held:
+				self.switch()
+			if old is self.view and kept > self.mark:	# overlapping, copy out first
+				self.buf[0:kept] = old[self.mark:self.end].tobytes()
+			else:
+				self.buf[0:kept] = old[self.mark:self.end]
+			self.copied += kept
+			self.pos -= self.mark
+			self.end = kept
+			self.mark = 0
+		if self.end == self.size:
+			self.clear()
+			return self.view[0:0]
+		return self.view[self.end:min(self.size, self.end + want)]
+
+	# function RxRing.switch() Read into a buffer with no packets held from now on, a spare one if there is one. The current buffer becomes a spare.
+	def switch(self):
+		block = None
+		for spare in self.spares:
+			if spare.held == 0:
+				block = spare
+				break
+		if block is None:
+			block = RxBlock(self.size)
+			self.allocated += 1
+		else:
+			self.spares.remove(block)
+		self.spares.append(self.block)
+		if len(self.spares) > self.maxSpares:
+			released = [spare for spare in self.spares if spare.held == 0]
+			for spare in (released + self.spares)[:len(self.spares) - self.maxSpares]:	# released ones first, then the oldest
+				self.spares.remove(spare)
+		self.block = block
+		self.buf = block.buf
+		self.view = block.view
+
+	# function RxRing.limitSpares( Int packets ) Keep only as many spare buffers as *packets* packets of up to MAX_PACKET bytes can fill, plus one.
+	def limitSpares(self, packets):
+		self.maxSpares = int(packets) * MAX_PACKET // self.size + 1
+
+	# function RxRing.commit( Int n ) Mark *n* more bytes of the last reserved view as read.
+	def commit(self, n):
+		self.end += n
+
+	# function RxRing.clear() Drop everything in the buffer.
+	def clear(self):
+		if self.block.held:
+			self.switch()
+		self.mark = 0
+		self.pos = 0
+		self.end = 0
+
+	# function RxRing.hold( Int n ) return RxBlock the buffer the last packets framed are views into, now holding *n* more of them.
+	# Every packet held must be released once it is no longer used, see RxRing.release.
+	def hold(self, n):
+		block = self.block
+		with self.lock:
+			block.held += n
+		return block
+
+	# function RxRing.release( [RxBlock] blocks ) Release one held packet from each of *blocks*. None entries, for packets that were never held, are skipped.
+	def release(self, blocks):
+		with self.lock:
+			for block in blocks:
+				if block is not None:
+					block.held -= 1
+
+	# function RxRing.copyRate( Framer framer ) return Float bytes copied per second since the last call, by compaction and by *framer* removing escapes.
+	# In the steady state this should be close to zero.
+	def copyRate(self, framer=None):
+		copied = self.copied
+		if framer is not None:
+			copied += framer.moved
+		now = time.time()
+		rate = (copied - self.lastCopied) / max(now - self.lastCopyTime, 1e-6)
+		self.lastCopied = copied
+		self.lastCopyTime = now
+		return rate
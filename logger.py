@@ -1,4 +1,8 @@
-import wx
+import atexit
+import collections
+import os
+import threading
+import time
 import traceback
 
 VERSION = 0.1   # global version number
@@ -10,42 +14,195 @@ QUESTION = 4
 
 options = dict()
 outFile = None
+writer = None	# the LogWriter thread, once setOptions has started it
+dropped = 0	# messages thrown away because log_queue_max were already waiting
+
+# Logging flags, resolved from the options by logger.resolve. Hot loops test these module globals, or a local copy made before the loop,
+# rather than looking the option up for every byte or sample.
+console = False		# console
+logSync = False		# log_sync
+logPoints = False	# log_points
+logStream = False	# log_stream
+logControl = False	# log_control
+logMsg = False		# log_msg
+logSent = False		# log_sent
+logBuffer = False	# log_buffer
+logParsing = False	# log_parsing
+logBadChecksum = False	# log_bad_checksum
+debugChecksum = False	# debug_checksum
+debugPoints = False	# debug_points
 
 #function logger.setOptions( Dict ) Sets the global option dicsionary to the given Dict.
+# The log file is opened for appending, and messages are written from then on by a LogWriter thread.
 def setOptions( o ):
 	global outFile
 	global options
+	global writer
 	options = o
+	resolve()
+	if writer is not None:
+		writer.stop()
+		writer = None
 	# open the outfile
 	try:
 		fname = options["file"]
-		outFile = open(fname, "w")
+		outFile = open(fname, "a")
 	except KeyError:
 		outFile = None
-	except OSError:
+	except (IOError, OSError):
 		outFile = None
+	if outFile is not None or console:
+		writer = LogWriter(outFile)
+		writer.start()
+
+#function logger.resolve() Set the logging flags from the options. Called by setOptions. Call it again after changing a log option in place, or use setOption.
+def resolve():
+	global console, logSync, logPoints, logStream, logControl, logMsg, logSent, logBuffer, logParsing, logBadChecksum, debugChecksum, debugPoints
+	console = bool(options.get("console", False))
+	logSync = bool(options.get("log_sync", False))
+	logPoints = bool(options.get("log_points", False))
+	logStream = bool(options.get("log_stream", False))
+	logControl = bool(options.get("log_control", False))
+	logMsg = bool(options.get("log_msg", False))
+	logSent = bool(options.get("log_sent", False))
+	logBuffer = bool(options.get("log_buffer", False))
+	logParsing = bool(options.get("log_parsing", False))
+	logBadChecksum = bool(options.get("log_bad_checksum", False))
+	debugChecksum = bool(options.get("debug_checksum", False))
+	debugPoints = bool(options.get("debug_points", False))
+
+#function logger.setOption( String name, Anything value ) Change one option, and the logging flags with it.
+def setOption(name, value):
+	options[name] = value
+	resolve()
 
-# function logger.close() Close any open files
+# function logger.close() Write out everything queued, stop the writer thread and close any open files
 def close():
+	global writer
+	if writer is not None:
+		writer.stop()
+		writer = None
 	if outFile is not None:
 		outFile.close()
 
+atexit.register(close) # so queued messages are written even if close is never called
+
+# class LogWriter The thread that writes log messages to the console and the log file, in batches.
+# logger.write only turns the message into a string and appends it to a deque, so the serial and dispatcher threads never wait on the disk or the console.
+# The queue is written out every log_flush_interval seconds, or as soon as log_batch_size messages are waiting.
+# At most log_queue_max messages wait. Beyond that they are dropped and counted in logger.dropped, and a warning saying how many is logged once the queue drains.
+# The log file is rotated when it grows past log_max_bytes, or is older than log_rotate_seconds: log.txt becomes log.txt.1, log.txt.1 becomes log.txt.2, and so on up to log_backups files.
+class LogWriter(threading.Thread):
+	def __init__(self, f):
+		threading.Thread.__init__(self, name="LogWriter")
+		self.daemon = True
+		self.f = f
+		self.queue = collections.deque()	# (String text, Bool sameLine)
+		self.wake = threading.Event()
+		self.running = True
+		self.interval = float(options.get("log_flush_interval", 0.5))
+		self.batchSize = int(options.get("log_batch_size", 500))
+		self.maxQueued = int(options.get("log_queue_max", 10000))
+		self.maxBytes = int(options.get("log_max_bytes", 0))
+		self.rotateSeconds = float(options.get("log_rotate_seconds", 0))
+		self.backups = int(options.get("log_backups", 3))
+		self.reportedDrops = 0
+		self.opened = time.time()
+		self.size = 0
+		if f is not None:
+			f.seek(0, 2)
+			self.size = f.tell()
+
+	# function LogWriter.put( String text, Bool sameLine ) Queue a message. Safe to call from any thread.
+	def put(self, text, sameLine):
+		global dropped
+		queue = self.queue
+		if len(queue) >= self.maxQueued:
+			dropped += 1
+			return
+		queue.append((text, sameLine))
+		if len(queue) == self.batchSize:
+			self.wake.set()
+
+	def run(self):
+		while self.running:
+			self.wake.wait(self.interval)
+			self.wake.clear()
+			self.flush()
+		self.flush()
+
+	# function LogWriter.flush() Write everything queued. Called on the writer thread.
+	def flush(self):
+		queue = self.queue
+		if dropped != self.reportedDrops:
+			queue.append(("(W)Log queue full: " + str(dropped - self.reportedDrops) + " messages dropped", False))
+			self.reportedDrops = dropped
+		if not queue:
+			return
+		parts = []
+		try:
+			while queue:
+				text, sameLine = queue.popleft()
+				if console:
+					if sameLine:
+						print(text),
+					else:
+						print text
+				parts.append(text if sameLine else text + "\n")
+		except IndexError:
+			pass
+		if self.f is None:
+			return
+		try:
+			data = "".join(parts)
+			self.f.write(data)
+			self.f.flush()
+			self.size += len(data)
+			if (self.maxBytes > 0 and self.size >= self.maxBytes) or (self.rotateSeconds > 0 and time.time() - self.opened >= self.rotateSeconds):
+				self.rotate()
+		except (IOError, OSError) as e:
+			print "Error writing to log:" + str(e)
+
+	# function LogWriter.rotate() Move the log file to the first backup and start a new one
+	def rotate(self):
+		global outFile
+		fname = self.f.name
+		self.f.close()
+		for n in range(self.backups - 1, 0, -1):
+			if os.path.exists(fname + "." + str(n)):
+				if os.path.exists(fname + "." + str(n + 1)):
+					os.remove(fname + "." + str(n + 1))
+				os.rename(fname + "." + str(n), fname + "." + str(n + 1))
+		if self.backups > 0:
+			if os.path.exists(fname + ".1"):
+				os.remove(fname + ".1")
+			os.rename(fname, fname + ".1")
+		self.f = outFile = open(fname, "w")
+		self.size = 0
+		self.opened = time.time()
+
+	# function LogWriter.stop() Write out what is queued and end the thread
+	def stop(self):
+		self.running = False
+		self.wake.set()
+		if self.isAlive() and threading.currentThread() is not self:
+			self.join(5.0)
+
 #function logger.write( String ) Write the string int the log as-is
+# The message is queued for the LogWriter thread, and written shortly after. Before setOptions, it is printed right away.
 def write( msg ,sameLine=False):
-	try:
-		if options["console"]:
-			if sameLine:
-				print(msg),
-			else:
-				print msg
-		if outFile is not None:
-			if sameLine:
-				outFile.write( str(msg) )
-			else:
-				outFile.write( str(msg) + "\n" )
-	except Exception as e:
-		print "Error writing to log:" + str(e)
-		pass
+	w = writer
+	if w is not None:
+		try:
+			w.put(str(msg), sameLine)
+		except Exception as e:
+			print "Error writing to log:" + str(e)
+		return
+	if console or not options:
+		if sameLine:
+			print(msg),
+		else:
+			print msg
 
 #function logger.log(String name, String options, Int mode) Add information to the log
 # name = The message to be logged
@@ -65,6 +222,7 @@ def log(name, options, mode=0):
 # message = The message to be displayed
 # mode = The logging level, 1-4, 1 being a serious error
 def message(message, mode=0):
+	import wx # imported on first use, so the logger works without wx (benchmarks, simulator)
 	if mode == ERROR:
 		wx.MessageBox(message, "Error", wx.OK | wx.ICON_ERROR)
 	elif mode == WARNING:
@@ -78,6 +236,7 @@ def message(message, mode=0):
 # message = the message to be displayed
 # mode = The logging level, 1-4, 1 being a serious error
 def ask(message, mode=4):
+	import wx
 	if mode == ERROR:
 		ret = wx.MessageBox(message, "Error", wx.YES_NO | wx.ICON_ERROR)
 	elif mode == WARNING:
@@ -77,6 +77,10 @@ class NewGui(GUI3.MainFrame):
 		global device
 		GUI3.MainFrame.__init__(self, parent, pluginTree) # superclass contructor
 		self.Bind( wx.EVT_CLOSE, self.OnClose )
+		# refresh the packet queue counters in the status bar once a second
+		self.statusTimer = wx.Timer(self)
+		self.Bind( wx.EVT_TIMER, self.OnStatusTimer, self.statusTimer )
+		self.statusTimer.Start(1000)
 	def buildSubMenu(self, node, parent):
 		"""items is a list of tuples to add or a module"""
 		logger.write( "Building Submenu:" )
@@ -137,6 +141,8 @@ class NewGui(GUI3.MainFrame):
 		rescan = wx.MenuItem( fileMenu, wx.ID_ANY, "Rescan", "Rescans for any attached devices", wx.ITEM_NORMAL )
 		sync = wx.MenuItem( fileMenu, wx.ID_ANY, "Sync", "Resyncs channel information between PC and device", wx.ITEM_NORMAL )
 		reloadtools = wx.MenuItem( fileMenu, wx.ID_ANY, "Reload Plugins", "Rescans plugin directory and loads changes", wx.ITEM_NORMAL )
+		saveMetrics = wx.MenuItem( fileMenu, wx.ID_ANY, "Save Metrics", "Appends a snapshot of the protocol counters to the metrics file", wx.ITEM_NORMAL )
+		dumpFlight = wx.MenuItem( fileMenu, wx.ID_ANY, "Dump Flight Recorder", "Writes the last packets received to a file, for python flightrec.py", wx.ITEM_NORMAL )
 		exit = wx.MenuItem( fileMenu, wx.ID_ANY, "Exit", "Closes the application", wx.ITEM_NORMAL )
 		about = wx.MenuItem( helpMenu, wx.ID_ANY, "About", "About Box", wx.ITEM_NORMAL ) 
 
@@ -144,12 +150,16 @@ class NewGui(GUI3.MainFrame):
 		#fileMenu.AppendItem(rescan)
 		fileMenu.AppendItem(sync)
 		fileMenu.AppendItem(reloadtools)
+		fileMenu.AppendItem(saveMetrics)
+		fileMenu.AppendItem(dumpFlight)
 		fileMenu.AppendItem(exit)
 		helpMenu.AppendItem(about)
 		# bind items
 		self.Bind( wx.EVT_MENU, self.OnRescan, id=rescan.GetId() )
 		self.Bind( wx.EVT_MENU, self.OnSync, id=sync.GetId() )
 		self.Bind( wx.EVT_MENU, self.OnReload, id=reloadtools.GetId() )
+		self.Bind( wx.EVT_MENU, self.OnSaveMetrics, id=saveMetrics.GetId() )
+		self.Bind( wx.EVT_MENU, self.OnDumpFlightRecorder, id=dumpFlight.GetId() )
 		self.Bind( wx.EVT_MENU, self.OnExit, id=exit.GetId() )
 		self.Bind( wx.EVT_MENU, self.OnAbout, id=about.GetId() )
 		return menuBar
@@ -162,10 +172,32 @@ class NewGui(GUI3.MainFrame):
 		self.menuBar = self.createMenubar(pluginTree)
 		self.SetMenuBar( self.menuBar )
 		self.Fit()
+	def OnSaveMetrics( self, event):
+		fname = logger.options.get("metrics_file", "metrics.txt")
+		try:
+			device.propCom.metrics.save(fname)
+			self.statusBar.SetStatusText("Metrics saved to " + fname)
+		except IOError as e:
+			logger.log("Could not save metrics", e, logger.ERROR)
+	def OnDumpFlightRecorder( self, event):
+		fname = device.propCom.dumpFlightRecorder("File menu")
+		if fname is None:
+			self.statusBar.SetStatusText("The flight recorder is off (flight_records = 0)")
+		else:
+			self.statusBar.SetStatusText("Flight recorder dumped to " + fname)
 	def OnRescan( self, event):
 		global device
-		device.propCom = device.propCom.restart()
+		device.restart()
+	def OnStatusTimer( self, event):
+		if device is None:
+			return
+		stats = device.propCom.queueStats()
+		if stats is None:
+			return
+		self.statusBar.SetStatusText("Packet queue: %(depth)d/%(maxsize)d  peak %(max_depth)d  dropped %(dropped)d" % stats)
+		device.propCom.queue.resetStats() # peak is per refresh
 	def OnClose( self, event):
+		self.statusTimer.Stop()
 		self.Destroy()
 		logger.log("Frame closed", "", logger.INFO)
 		for ID,t in device.propCom.locks.iteritems():
@@ -212,7 +244,7 @@ class NewGui(GUI3.MainFrame):
 		global device
 		try:
 			value = float(self.widgets[idx].channelValue.GetValue())
-			device.channels[idx].setValue(value, True)
+			device.channels[idx].setValue(value, True, dedupe=True) # Enter and losing focus both get here
 			value = device.channels[idx].value
 		except ValueError:
 			self.widgets[idx].channelValue.SetLabel("NaN")
@@ -652,4 +684,5 @@ def main():
 	logger.close()
 
 # start program
-main()
+if __name__ == "__main__": # the acquisition process re-imports this module on Windows
+	main()
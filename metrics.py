@@ -0,0 +1,138 @@
+import json
+import time
+
+# metrics.py Protocol level counters for a PropCom.
+# Counters are plain attributes bumped by the thread that owns them (the reader or a dispatcher) with no locking.
+# Under the GIL an increment can only be lost when two dispatcher threads bump the same counter at once,
+# which is good enough for rates and trends. Framer and receive ring counters are read from them when a snapshot is taken.
+#
+# Plugins can read the counters through device.propCom.metrics:
+#	m = device.propCom.metrics.snapshot("myplugin")
+#	m["rates"]["stream_packets"], m["bad_checksums"]["control"], ...
+# Rates are kept per consumer, so a plugin polling the metrics does not shorten the window of the metrics file, or of another plugin.
+
+HISTOGRAM_BUCKETS = 24	# bucket n counts chunks parsed in [2^(n-1), 2^n) microseconds. The last bucket also takes anything slower.
+
+# class Metrics The metrics registry of one PropCom.
+class Metrics():
+	bytesRead = 0		# bytes read from the serial port
+	streamPackets = 0	# good stream packets
+	streamBytes = 0		# bytes in good stream packets, unescaped, without EOP and checksum
+	controlPackets = 0	# good control packets
+	controlBytes = 0	# bytes in good control packets
+	unknownIDs = 0		# control packets with a message type missing from keyTable
+	parseChunks = 0		# chunks timed in parseTimes
+	requestRetries = 0	# requests sent again for want of an answer
+	requestTimeouts = 0	# requests given up on
+
+	# constructor Metrics( PropCom propCom ) return Metrics a zeroed registry for *propCom*
+	def __init__(self, propCom):
+		self.propCom = propCom
+		self.reset()
+
+	# function Metrics.reset() Zero every counter and restart the rates.
+	def reset(self):
+		self.started = time.time()
+		self.bytesRead = 0
+		self.streamPackets = 0
+		self.streamBytes = 0
+		self.controlPackets = 0
+		self.controlBytes = 0
+		self.unknownIDs = 0
+		self.parseChunks = 0
+		self.parseTimes = [0] * HISTOGRAM_BUCKETS
+		self.requestRetries = 0
+		self.requestTimeouts = 0
+		self.roundTrips = dict()	# answer message type -> [count, total, min, max] seconds from request to answer
+		self.callbackErrors = dict()	# "message:function" -> exceptions raised
+		self.windows = dict()	# consumer -> (time, counts) of its last call to rates, see Metrics.rates
+		framer = self.propCom.framer
+		self.framerBase = (framer, framer.badChecksums, framer.badStreamChecksums, framer.emptyPackets)
+		self.ringBase = self.propCom.ring.allocated
+
+	# function Metrics.parseTime( Float seconds ) Add the time taken to parse one chunk to the histogram.
+	def parseTime(self, seconds):
+		n = int(seconds * 1000000).bit_length()
+		if n >= HISTOGRAM_BUCKETS:
+			n = HISTOGRAM_BUCKETS - 1
+		self.parseTimes[n] += 1
+		self.parseChunks += 1
+
+	# function Metrics.roundTrip( String name, Float seconds ) Add the round trip time of a request answered by a packet of type *name*.
+	def roundTrip(self, name, seconds):
+		rt = self.roundTrips.get(name)
+		if rt is None:
+			self.roundTrips[name] = [1, seconds, seconds, seconds]
+			return
+		rt[0] += 1
+		rt[1] += seconds
+		if seconds < rt[2]:
+			rt[2] = seconds
+		if seconds > rt[3]:
+			rt[3] = seconds
+
+	# function Metrics.roundTripStats() return Dict count, mean, min and max round trip in milliseconds, by answer message type
+	def roundTripStats(self):
+		stats = dict()
+		for name, (count, total, low, high) in self.roundTrips.items():
+			stats[name] = {"count": count, "mean": 1000 * total / count, "min": 1000 * low, "max": 1000 * high}
+		return stats
+
+	# function Metrics.callbackError( String name, Function func ) Count an exception raised by a registered callback or stream listener.
+	# name = the message type, or "stream[n]" for stream listeners
+	def callbackError(self, name, func):
+		key = name + ":" + getattr(func, "__name__", type(func).__name__)
+		self.callbackErrors[key] = self.callbackErrors.get(key, 0) + 1
+
+	# function Metrics.counts() return Dict the counters that have a per second rate
+	def counts(self):
+		return {"bytes": self.bytesRead,
+			"stream_packets": self.streamPackets, "stream_bytes": self.streamBytes,
+			"control_packets": self.controlPackets, "control_bytes": self.controlBytes}
+
+	# function Metrics.rates( String consumer ) return Dict per second rates of the counters in Metrics.counts since *consumer*'s last call, or since the last reset
+	# consumer = whoever is asking. Each consumer has its own window, so callers do not reset each other's rates.
+	def rates(self, consumer="default"):
+		now = time.time()
+		counts = self.counts()
+		lastTime, lastCounts = self.windows.get(consumer, (self.started, None))
+		dt = max(now - lastTime, 1e-6)
+		self.windows[consumer] = (now, counts)
+		if lastCounts is None:	# first call since the reset, which zeroed the counters
+			return dict([(k, v / dt) for k, v in counts.iteritems()])
+		return dict([(k, (v - lastCounts[k]) / dt) for k, v in counts.iteritems()])
+
+	# function Metrics.badChecksums() return Dict bad checksums by packet type ("stream" and "control") since the last reset
+	def badChecksums(self):
+		framer, bad, badStream, empty = self.framerBase
+		if framer is not self.propCom.framer:	# a new framer was made when the read loop started
+			framer, bad, badStream = self.propCom.framer, 0, 0
+		stream = framer.badStreamChecksums - badStream
+		return {"stream": stream, "control": framer.badChecksums - bad - stream}
+
+	# function Metrics.emptyPackets() return Int packets dropped for having no bytes since the last reset
+	def emptyPackets(self):
+		framer, bad, badStream, empty = self.framerBase
+		if framer is not self.propCom.framer:
+			return self.propCom.framer.emptyPackets
+		return framer.emptyPackets - empty
+
+	# function Metrics.snapshot( String consumer ) return Dict every counter, the rates since *consumer*'s last call to rates or snapshot, and the parse time histogram.
+	def snapshot(self, consumer="default"):
+		now = time.time()
+		return {"time": now, "uptime": now - self.started,
+			"totals": self.counts(), "rates": self.rates(consumer),
+			"bad_checksums": self.badChecksums(), "empty_packets": self.emptyPackets(),
+			"rx_buffers_allocated": self.propCom.ring.allocated - self.ringBase,
+			"unknown_ids": self.unknownIDs, "callback_errors": dict(self.callbackErrors),
+			"request_retries": self.requestRetries, "request_timeouts": self.requestTimeouts, "round_trip_ms": self.roundTripStats(),
+			"clock": self.propCom.clock.stats(),
+			"parse_chunks": self.parseChunks, "parse_time_us_log2": list(self.parseTimes)}
+
+	# function Metrics.save( String fname ) Append a snapshot to the file *fname*, as one line of JSON. Its rates are since the last save to the same file.
+	def save(self, fname):
+		f = open(fname, "a")
+		try:
+			f.write(json.dumps(self.snapshot("file:" + fname), sort_keys=True) + "\n")
+		finally:
+			f.close()
@@ -0,0 +1,258 @@
+import collections
+import threading
+import time
+
+import logger
+
+# outbound.py Sends control packets from a single writer thread.
+# PropCom.send puts messages into an Outbox and returns a SendFuture right away. The Writer thread takes
+# everything waiting, encodes it and writes it to the port in one call.
+# While a message waits, a newer message that supersedes it replaces it in place:
+#	("set", [idx, value]) replaces an earlier set for the same channel index
+#	("avg", n) replaces an earlier avg
+# Both futures then complete when the newer message is written.
+# The writer also skips a superseding message identical to the last one written within *dedupe* seconds, if it was sent with dedupe=True,
+# e.g. the same rate sent again when a text box loses focus right after Enter was pressed. Other sends are always written,
+# so a plugin can send a setting again on purpose.
+# A message sent with its own message ID, like a Request, is never coalesced.
+# A set is only replaced in place while no later message about the same channel is waiting, like a start, stop or query,
+# so it is never moved ahead of one. See channelIndexes.
+
+# function coalesceKey( String|Int key, Int|[Int] value ) return Tuple|None the identity of the device setting this message changes, or None if it should never be coalesced
+def coalesceKey(key, value):
+	if key == "avg":
+		return ("avg",)
+	if key == "set":
+		try:
+			if len(value) >= 2:
+				return ("set", value[0])
+		except TypeError:
+			pass
+	return None
+
+# function channelIndexes( String|Int key, Int|[Int] value ) return [Int]|None the indexes of the channels a message is about, None if it is about all of them
+# start and stop are about the channels in their mask, or all of them for a mask of 0. set and query are about the channel in their first word.
+def channelIndexes(key, value):
+	if key == "start" or key == "stop":
+		if isinstance(value, (list, tuple)):
+			value = value[0] if value else None
+		if not value:
+			return None
+		return [n for n in range(32) if (value >> n) & 1]
+	if key == "set" or key == "query":
+		if isinstance(value, (list, tuple)):
+			return list(value[:1])
+		if value is not None:
+			return [value]
+	return []
+
+# class SendFuture The result of a PropCom.send. Completes once the message has been written, or has failed.
+class SendFuture():
+	# constructor SendFuture( Int result ) return SendFuture a pending future, or a completed one if *result* is given
+	def __init__(self, result=None):
+		self.event = threading.Event()
+		self.result = None
+		if result is not None:
+			self.set(result)
+
+	# function SendFuture.set( Int result ) Complete the future. result = 1 if written, -1 otherwise
+	def set(self, result):
+		self.result = result
+		self.event.set()
+
+	# function SendFuture.done() return Bool True once the message has been written or has failed
+	def done(self):
+		return self.event.isSet()
+
+	# function SendFuture.wait( Float timeout ) return Int|None 1 if written, -1 if the write failed, None if still waiting after *timeout* seconds
+	def wait(self, timeout=None):
+		self.event.wait(timeout)
+		return self.result
+
+# class FutureGroup Completes when all of its futures have. Returned by PropCom.sendMany.
+class FutureGroup():
+	def __init__(self, futures):
+		self.futures = futures
+
+	def done(self):
+		return all([f.done() for f in self.futures])
+
+	# function FutureGroup.wait( Float timeout ) return Int|None 1 if all were written, -1 if any failed, None if still waiting after *timeout* seconds
+	def wait(self, timeout=None):
+		end = None
+		if timeout is not None:
+			end = time.time() + timeout
+		result = 1
+		for f in self.futures:
+			r = f.wait(None if end is None else max(end - time.time(), 0))
+			if r is None:
+				return None
+			if r < 0:
+				result = -1
+		return result
+
+# class Request A control packet waiting for the device's answer, matched by the message ID the device echoes. Returned by PropCom.request and PropCom.query.
+# Many can be in flight at once. An unanswered request is sent again with a new message ID, and an answer to any of its IDs completes it.
+class Request():
+	# constructor Request( String|Int key, Int|[Int] value, String reply, Int index ) return Request a request not yet sent
+	# reply = the message type of the answer, like "info"
+	# index = if given, the answer's first word must equal it, like the channel index of a query
+	def __init__(self, key, value=None, reply="info", index=None):
+		self.key = key
+		self.value = value
+		self.reply = reply
+		self.index = index
+		self.event = threading.Event()
+		self.answer = None	# the words of the answer
+		self.msgIDs = []	# every message ID it was sent with
+		self.sentTime = None	# host time of the last attempt
+		self.attempts = 0
+		self.rtt = None		# seconds from the last attempt to the answer
+
+	# function Request.matches( String name, [Int] val ) return Bool True if a packet of type *name* with words *val* answers this request
+	def matches(self, name, val):
+		return name == self.reply and (self.index is None or (len(val) > 0 and val[0] == self.index))
+
+	# function Request.set( [Int] val ) Complete the request with the answer *val*, or with None if it timed out.
+	def set(self, val):
+		if val is not None:
+			self.rtt = time.time() - self.sentTime
+		self.answer = val
+		self.event.set()
+
+	def done(self):
+		return self.event.isSet()
+
+	# function Request.wait( Float timeout ) return [Int]|None the words of the answer. None if it timed out, or if still waiting after *timeout* seconds.
+	def wait(self, timeout=None):
+		self.event.wait(timeout)
+		return self.answer
+
+# class RequestGroup Completes when all of its requests have. Returned by PropCom.requestMany.
+class RequestGroup():
+	def __init__(self, requests):
+		self.requests = requests
+
+	def done(self):
+		return all([r.done() for r in self.requests])
+
+	# function RequestGroup.wait( Float timeout ) return [[Int]|None]|None the answer of every request, in order, once all are done. None if still waiting after *timeout* seconds.
+	def wait(self, timeout=None):
+		end = None
+		if timeout is not None:
+			end = time.time() + timeout
+		for r in self.requests:
+			r.event.wait(None if end is None else max(end - time.time(), 0))
+			if not r.done():
+				return None
+		return [r.answer for r in self.requests]
+
+# class Outbox The queue of messages waiting for the Writer. Thread safe.
+class Outbox():
+	coalesced = 0	# messages replaced by a newer one before they were written
+
+	def __init__(self):
+		self.entries = collections.deque()	# [key, value, coalesceKey, [SendFuture], msgID, Bool dedupe]
+		self.pending = dict()	# coalesceKey -> the waiting entry for it
+		self.lastByIndex = dict()	# channel index -> the last waiting entry about it, see channelIndexes
+		self.cond = threading.Condition(threading.Lock())
+		self.closed = False
+		self.coalesced = 0
+
+	# function Outbox.put( String|Int key, Int|[Int] value, Int msgID, Bool dedupe ) return SendFuture completed once the message, or the one that supersedes it, is written
+	# msgID = the message ID to send it with. By default the next one is taken when it is written.
+	# dedupe = True if the Writer may skip it when it is the same as the last one written, see Writer.write
+	def put(self, key, value=None, msgID=None, dedupe=False):
+		future = SendFuture()
+		ckey = coalesceKey(key, value) if msgID is None else None
+		with self.cond:
+			entry = self.pending.get(ckey) if ckey is not None else None
+			if entry is not None and ckey[0] == "set" and self.lastByIndex.get(ckey[1]) is not entry:
+				entry = None	# a later message about the channel is waiting, the set must stay ahead of it
+			if entry is not None:
+				entry[1] = value
+				entry[3].append(future)
+				entry[5] = dedupe
+				self.coalesced += 1
+			else:
+				entry = [key, value, ckey, [future], msgID, dedupe]
+				self.entries.append(entry)
+				if ckey is not None:
+					self.pending[ckey] = entry
+				indexes = channelIndexes(key, value)
+				if indexes is None:
+					self.lastByIndex.clear()	# nothing waiting can be coalesced past it
+				else:
+					for idx in indexes:
+						self.lastByIndex[idx] = entry
+			self.cond.notify()
+		return future
+
+	# function Outbox.get( Float timeout ) return [List] every waiting entry, oldest first. Empty after *timeout* seconds with nothing to send, or once closed.
+	def get(self, timeout=0.5):
+		with self.cond:
+			if not self.entries and not self.closed:
+				self.cond.wait(timeout)
+			batch = list(self.entries)
+			self.entries.clear()
+			self.pending.clear()
+			self.lastByIndex.clear()
+			return batch
+
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+
+# class Writer The thread that writes everything put into an Outbox to the PropCom's port.
+class Writer(threading.Thread):
+	# constructor Writer( PropCom propCom, Outbox outbox, Float dedupe ) return Writer a daemon thread, not yet started
+	def __init__(self, propCom, outbox, dedupe=0):
+		threading.Thread.__init__(self, name="Writer")
+		self.daemon = True
+		self.propCom = propCom
+		self.outbox = outbox
+		self.dedupe = dedupe
+		self.lastWritten = dict()	# coalesceKey -> (value, time written)
+
+	def run(self):
+		while not self.outbox.closed:
+			batch = self.outbox.get()
+			if batch:
+				self.write(batch)
+		for entry in self.outbox.get(0):	# anything put in while closing
+			for f in entry[3]:
+				f.set(-1)
+
+	# function Writer.write( [List] batch ) Encode the entries of *batch* and write them in one call
+	# An entry put with dedupe=True is skipped if it is the same as the last one written for its coalesceKey, within *dedupe* seconds.
+	def write(self, batch):
+		now = time.time()
+		msgs = []
+		written = []
+		for key, value, ckey, futures, msgID, dedupe in batch:
+			if dedupe and ckey is not None and self.dedupe > 0:
+				last = self.lastWritten.get(ckey)
+				if last is not None and last[0] == value and now - last[1] < self.dedupe:
+					for f in futures:
+						f.set(1)
+					continue
+			msg = self.propCom.encode(key, value, msgID)
+			if msg is None:
+				for f in futures:
+					f.set(-1)
+				continue
+			msgs.append(msg)
+			written.append((ckey, value, futures))
+		if not msgs:
+			return
+		result = self.propCom.sendRaw("".join(msgs))
+		for ckey, value, futures in written:
+			if ckey is not None and result > 0:
+				self.lastWritten[ckey] = (value, now)
+			for f in futures:
+				f.set(result)
+
+	# function Writer.forget() Forget what was last written, so nothing is skipped as a duplicate. Used when the device may have lost its settings.
+	def forget(self):
+		self.lastWritten = dict()
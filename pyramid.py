@@ -0,0 +1,98 @@
+import numpy
+
+# pyramid.py Min, max and mean of an analog input's samples at power-of-two bucket sizes, for plotting long runs without touching every sample.
+# Level k holds buckets of 2^(BASE+k) samples, each with the ticks of its first sample, and the min, max and mean of its samples.
+# Level 0 is made from the raw samples, and each level above from pairs of buckets of the level below, as they complete.
+# Every level keeps the same number of buckets in a mirrored ring like samplering.SampleRing, so a coarser level reaches further back.
+# With *slots* buckets of 32 bytes (16, mirrored) per level, 16 levels take about 1.6 times the memory of a SampleRing of 16 * slots samples,
+# and the top level covers slots * 2^21 samples: a month at 3000 samples per second with the default history.
+#
+# AnalogIn feeds the pyramid from its history in batches, see AnalogIn.buckets. The newest samples, less than a batch, are only in the history.
+
+BASE = 6	# level 0 buckets hold 2^BASE samples
+
+# class BucketRing The buckets of one level of a Pyramid.
+class BucketRing():
+	# constructor BucketRing( Int capacity, Int size ) return BucketRing an empty ring of *capacity* buckets of *size* samples each
+	def __init__(self, capacity, size):
+		self.capacity = max(int(capacity), 1)
+		self.size = size
+		self.ticks = numpy.zeros(2 * self.capacity, dtype=numpy.int64)
+		self.min = numpy.zeros(2 * self.capacity, dtype=numpy.uint16)
+		self.max = numpy.zeros(2 * self.capacity, dtype=numpy.uint16)
+		self.mean = numpy.zeros(2 * self.capacity, dtype=numpy.float32)
+		self.head = 0	# where the next bucket goes, in [0, capacity)
+		self.count = 0	# buckets held
+		self.total = 0	# buckets ever added
+
+	# function BucketRing.extend( numpy.ndarray ticks, numpy.ndarray mins, numpy.ndarray maxs, numpy.ndarray means ) Add buckets, oldest first.
+	def extend(self, ticks, mins, maxs, means):
+		n = len(ticks)
+		cap = self.capacity
+		skip = max(n - cap, 0)
+		self.total += skip
+		n -= skip
+		head = self.head
+		first = min(n, cap - head)	# buckets before the end of the ring
+		for column, data in ((self.ticks, ticks), (self.min, mins), (self.max, maxs), (self.mean, means)):
+			data = data[skip:]
+			column[head:head + first] = column[head + cap:head + cap + first] = data[:first]
+			if first < n:
+				column[:n - first] = column[cap:cap + n - first] = data[first:]
+		self.head = (head + n) % cap
+		self.count = min(self.count + n, cap)
+		self.total += n
+
+	# function BucketRing.last( Int n ) return (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray) views of the ticks, mins, maxs and means of the last *n* buckets
+	def last(self, n):
+		end = self.head + self.capacity
+		start = end - max(min(n, self.count), 0)
+		return self.ticks[start:end], self.min[start:end], self.max[start:end], self.mean[start:end]
+
+	# function BucketRing.covers( Int t0 ) return Bool True if the ring still holds the bucket of ticks *t0*, or everything ever added
+	def covers(self, t0):
+		return self.total == self.count or (self.count > 0 and self.ticks[self.head + self.capacity - self.count] <= t0)
+
+	# function BucketRing.find( Int t0, Int t1 ) return (Int, Int) the slice, for last(count), of the buckets that overlap ticks t0 up to t1
+	def find(self, t0, t1):
+		ticks = self.last(self.count)[0]
+		return max(ticks.searchsorted(t0, "right") - 1, 0), ticks.searchsorted(t1, "left")
+
+# class Pyramid The levels of buckets of one channel.
+class Pyramid():
+	# constructor Pyramid( Int slots, Int levels ) return Pyramid an empty pyramid of *levels* levels of *slots* buckets each
+	def __init__(self, slots, levels=16):
+		self.levels = [BucketRing(slots, 1 << (BASE + k)) for k in range(max(int(levels), 1))]
+
+	# function Pyramid.extend( numpy.ndarray values, numpy.ndarray ticks ) Add raw samples, oldest first. Their number must be a multiple of 2^BASE.
+	# Only the levels that complete a bucket do any work.
+	def extend(self, values, ticks):
+		size = self.levels[0].size
+		rows = values.reshape(-1, size)
+		self.levels[0].extend(ticks[::size], rows.min(1), rows.max(1), rows.mean(1))
+		for lower, level in zip(self.levels, self.levels[1:]):
+			pending = lower.total - 2 * level.total	# buckets of the level below not yet paired
+			n = pending - pending % 2
+			if n <= 0:
+				break
+			ticks, mins, maxs, means = lower.last(pending)
+			level.extend(ticks[:n:2], numpy.minimum(mins[:n:2], mins[1:n:2]), numpy.maximum(maxs[:n:2], maxs[1:n:2]), (means[:n:2] + means[1:n:2]) / 2)
+
+	# function Pyramid.buckets( Int t0, Int t1, Int n ) return (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray)|None views of the ticks, mins, maxs and means of the buckets over ticks t0 up to t1.
+	# The finest level that still reaches back to t0 and needs at most *n* buckets is used. If none does, the coarsest level that needs at most *n*. None if the pyramid is empty.
+	def buckets(self, t0, t1, n):
+		fallback = None
+		for level in self.levels:
+			if level.count == 0:
+				break
+			i, j = level.find(t0, t1)
+			if j - i <= n:
+				columns = [column[i:j] for column in level.last(level.count)]
+				if level.covers(t0):
+					return tuple(columns)
+				fallback = tuple(columns)	# coarser levels reach further back
+		if fallback is None and self.levels[0].count > 0:	# nothing fits in n: the newest n buckets of the coarsest level
+			top = [level for level in self.levels if level.count > 0][-1]
+			i, j = top.find(t0, t1)
+			fallback = tuple([column[max(j - n, i):j] for column in top.last(top.count)])
+		return fallback
@@ -0,0 +1,73 @@
+import numpy
+
+# samplering.py The recent history of one analog input: a fixed number of samples in preallocated numpy arrays, one for the ticks and one for the values.
+# Memory is set when the ring is made and does not grow however long acquisition runs. The newest samples replace the oldest.
+# The ring is mirrored: every sample is written twice, at n and at n + capacity. The last *count* samples are then always
+# one contiguous slice, so last() and window() return views into the ring, without copying.
+# Ticks are the unwrapped device ticks from PropCom.streamTicks, so they only grow and window() can binary search them.
+#
+# Samples are added by the thread that handles the channel's packets. A view stays valid until that many newer samples have
+# been added over it, capacity samples at the least. Copy it if it is to be kept.
+
+# class SampleRing The last *capacity* samples of a channel.
+class SampleRing():
+	# constructor SampleRing( Int capacity ) return SampleRing an empty ring
+	def __init__(self, capacity):
+		self.capacity = max(int(capacity), 1)
+		self.ticks = numpy.zeros(2 * self.capacity, dtype=numpy.int64)
+		self.values = numpy.zeros(2 * self.capacity, dtype=numpy.uint16)
+		self.head = 0	# where the next sample goes, in [0, capacity)
+		self.count = 0	# samples held
+		self.total = 0	# samples ever added
+
+	def __len__(self):
+		return self.count
+
+	# function SampleRing.append( Int value, Int ticks ) Add one sample.
+	def append(self, value, ticks):
+		head = self.head
+		cap = self.capacity
+		self.ticks[head] = self.ticks[head + cap] = ticks
+		self.values[head] = self.values[head + cap] = value
+		self.head = head + 1 if head + 1 < cap else 0
+		if self.count < cap:
+			self.count += 1
+		self.total += 1
+
+	# function SampleRing.extend( numpy.ndarray values, numpy.ndarray ticks ) Add the samples of a packet, oldest first. Lists work too.
+	def extend(self, values, ticks):
+		n = len(values)
+		cap = self.capacity
+		if n > cap:
+			values = values[n - cap:]
+			ticks = ticks[n - cap:]
+			self.total += n - cap
+			n = cap
+		head = self.head
+		first = min(n, cap - head)	# samples before the end of the ring
+		for column, data in ((self.ticks, ticks), (self.values, values)):
+			column[head:head + first] = column[head + cap:head + cap + first] = data[:first]
+			if first < n:
+				column[:n - first] = column[cap:cap + n - first] = data[first:]
+		self.head = (head + n) % cap
+		self.count = min(self.count + n, cap)
+		self.total += n
+
+	# function SampleRing.span( Int n ) return (Int, Int) the slice of the mirrored arrays holding the last *n* samples
+	def span(self, n):
+		end = self.head + self.capacity
+		return end - n, end
+
+	# function SampleRing.last( Int n ) return (numpy.ndarray, numpy.ndarray) views of the ticks and values of the last *n* samples, oldest first. Fewer if the ring holds fewer.
+	def last(self, n):
+		start, end = self.span(max(min(n, self.count), 0))
+		return self.ticks[start:end], self.values[start:end]
+
+	# function SampleRing.window( Int t0, Int t1 ) return (numpy.ndarray, numpy.ndarray) views of the ticks and values of the samples with t0 <= ticks < t1, oldest first.
+	# Found by binary search, in O(log n).
+	def window(self, t0, t1):
+		start, end = self.span(self.count)
+		ticks = self.ticks[start:end]
+		i = ticks.searchsorted(t0, "left")
+		j = ticks.searchsorted(t1, "left")
+		return ticks[i:j], self.values[start + i:start + j]
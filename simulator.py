@@ -0,0 +1,457 @@
+import os
+import sys
+import time
+import math
+import random
+import select
+import struct
+import threading
+import tty
+
+import numpy
+
+import framing
+
+# simulator.py A DataSpider simulator on a pseudo-terminal, for testing and load testing without hardware.
+# It speaks the protocol of PropCom.send and PropCom.parse on the master side of a pty. Point PropCom.open at Simulator.port.
+# Answers version, query, set, start, stop, avg, dir, dig, event, timer, resetevents and trigger. Sends a sync packet every SYNCPERIOD clocks.
+# Runs the events added with Device.addEvent(s): timers expire, triggers fire, digital inputs are watched, and actions start and stop
+# analog inputs, change digital outputs and notify the host. See Simulator.runEvents. What it cannot simulate is reported on stderr.
+# Answers carry the message ID of the packet they answer, like the firmware's.
+# Started analog inputs send a point packet per sample at low rates, and 12-bit packed stream packets at high rates.
+# Faults can be injected: bad checksums, dropped bytes, and a clock that starts just before its 32-bit rollover.
+# Linux and OS X only.
+#
+# usage: python simulator.py [seconds to load test] [samples per second per channel] [samples averaged]
+#        python simulator.py control [seconds] [samples per second per channel]
+#        python simulator.py events
+# Without arguments the simulator runs until interrupted and prints its port.
+# control counts the control packets a Device sends once its channels are set up, in process and with acquisition_process on, see controlTest.
+# events runs a timer and a trigger through the simulator's event loop, see eventTest.
+
+KEYS = ["talk","over","bad","version","start","stop","set","dir","query","info","dig","wav","point","sync","avg", "timer", "event", "resetevents", "trigger"]	# same as Propeller.keyTable
+CLOCKPERSEC = 80000000
+SYNCPERIOD = 80000000
+MAX_CLOCK = (1<<32) - 1
+VERNUM = 10
+MIN_ADC_PERIOD = 1500
+HALF_CLOCK = 1<<31
+CONDITIONS = ["TimerExpire", "Always", "OnChange", "OnHigh", "OnLow", "WhileHigh", "WhileLow", "OnTrigger"]	# same as Propeller.Device.conditions
+ACTIONS = ["SetTimer", "Notify", "AIStart", "AIStop", "DOHigh", "DOLow"]	# same as Propeller.Device.actions
+
+# class Simulator A thread serving one simulated DataSpider on a new pty.
+class Simulator(threading.Thread):
+	version = VERNUM
+	streamRate = 200	# sampling rates above this many samples per second are streamed, slower ones are sent as points
+	perPacket = 31		# samples per stream packet
+	checksumErrors = 0.0	# probability of sending a packet with a wrong checksum
+	droppedBytes = 0.0	# probability of leaving one byte out of a packet
+	startClock = 0		# device clock at start up. Close to MAX_CLOCK to test rollovers
+	digitalPeriod = 0	# seconds between changes of the digital inputs. 0 for never
+
+	# constructor Simulator( Int nAnalogI, Int nAnalogO, Int nDigitals ) return Simulator a stopped simulator with its pty already open
+	def __init__(self, nAnalogI=4, nAnalogO=2, nDigitals=8):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.nAnalogI = nAnalogI
+		self.nAnalogO = nAnalogO
+		self.nDigitals = nDigitals
+		self.digitalIdx = nAnalogI + nAnalogO
+		self.master, self.slave = os.openpty()
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+		self.running = False
+		self.framer = framing.Framer()
+		self.periods = [CLOCKPERSEC // 1000] * nAnalogI + [0] * nAnalogO	# ticks per sample, or output power
+		self.started = 0	# bitmask of started analog inputs
+		self.nAvg = 1
+		self.pinDirs = 0
+		self.outVals = 0
+		self.inVals = 0
+		self.events = []	# [condition, condParam, action, actionParam, ...] as sent in event messages
+		self.timers = dict()	# timer ID -> the device clock, 32 bits, it expires at
+		self.reported = set()	# what was already reported as not simulated, see Simulator.unsupported
+		self.notified = 0	# Notify actions run
+		self.nextSample = [0] * nAnalogI	# unwrapped tick of each channel's next sample
+		self.buffers = [[] for n in range(nAnalogI)]	# (tick, value) not yet sent
+		self.sent = 0		# packets written
+		self.received = 0	# packets read
+
+	# function Simulator.clock() return Int the unwrapped device clock
+	def clock(self):
+		return self.startClock + int((time.time() - self.startTime) * CLOCKPERSEC)
+
+	# function Simulator.sample( Int idx, numpy.int64[] ticks ) return numpy.int64[] 12-bit samples of input *idx* at *ticks*
+	# Each input is a sine of 1 + idx Hz. With averaging on, every sample is the mean of nAvg ADC readings spaced MIN_ADC_PERIOD apart.
+	def sample(self, idx, ticks):
+		raw = ticks[:, None] - numpy.arange(self.nAvg)[None, :] * MIN_ADC_PERIOD
+		wave = numpy.sin(2 * math.pi * (1 + idx) * raw / float(CLOCKPERSEC) + idx)
+		return (2048 + 1800 * wave.mean(axis=1)).astype(numpy.int64) & 0xFFF
+
+	# function Simulator.send( String key, [Int] values, Int msgID ) Write a control packet to the host
+	def send(self, key, values=(), msgID=0):
+		self.write(framing.controlPacket(KEYS.index(key), values, msgID))
+
+	# function Simulator.write( String packet ) Write an encoded packet, injecting any faults asked for.
+	def write(self, packet):
+		if self.checksumErrors and random.random() < self.checksumErrors:
+			packet = packet[:-1] + chr((ord(packet[-1]) + 1) & 255 or 1)
+		if self.droppedBytes and random.random() < self.droppedBytes:
+			n = random.randrange(len(packet))
+			packet = packet[:n] + packet[n+1:]
+		self.sent += 1
+		try:
+			os.write(self.master, packet)
+		except OSError:
+			pass	# nothing has the port open
+
+	# function Simulator.handle( String packet ) Answer one control packet from the host
+	def handle(self, packet):
+		self.received += 1
+		nameNum = ord(packet[0])
+		msgID = ord(packet[1]) if len(packet) > 1 else 0
+		n = (len(packet) - 2) // 4
+		val = [struct.unpack_from(">I", packet, 2 + 4*i)[0] for i in range(n)]
+		key = KEYS[nameNum] if nameNum < len(KEYS) else None
+		if key == "version":
+			self.send("version", [self.version], msgID)
+		elif key == "query" and val:
+			self.info(val[0], msgID)
+		elif key == "set" and val:
+			idx = val[0]
+			if len(val) > 1:
+				if idx < self.nAnalogI + self.nAnalogO:
+					self.periods[idx] = max(val[1], 1)
+				elif idx == self.digitalIdx:
+					self.outVals = val[1]
+			self.info(idx, msgID)
+		elif key == "start":
+			self.startInputs(val[0] if val else 0)
+		elif key == "stop":
+			self.stopInputs(val[0] if val else 0)
+		elif key == "avg" and val:
+			self.nAvg = max(1, min(val[0], 100))
+		elif key == "dir" and val:
+			self.pinDirs = val[0]
+		elif key == "dig" and val:
+			self.outVals = val[0]
+		elif key == "timer" and len(val) > 1:
+			self.timers[val[0]] = val[1] & MAX_CLOCK
+		elif key == "event":
+			if len(val) < 2 or val[0] >= len(CONDITIONS) or len(val) % 2:
+				self.unsupported("event " + str(val))
+			else:
+				self.events.append(val)
+		elif key == "resetevents":
+			self.events = []
+			self.timers = dict()
+		elif key == "trigger":
+			trigger = val[0] if val else 0
+			self.runEvents(lambda condition, param: condition == "OnTrigger" and param == trigger)
+		else:
+			self.send("bad", [nameNum], msgID)
+
+	# function Simulator.startInputs( Int mask ) Start the analog inputs in *mask*
+	def startInputs(self, mask):
+		now = self.clock()
+		for idx in range(self.nAnalogI):
+			if mask & (1<<idx) and not self.started & (1<<idx):
+				self.nextSample[idx] = now
+		self.started |= mask & ((1<<self.nAnalogI) - 1)
+
+	# function Simulator.stopInputs( Int mask ) Stop the analog inputs in *mask*, or all of them for 0. Buffered samples are sent first.
+	def stopInputs(self, mask):
+		if mask == 0:
+			mask = (1<<self.nAnalogI) - 1
+		for idx in range(self.nAnalogI):
+			if mask & (1<<idx):
+				self.flushStream(idx)
+		self.started &= ~mask
+
+	# function Simulator.runEvents( Function matches ) Run the actions of every event whose condition *matches*.
+	# matches = called with the condition name and parameter of each event, returns True if the condition is met
+	# Conditions on pins look at the digital inputs. Actions take one parameter each:
+	#	Notify n	sends ("event", [n, clock]) to the host
+	#	AIStart i, AIStop i	start or stop analog input i
+	#	DOHigh p, DOLow p	set digital output p high or low, and send the digital channel's info packet so the host sees the change
+	# SetTimer is reported as not simulated: its parameter's meaning is not known here.
+	def runEvents(self, matches):
+		for event in self.events:
+			if not matches(CONDITIONS[event[0]], event[1]):
+				continue
+			for n in range(2, len(event), 2):
+				action = ACTIONS[event[n]] if event[n] < len(ACTIONS) else None
+				param = event[n+1]
+				if action == "Notify":
+					self.notified += 1
+					self.send("event", [param, self.clock() & MAX_CLOCK])
+				elif action == "AIStart":
+					self.startInputs(1 << param)
+				elif action == "AIStop":
+					self.stopInputs(1 << param)
+				elif action == "DOHigh" or action == "DOLow":
+					outVals = self.outVals | (1 << param) if action == "DOHigh" else self.outVals & ~(1 << param)
+					if outVals != self.outVals:
+						self.outVals = outVals
+						self.info(self.digitalIdx)
+				else:
+					self.unsupported("action " + str(action or event[n]))
+
+	# function Simulator.unsupported( String what ) Report, once, something the host asked for that the simulator does not simulate
+	def unsupported(self, what):
+		if what not in self.reported:
+			self.reported.add(what)
+			sys.stderr.write("simulator: not simulated: " + what + "\n")
+
+	# function Simulator.info( Int idx, Int msgID ) Send the info packet for channel *idx*, as the firmware answers a query.
+	def info(self, idx, msgID=0):
+		if idx < self.nAnalogI:
+			self.send("info", [idx, self.periods[idx], self.started], msgID)
+		elif idx < self.nAnalogI + self.nAnalogO:
+			self.send("info", [idx, self.periods[idx], 0], msgID)
+		elif idx == self.digitalIdx:
+			self.send("info", [idx, self.outVals, self.pinDirs], msgID)
+
+	# function Simulator.produce( Int now ) Send every sample due by the clock *now*, and the sync packets before it.
+	def produce(self, now):
+		while self.nextSync <= now:
+			self.send("sync", [self.nextSync & MAX_CLOCK])
+			self.nextSync += SYNCPERIOD
+		if self.digitalPeriod and now >= self.nextDigital:
+			old = self.inVals
+			self.inVals = (self.inVals + 1) & ~self.pinDirs & ((1<<self.nDigitals) - 1)
+			self.send("dig", [self.inVals, now & MAX_CLOCK])
+			self.nextDigital = now + int(self.digitalPeriod * CLOCKPERSEC)
+			if self.events:
+				changed = old ^ self.inVals
+				high = self.inVals
+				self.runEvents(lambda condition, pin: (changed >> pin) & 1 and (condition == "OnChange" or
+					(condition == "OnHigh" and (high >> pin) & 1) or (condition == "OnLow" and not (high >> pin) & 1)))
+		if self.timers:
+			clock = now & MAX_CLOCK
+			for timerID, expires in self.timers.items():
+				if (clock - expires) & MAX_CLOCK < HALF_CLOCK:	# reached, allowing for rollover
+					del self.timers[timerID]
+					self.runEvents(lambda condition, param: condition == "TimerExpire" and param == timerID)
+		if self.events:
+			high = self.inVals
+			self.runEvents(lambda condition, pin: condition == "Always" or
+				(condition == "WhileHigh" and (high >> pin) & 1) or (condition == "WhileLow" and not (high >> pin) & 1))
+		for idx in range(self.nAnalogI):
+			if not self.started & (1<<idx):
+				continue
+			period = self.periods[idx]
+			if self.nextSample[idx] > now:
+				continue
+			count = (now - self.nextSample[idx]) // period + 1
+			ticks = self.nextSample[idx] + period * numpy.arange(count, dtype=numpy.int64)
+			self.nextSample[idx] += period * count
+			values = self.sample(idx, ticks).tolist()
+			if CLOCKPERSEC // period <= self.streamRate:
+				for tick, v in zip(ticks.tolist(), values):
+					self.send("point", [(idx<<12) | v, tick & MAX_CLOCK])
+				continue
+			buf = self.buffers[idx]
+			buf.extend(zip(ticks.tolist(), values))
+			while len(buf) >= self.perPacket:
+				self.writeStream(idx, buf[:self.perPacket])
+				del buf[:self.perPacket]
+
+	# function Simulator.flushStream( Int idx ) Send any buffered samples of input *idx* in a short stream packet
+	def flushStream(self, idx):
+		if self.buffers[idx]:
+			self.writeStream(idx, self.buffers[idx])
+			self.buffers[idx] = []
+
+	def writeStream(self, idx, samples):
+		self.write(framing.streamPacket(idx, self.periods[idx], samples[0][0] & MAX_CLOCK, [v for t, v in samples]))
+
+	def run(self):
+		self.running = True
+		self.startTime = time.time()
+		self.nextSync = self.startClock
+		self.nextDigital = self.startClock
+		while self.running:
+			ready = select.select([self.master], [], [], 0.005)[0]
+			if ready:
+				try:
+					data = os.read(self.master, 4096)
+				except OSError:
+					data = ""
+				for packet in self.framer.feed(data):
+					self.handle(packet)
+			self.produce(self.clock())
+
+	# function Simulator.stop() Stop the thread and close the pty
+	def stop(self):
+		self.running = False
+		if self.isAlive():
+			self.join()
+		os.close(self.master)
+		os.close(self.slave)
+
+# function loadTest( Float seconds, Int rate, Int nAvg, Dict faults ) return Dict counts of what a PropCom on a new Simulator received
+# Starts every analog input at *rate* samples per second with *nAvg* averaging, and runs the full PropCom read path for *seconds*.
+# faults = Simulator attributes to set, like {"checksumErrors": 0.01, "startClock": MAX_CLOCK - CLOCKPERSEC}
+def loadTest(seconds, rate, nAvg=1, faults=None):
+	import Propeller
+	sim = Simulator()
+	for name, value in (faults or dict()).iteritems():
+		setattr(sim, name, value)
+	sim.start()
+	propCom = Propeller.PropCom()
+	propCom.port = sim.port
+	samples = [0]
+	ready = threading.Event()
+	def listener(propCom, values):
+		samples[0] += len(values) - 3
+	def point(propCom, pVal, tStamp):
+		samples[0] += 1
+	for idx in range(sim.nAnalogI):
+		propCom.addListener(idx, listener)
+	propCom.register("point", point)
+	propCom.register("version", lambda propCom, ver: ready.set())
+	propCom.register("sync", lambda propCom, tStamp: propCom.onSync(tStamp))
+	propCom.start()
+	ready.wait(10)	# the read loop only starts once the version handshake is sent
+	setup = [("avg", nAvg)] + [("set", [idx, CLOCKPERSEC // rate]) for idx in range(sim.nAnalogI)]
+	propCom.sendMany(setup + [("start", (1<<sim.nAnalogI) - 1)])
+	propCom.metrics.reset()
+	samples[0] = 0
+	time.sleep(seconds)
+	propCom.send("stop", 0)
+	time.sleep(0.2)
+	snapshot = propCom.metrics.snapshot()
+	propCom.close()	# before the simulator goes away, so the reader and dispatcher threads end with the port
+	sim.stop()
+	return {"seconds": seconds, "rate": rate, "avg": nAvg, "samples": samples[0],
+		"samples_per_sec": samples[0] / float(seconds), "expected_per_sec": rate * sim.nAnalogI,
+		"bad_checksums": snapshot["bad_checksums"], "totals": snapshot["totals"], "clock": snapshot["clock"], "simulator_packets": sim.sent}
+
+# class Control Stands in for a wx control in controlTest.
+class Control():
+	value = None
+	def SetValue(self, value):
+		self.value = value
+	def GetValue(self):
+		return self.value
+
+# class Widgets Stands in for the widgets main.py gives a channel, for controlTest.
+class Widgets():
+	def __init__(self, nPins):
+		self.channelValue = Control()
+		self.startBtn = Control()
+		self.lights = [Control() for n in range(nPins)]
+		self.switches = [Control() for n in range(nPins)]
+
+# function controlTest( Float seconds, Bool remote, Int rate ) return Dict control packets that went each way between a Device and a new Simulator
+# Every analog input is given *rate* samples per second and started through its channel, as the GUI does, then left alone for *seconds*.
+# The simulator answers every set with an info packet. The channels' info hooks must not send the set back, or the two echo each other
+# as fast as they can. A settled device sends next to nothing: "host_to_device_per_sec" should be close to 0.
+# remote = run the serial side in an acquisition process, see acquisition.py
+def controlTest(seconds, remote=False, rate=1000):
+	import Propeller
+	import logger
+	sim = Simulator()
+	sim.start()
+	acquisitionProcess = logger.options.get("acquisition_process", False)
+	logger.options["acquisition_process"] = remote
+	try:
+		device = Propeller.Device(sim.nAnalogI, sim.nAnalogO, sim.nDigitals)
+	finally:
+		logger.options["acquisition_process"] = acquisitionProcess
+	for chan in device.channels.values():
+		chan.widgets = Widgets(sim.nDigitals)
+	propCom = device.propCom
+	propCom.port = sim.port
+	ready = threading.Event()
+	propCom.register("version", lambda propCom, *ver: ready.set())
+	propCom.start()
+	ready.wait(10)
+	for chan in device.analogIn.values():
+		chan.setValue(rate)
+	time.sleep(0.5)	# an info packet answering a set reports the channel stopped, and would stop it again if it came after the start
+	for chan in device.analogIn.values():
+		chan.start()
+	time.sleep(0.5)
+	setup = (sim.received, sim.sent)
+	time.sleep(seconds)
+	settled = (sim.received - setup[0], sim.sent - setup[1])
+	propCom.close()
+	sim.stop()
+	return {"seconds": seconds, "remote": remote, "rate": rate,
+		"setup_host_to_device": setup[0], "host_to_device": settled[0], "device_to_host": settled[1],
+		"host_to_device_per_sec": settled[0] / float(seconds)}
+
+# function eventTest() return Dict what a Device saw of the events it added to a new Simulator
+# Adds events through Device.addEvents: timer 0 expiring sets digital output 1 high and notifies the host, trigger 3 sets it low again
+# and starts analog input 0. Then sets timer 0 about a second ahead with Device.setEventTimer and fires trigger 3 with Device.eventTrigger.
+# Every value in the result should be True.
+def eventTest():
+	import Propeller
+	import logger
+	sim = Simulator()
+	sim.start()
+	device = Propeller.Device(sim.nAnalogI, sim.nAnalogO, sim.nDigitals)
+	for chan in device.channels.values():
+		chan.widgets = Widgets(sim.nDigitals)
+	propCom = device.propCom
+	propCom.port = sim.port
+	synced = threading.Event()
+	notified = threading.Event()
+	propCom.register("sync", lambda propCom, tStamp: (propCom.onSync(tStamp), synced.set()))
+	propCom.register("event", lambda propCom, *val: val[:1] == (7,) and notified.set())
+	propCom.start()
+	synced.wait(10)
+	device.addEvents([("TimerExpire", 0, "DOHigh", 1, "Notify", 7), ("OnTrigger", 3, "DOLow", 1, "AIStart", 0)], reset=True)
+	device.setEventTimer(0, (propCom.lastTime + 3 * CLOCKPERSEC // 2) & MAX_CLOCK)	# the last sync was up to a second ago
+	result = {"timer_notified": notified.wait(5)}
+	time.sleep(0.2)
+	result["output_high_after_timer"] = bool(device.digitals.value & 2)
+	device.eventTrigger(3)
+	time.sleep(0.5)
+	result["output_low_after_trigger"] = not device.digitals.value & 2
+	result["input_started_by_trigger"] = bool(sim.started & 1)
+	result["nothing_unsimulated"] = not sim.reported
+	propCom.close()
+	sim.stop()
+	return result
+
+def main():
+	if len(sys.argv) > 1:
+		import config
+		import logger
+		options = dict(config.options)
+		del options["file"]
+		options["console"] = False
+		options["log_sent"] = False
+		options["state_file"] = ""	# do not remember the pty as the device's port
+		logger.setOptions(options)
+		if sys.argv[1] == "control":
+			seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+			rate = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+			for remote in [False, True]:
+				print(controlTest(seconds, remote, rate))
+			return
+		if sys.argv[1] == "events":
+			print(eventTest())
+			return
+		rate = 3000
+		nAvg = 1
+		if len(sys.argv) > 2:
+			rate = int(sys.argv[2])
+		if len(sys.argv) > 3:
+			nAvg = int(sys.argv[3])
+		print(loadTest(float(sys.argv[1]), rate, nAvg))
+		return
+	sim = Simulator()
+	sim.start()
+	print("DataSpider simulator on " + sim.port)
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		sim.stop()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,96 @@
+import struct
+import numpy
+
+# streamdecode.py Decodes 12-bit packed stream packets.
+# A stream packet is a bit string, most significant bit first:
+#	1 bit stream flag, 3 bits stream ID, 32 bit rate, 32 bit timestamp of the first sample,
+#	12 bits per sample, 32 bit timestamp of the last sample, padding up to a whole byte.
+# The firmware switches from 12 to 32 bit values once 5 or fewer bytes are left in the packet,
+# so the number of samples follows from the packet length alone.
+
+MIN_PACKED = 9		# shortest packet holding both leading words. Anything shorter goes through decodeLegacy.
+
+# function decode( String|memoryview packet ) return (Int streamID, [Int] head, numpy.uint16[] samples, [Int] tail)
+# Decode a stream packet without looking at individual bits.
+# head = the rate and the timestamp of the first sample
+# samples = the 12-bit samples
+# tail = the 32-bit words after the samples. Normally only the timestamp of the last sample.
+# head + samples + tail is exactly the value list decodeLegacy returns.
+def decode(packet):
+	if isinstance(packet, memoryview):
+		b = numpy.asarray(packet)	# a view, not a copy
+	else:
+		b = numpy.frombuffer(packet, numpy.uint8)
+	streamID = (int(b[0]) >> 4) & 7
+	length = len(b)
+	if length < MIN_PACKED:
+		streamID, values = decodeLegacy(packet)
+		return streamID, values[:2], numpy.zeros(0, numpy.uint16), values[2:]
+
+	# bit offsets below count from the most significant bit of the first byte
+	nSamples = 0
+	if 8*length >= 108:
+		nSamples = (8*length - 108) // 12 + 1
+	# samples come in pairs packed into 3 bytes, the first starting on a low nibble
+	nPairs = (nSamples + 1) // 2
+	a = b[8:9+3*nPairs].astype(numpy.uint16)
+	samples = numpy.empty(2*nPairs, numpy.uint16)
+	samples[0::2] = ((a[0:-1:3] & 15) << 8) | a[1::3]
+	samples[1::2] = (a[2::3] << 4) | (a[3::3] >> 4)
+	if nSamples & 1:
+		samples = samples[:nSamples]	# the odd half of the last pair is the start of the tail
+
+	head = [word(packet, 4), word(packet, 36)]
+	tail = []
+	bit = 68 + 12*nSamples
+	while bit + 32 <= 8*length:
+		tail.append(word(packet, bit))
+		bit += 32
+	return streamID, head, samples, tail
+
+# function word( String packet, Int bit ) return Int the 32-bit word starting *bit* bits into *packet*. *bit* must be a multiple of 4.
+def word(packet, bit):
+	if bit & 4:
+		hi, lo = struct.unpack_from(">IB", packet, bit >> 3)
+		return ((hi << 4) | (lo >> 4)) & 0xFFFFFFFF
+	return struct.unpack_from(">I", packet, bit >> 3)[0]
+
+# function decodeLegacy( String packet ) return (Int streamID, [Int] values) Decode a stream packet one bit-field at a time.
+# This is the original PropCom.parseStream loop. decode must give the same values.
+def decodeLegacy(packet):
+	packet = bytearray(packet)
+	streamID = (packet[0]>>4) & 7
+
+	values = []
+	val = 0
+	valBits=32 # bits left to read for the current val
+	byteBits=4 # bits left in the current byte
+	packet[0] = packet[0] & 15
+	bytesLeft = len(packet) # bytes left in packet
+
+	n=0
+
+	for c in packet:
+		while byteBits>0:
+			if valBits >= byteBits: # read in byteBits amount of bits
+				val = (val<<byteBits) | c
+				valBits -= byteBits
+				byteBits = 0
+			else: 			# read in valBits amount of bits, remaining bits left in c.
+				val = (val<<valBits) | (c>>(byteBits-valBits))
+				byteBits -= valBits
+				c = c & (~(255<<valBits))
+				valBits = 0
+			if valBits <= 0:
+				values.append(val)
+				n+=1
+				val = 0
+				if n<=1:
+					valBits = 32
+				elif bytesLeft <= 5:
+					valBits = 32
+				else:
+					valBits = 12
+		byteBits = 8 # prepare for next byte
+		bytesLeft -= 1
+	return streamID, values